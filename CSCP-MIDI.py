@@ -6,14 +6,28 @@
 # See Readme.txt for info on how to use this app.
 # See Project_Notes.txt for info on the implementation - how the app works.
 
-import json
+import asyncio
+import logging
+import sys
+import threading
 
 # My local files
 import CSCP_MIDI_settings as config
 import MIDI_connection
 import CSCP_connection
-import MIDI_to_CSCP
-import CSCP_to_MIDI
+import MIDI_async_connection
+import CSCP_async_connection
+import CSCP_capture
+import CSCP_MIDI_bridge
+import CSCP_MIDI_latency
+import CSCP_MIDI_log
+import CSCP_MIDI_metrics
+import CSCP_MIDI_mapping
+import CSCP_requests
+import CSCP_snapshot
+import CSCP_state
+import CSCP_sync
+import CSCP_subscription
 
 # mido uses rtmidi backend
 # For some reason I have to ensure I have rtmidi installed in order for mido to work
@@ -23,62 +37,123 @@ import CSCP_to_MIDI
 # The following import fixes this, this import is included purely for pyinstaller to build a functioning exe...
 import mido.backends.rtmidi  # DO NOT DELETE THIS EVEN THOUGH PYCHARM THINKS IT IS NOT REQUIRED
 
+LATENCY_REPORT_INTERVAL = 10  # Seconds between latency reports when run with 'latency'
+METRICS_PORT = 9150  # Local HTTP port serving Prometheus metrics when run with 'metrics'
+METRICS_FILE = "metrics.json"  # File metrics are written to when run with 'metrics-json'
+METRICS_INTERVAL = 5  # Seconds between writing METRICS_FILE
+CAPTURE_FILE = "capture.cscap"  # File everything received is recorded to when run with 'capture', see CSCP_capture
+
 
 def main():
     print("\n", 27 * "-", "\n", 8 * " ", "CSCP-MIDI\n", 27 * "-")  # Formatted title/heading
+
+    # Logging is written by a background thread. Each message handled is only logged in debug mode,
+    # I.E. from terminal - 'python CSCP-MIDI.py debug'
+    CSCP_MIDI_log.setup(logging.DEBUG if "debug" in sys.argv else logging.INFO)
+
     # Load config settings with user confirm/edit
     settings = config.get_settings()
 
-    # Load the chosen control mapping json file
+    # Load the chosen control mapping json file, compiled into tables for converting messages
     try:
-        with open(settings["Mode/Mapping"][1], "r") as control_map:
-            control_map = json.load(control_map)
+        control_map = CSCP_MIDI_mapping.load(settings["Mode/Mapping"][1])
     except FileNotFoundError:
         print("'{}' file not found!".format(settings["Mode/Mapping"][1]))
         return False
-    except json.decoder.JSONDecodeError:
-        print("'{}' file is invalid!".format(settings["Mode/Mapping"][1]))
+    except CSCP_MIDI_mapping.MappingError as e:
+        print(e)
         return False
     except TypeError:
         print("** Need to select a control mode/mapping file! **")
         return False
 
+    if "async" in sys.argv:
+        # I.E. from terminal - 'python CSCP-MIDI.py async'
+        # Runs the connections and the bridge on a single asyncio event loop rather than in threads
+        asyncio.run(run_async(settings, control_map))
+        return
+
+    # Both connections wake the bridge when they receive something, so it can sleep in between
+    wake = threading.Event()
+
+    # I.E. from terminal - 'python CSCP-MIDI.py capture', to replay later with CSCP_capture.py
+    capture = CSCP_capture.Recorder(CAPTURE_FILE) if "capture" in sys.argv else None
+
+    # Times each stage of handling messages, see CSCP_MIDI_latency
+    latency = CSCP_MIDI_latency.LatencyRecorder()
+
     # Open MIDI ports and start thread receiving incoming MIDI messages
-    midi = MIDI_connection.Connection(settings["MIDI -> CSCP port"], settings["CSCP -> MIDI port"])
+    midi = MIDI_connection.Connection(settings["MIDI -> CSCP port"], settings["CSCP -> MIDI port"], notify=wake.set,
+                                      latency=latency, capture=capture)
+
+    # Copy of the mixer's state, kept up to date by the bridge.
+    # Starts with the layout of the console used last time, until the mixer connects
+    state = CSCP_state.MixerState()
+    snapshot = CSCP_snapshot.Snapshot(state)
+    snapshot.load_latest()
 
     # Open CSCP connection and start thread receiving incoming CSCP messages
-    cscp = CSCP_connection.Connection(settings["Mixer IP Address"], settings["Mixer CSCP Port"])
+    # Only pass on the CSCP messages the mapping converts & the state is kept from
+    cscp = CSCP_connection.Connection(settings["Mixer IP Address"], settings["Mixer CSCP Port"], notify=wake.set,
+                                      latency=latency, capture=capture,
+                                      subscription=CSCP_subscription.merge(control_map.subscription(),
+                                                                           state.subscription()))
 
     # Store current settings for next start up
     config.save_settings(settings)
 
-    while True:
-        # Get the oldest received MIDI message if there are any and send it to the CSCP device
-        midi_in = midi.get_message()
-        if midi_in:
-            #print(20*"-", "\nMIDI RECEIVED: {} [MIDI messages remaining in connection buffer:{}"
-            #      .format(midi_in, len(midi.messages)))
-
-            # Convert MIDI to CSCP Message object
-            cscp_message = MIDI_to_CSCP.convert_message(midi_in, control_map)
-            if cscp_message:
-                print(20*"-", "\nMIDI RECEIVED", midi_in)
-                print("converted to CSCP Message object:", cscp_message)
-
-            if cscp_message and cscp.status == "Connected":
-                # Send CSCP message bytes to mixer
-                # print("DEBUG MAIN", cscp_message)
-                cscp.send(cscp_message.encoded)
-
-        # Get the oldest received CSCP message if there are any and send it to the MIDI device
-        cscp_in = cscp.get_message()
-        if cscp_in:
-            print(20 * "-", "\nCSCP RECEIVED:", cscp_in, ". CSCP messages remaining in connection buffer:",
-                  len(cscp.messages))
-            midi_msg = CSCP_to_MIDI.convert_message(cscp_in, control_map)
-            print("Translated to MIDI:", midi_msg)
-            if midi_msg:
-                midi.send_message(midi_msg)
+    # Messages to the mixer go through a window of requests waiting for a response
+    requests = CSCP_requests.RequestTracker(cscp)
+
+    # Pass messages between the MIDI device and the mixer until the app is closed,
+    # reading every strip's state from the mixer each time it connects
+    bridge = CSCP_MIDI_bridge.Bridge(midi, cscp, control_map, wake, latency=latency, state=state,
+                                     sync=CSCP_sync.Sync(requests), requests=requests, snapshot=snapshot)
+    # Edits to the mapping file are picked up without restarting
+    CSCP_MIDI_mapping.MappingWatcher(bridge, settings["Mode/Mapping"][1])
+    if "latency" in sys.argv:
+        # I.E. from terminal - 'python CSCP-MIDI.py latency'
+        bridge.add_timer(LATENCY_REPORT_INTERVAL, lambda: print(latency.report()))
+    if "metrics" in sys.argv:
+        # I.E. from terminal - 'python CSCP-MIDI.py metrics', then see http://127.0.0.1:9150/metrics
+        CSCP_MIDI_metrics.MetricsServer(bridge, METRICS_PORT)
+    if "metrics-json" in sys.argv:
+        bridge.add_timer(METRICS_INTERVAL, CSCP_MIDI_metrics.JsonDump(bridge, METRICS_FILE))
+
+    try:
+        bridge.run()
+    except KeyboardInterrupt:
+        # control+c, show how the bridge performed before exiting
+        print(latency.report())
+        snapshot.check()
+        if capture:
+            capture.close()
+
+
+async def run_async(settings, control_map):
+    """ Async mode version of the end of main() """
+    wake = asyncio.Event()
+    capture = CSCP_capture.Recorder(CAPTURE_FILE) if "capture" in sys.argv else None
+    state = CSCP_state.MixerState()
+    snapshot = CSCP_snapshot.Snapshot(state)
+    snapshot.load_latest()
+    midi = MIDI_async_connection.Connection(settings["MIDI -> CSCP port"], settings["CSCP -> MIDI port"],
+                                            notify=wake.set, capture=capture)
+    cscp = CSCP_async_connection.Connection(settings["Mixer IP Address"], settings["Mixer CSCP Port"],
+                                            notify=wake.set, capture=capture,
+                                            subscription=CSCP_subscription.merge(control_map.subscription(),
+                                                                                 state.subscription()))
+    config.save_settings(settings)
+
+    requests = CSCP_requests.RequestTracker(cscp)
+    bridge = CSCP_MIDI_bridge.Bridge(midi, cscp, control_map, wake, state=state, sync=CSCP_sync.Sync(requests),
+                                     requests=requests, snapshot=snapshot)
+    CSCP_MIDI_mapping.MappingWatcher(bridge, settings["Mode/Mapping"][1])
+    try:
+        await bridge.run_async()
+    finally:
+        if capture:
+            capture.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,395 @@
+# CSCP_MIDI_bridge
+# Used by the CSCP-MIDI application.
+# Provides the Bridge class that moves messages between a MIDI_connection and a CSCP_connection.
+# The connections' receiver threads set a shared threading.Event whenever they store a message,
+# the bridge sleeps on that event rather than spinning, so it uses no CPU while the controls are idle
+# In async mode the connections are from CSCP_async_connection & MIDI_async_connection and the event is an asyncio.Event
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import asyncio
+import logging
+import threading
+import time
+
+import CSCP_MIDI_coalesce as coalesce
+import CSCP_MIDI_echo as echo
+import CSCP_MIDI_latency
+import CSCP_MIDI_mapping
+import CSCP_subscription
+from CSCP_MIDI_log import Trace
+
+BATCH_SIZE = 64  # Max messages taken from each connection at a time
+
+log = logging.getLogger(__name__)
+
+
+class Bridge:
+    """
+    Dispatches received MIDI messages to the mixer and received CSCP messages to the MIDI device
+    Pass the same wake event to both connections (as their notify callback, wake.set),
+    run() then blocks until either connection has something to handle
+    """
+    def __init__(self, midi, cscp, control_map, wake=None, batch_size=BATCH_SIZE, coalescing=True,
+                 echo_suppression=True, latency=None, state=None, sync=None, requests=None, snapshot=None):
+        """
+        :param midi: MIDI_connection.Connection object
+        :param cscp: CSCP_connection.Connection object
+        :param control_map: CSCP_MIDI_mapping.Mapping, or dict loaded from json control mapping file to compile
+        :param wake: threading.Event set by the connections when they receive messages,
+                     or asyncio.Event if the connections are the async versions (use run_async())
+        :param batch_size: int, max messages taken from each connection before switching to the other
+        :param coalescing: bool, if True, when a backlog builds up only the newest of each fader's moves is sent on
+        :param echo_suppression: bool, if True, fader moves that are echoes of moves just sent are dropped
+        :param latency: optional CSCP_MIDI_latency.LatencyRecorder, also given to the connections,
+                        to record how long each message takes to get through
+        :param state: optional CSCP_state.MixerState, kept up to date from the messages received from the mixer.
+                      The CSCP connection's subscription needs to include state.subscription()
+        :param sync: optional CSCP_sync.Sync, to read every strip's state from the mixer when it connects.
+                     Likewise, the CSCP connection's subscription needs to include sync.subscription()
+        :param requests: optional CSCP_requests.RequestTracker for cscp. Messages are then sent to the mixer
+                         through it, so no more than its window are waiting for an ACK at once
+        :param snapshot: optional CSCP_snapshot.Snapshot of state, saved when the console's layout changes
+        """
+        self.midi = midi
+        self.cscp = cscp
+        if not isinstance(control_map, CSCP_MIDI_mapping.Mapping):
+            control_map = CSCP_MIDI_mapping.compile_mapping(control_map)
+        self.mapping = control_map  # Conversion tables, built once per mapping
+        self.control_map = control_map.source
+        self.wake = wake if wake else threading.Event()
+        self.batch_size = batch_size
+        self.coalescing = coalescing
+
+        # Counts of messages handled, per direction
+        self.message_counts = {CSCP_MIDI_latency.CSCP_TO_MIDI: {}, CSCP_MIDI_latency.MIDI_TO_CSCP: {}}  # per operation
+        self.unmapped = {CSCP_MIDI_latency.CSCP_TO_MIDI: 0, CSCP_MIDI_latency.MIDI_TO_CSCP: 0}  # No mapping for the strip/control, dropped
+        self.coalesced = {CSCP_MIDI_latency.CSCP_TO_MIDI: 0, CSCP_MIDI_latency.MIDI_TO_CSCP: 0}  # Dropped by coalescing
+
+        # Fader values recently sent to each device, to recognise them being echoed back, see CSCP_MIDI_echo
+        self.echo_suppression = echo_suppression
+        self.cscp_echoes = echo.EchoSuppressor(echo.CSCP_TOLERANCE)
+        self.midi_echoes = echo.EchoSuppressor(echo.MIDI_TOLERANCE)
+
+        self.latency = latency
+        self.state = state
+        self.timers = []  # [next due, interval, callback], see add_timer()
+        self.running = False
+
+        self.sync = sync
+        if sync is not None:
+            self.add_timer(sync.interval, sync.check)
+
+        self.requests = requests
+        self.send_cscp = requests.send if requests is not None else cscp.send
+        if requests is not None:
+            self.add_timer(requests.interval, requests.check)
+
+        self.snapshot = snapshot
+        if snapshot is not None:
+            self.add_timer(snapshot.interval, snapshot.check)
+
+    def add_timer(self, interval, callback):
+        """
+        Call a function every interval seconds, from the bridge's thread/task, in between handling messages
+        :param interval: float, seconds
+        :param callback: function taking no arguments
+        """
+        self.timers.append([time.monotonic() + interval, interval, callback])
+
+    def set_mapping(self, mapping):
+        """
+        Swap in a different mapping, e.g. the mapping file's been edited, see CSCP_MIDI_mapping.MappingWatcher
+        Call from the bridge's thread/task, messages already converted are still sent
+        :param mapping: CSCP_MIDI_mapping.Mapping
+        """
+        self.mapping = mapping
+        self.control_map = mapping.source
+        # Have the CSCP connection pass on what the new mapping converts, and what the state is kept from
+        subscription = getattr(self.cscp, 'subscription', None)
+        if subscription is not None:
+            subscription.update(self.subscription())
+
+    def subscription(self):
+        """ :return: dict, the CSCP operations & strips the bridge needs, see CSCP_subscription """
+        return CSCP_subscription.merge(self.mapping.subscription(),
+                                       *(part.subscription() for part in (self.state, self.sync) if part is not None))
+
+    def _run_timers(self):
+        """
+        Call any timer callbacks that are due
+        :return: float, seconds until the next is due, None if there are no timers
+        """
+        if not self.timers:
+            return None
+
+        now = time.monotonic()
+        r = None
+        for timer in self.timers:
+            if timer[0] <= now:
+                timer[2]()
+                timer[0] = now + timer[1]
+            if r is None or timer[0] - now < r:
+                r = timer[0] - now
+        return max(r, 0)
+
+    def run(self):
+        """
+        Sleep until a connection receives something, then handle everything pending.
+        Runs until stop() is called
+        """
+        self.running = True
+        while self.running:
+            # Sleep until woken by a connection or a timer is due
+            self.wake.wait(self._run_timers())
+            # Clear before draining - anything arriving while we drain sets it again,
+            # so a message can never be left sitting in a buffer while we sleep
+            self.wake.clear()
+            self.process()
+
+    async def run_async(self):
+        """
+        As run(), for async connections - waits on the event loop so other bridges and
+        connections on the same loop carry on while this one is idle
+        """
+        self.running = True
+        while self.running:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self._run_timers())
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            self.process()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+    def process(self):
+        """
+        Handle messages from both connections until both buffers are empty,
+        taking them in batches, alternating between the connections so neither direction starves the other
+        """
+        busy = True
+        while busy:
+            midi_batch = self.midi.get_messages(self.batch_size)
+            busy = bool(midi_batch)
+            if self.coalescing and len(midi_batch) > 1:
+                received = len(midi_batch)
+                midi_batch = coalesce.coalesce(midi_batch, coalesce.midi_key)
+                self.coalesced[CSCP_MIDI_latency.MIDI_TO_CSCP] += received - len(midi_batch)
+            for midi_in in midi_batch:
+                self.handle_midi(midi_in)
+
+            cscp_batch = self.cscp.get_messages(self.batch_size)
+            busy = busy or bool(cscp_batch)
+            if self.coalescing and len(cscp_batch) > 1:
+                received = len(cscp_batch)
+                cscp_batch = coalesce.coalesce(cscp_batch, coalesce.cscp_key)
+                self.coalesced[CSCP_MIDI_latency.CSCP_TO_MIDI] += received - len(cscp_batch)
+            for cscp_in in cscp_batch:
+                self.handle_cscp(cscp_in)
+
+    def handle_midi(self, midi_in):
+        """ Convert a received MIDI message to CSCP and send it to the mixer """
+        start = time.perf_counter() if self.latency else 0
+        counts = self.message_counts[CSCP_MIDI_latency.MIDI_TO_CSCP]
+        counts[midi_in.type] = counts.get(midi_in.type, 0) + 1
+
+        if self.echo_suppression:
+            key = coalesce.midi_key(midi_in)
+            # midi_key only picks out pitchwheel messages
+            if key and self.midi_echoes.is_echo(key, midi_in.pitch):
+                return
+
+        cscp_message = self.mapping.midi_to_cscp(midi_in)
+        converted = time.perf_counter() if self.latency else 0
+        if not cscp_message:
+            self.unmapped[CSCP_MIDI_latency.MIDI_TO_CSCP] += 1
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s > %s", Trace(midi_in), Trace(cscp_message) if cscp_message else "unmapped")
+
+        if cscp_message and self.cscp.status == "Connected":
+            if self.echo_suppression:
+                key = coalesce.cscp_key(cscp_message)
+                if key:
+                    self.cscp_echoes.sent(key, cscp_message.value)
+            # Send CSCP message bytes to mixer
+            self.send_cscp(cscp_message.encoded)
+            # The MIDI connection puts the time it received the message in .time
+            if self.latency and midi_in.time:
+                self._record_latency(CSCP_MIDI_latency.MIDI_TO_CSCP, midi_in.type, midi_in.time, midi_in.time,
+                                     start, converted)
+
+    def handle_cscp(self, cscp_in):
+        """ Convert a received CSCP message to MIDI and send it to the MIDI device """
+        start = time.perf_counter() if self.latency else 0
+        counts = self.message_counts[CSCP_MIDI_latency.CSCP_TO_MIDI]
+        operation = cscp_in.operation or cscp_in.type  # ACK/NAK have no operation
+        counts[operation] = counts.get(operation, 0) + 1
+
+        if self.requests is not None:
+            self.requests.received(cscp_in)
+        if self.snapshot is not None:
+            self.snapshot.received(cscp_in)  # Before the state's updated, to see what's changed
+        if self.state is not None:
+            self.state.update(cscp_in)
+        if self.sync is not None:
+            self.sync.received(cscp_in)
+        if cscp_in.type in ('ACK', 'NAK'):
+            return  # Responses to what was sent to the mixer, counted by the connection, nothing to convert
+
+        if self.echo_suppression:
+            key = coalesce.cscp_key(cscp_in)
+            if key and self.cscp_echoes.is_echo(key, cscp_in.value):
+                return
+
+        midi_msg = self.mapping.cscp_to_midi(cscp_in)
+        converted = time.perf_counter() if self.latency else 0
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s > %s (%d waiting)", Trace(cscp_in), Trace(midi_msg) if midi_msg else "unmapped",
+                      len(self.cscp.messages))
+        if midi_msg:
+            if self.echo_suppression:
+                key = coalesce.midi_key(midi_msg)
+                if key:
+                    self.midi_echoes.sent(key, midi_msg.pitch)
+            self.midi.send_message(midi_msg)
+            # The CSCP connection timestamps messages it receives with .received & .decoded
+            received = getattr(cscp_in, 'received', None)
+            if self.latency and received:
+                self._record_latency(CSCP_MIDI_latency.CSCP_TO_MIDI, cscp_in.operation, received, cscp_in.decoded,
+                                     start, converted)
+        elif cscp_in.operation in self.mapping.cscp_tables:
+            # Only operations the mapping converts, not those just received for the state (e.g. sync responses)
+            self.unmapped[CSCP_MIDI_latency.CSCP_TO_MIDI] += 1
+
+    def stats(self):
+        """
+        :return: dict of the bridge's counters, each a dict per direction (CSCP_MIDI_latency.CSCP_TO_MIDI etc.)
+        """
+        return {'messages': {direction: dict(counts) for direction, counts in self.message_counts.items()},
+                'unmapped': dict(self.unmapped),
+                'coalesced': dict(self.coalesced),
+                'echoes suppressed': {CSCP_MIDI_latency.CSCP_TO_MIDI: self.cscp_echoes.suppressed_count,
+                                      CSCP_MIDI_latency.MIDI_TO_CSCP: self.midi_echoes.suppressed_count}}
+
+    def _record_latency(self, direction, operation, received, queued, start, converted):
+        """
+        Record the stage timings for a message that has just been sent
+        :param direction: CSCP_MIDI_latency.CSCP_TO_MIDI or MIDI_TO_CSCP
+        :param operation: string, CSCP operation or MIDI message type
+        :param received: float, time.perf_counter() when the message was received
+        :param queued: float, when it was put in the connection's buffer
+        :param start: float, when the bridge started handling it
+        :param converted: float, when it had been converted
+        """
+        sent = time.perf_counter()
+        record = self.latency.record
+        record(direction, 'queue', operation, start - queued)
+        record(direction, 'convert', operation, converted - start)
+        record(direction, 'send', operation, sent - converted)
+        record(direction, 'total', operation, sent - received)
+
+
+async def run_all(bridges):
+    """
+    Run several bridges (e.g. one per mixer/controller pair) on the current event loop
+    :param bridges: list of Bridge objects, all using async connections
+    """
+    await asyncio.gather(*(bridge.run_async() for bridge in bridges))
+
+
+if __name__ == '__main__':
+    # Benchmark - compares the old busy-spin main loop with the Bridge
+    # Uses stand-in connections so no mixer or MIDI device is needed.
+    # Measures CPU used while idle, and latency from a message being stored to it being handled
+
+    print(20*'#'+' CSCP_MIDI_bridge benchmark ' + 20*'#')
+
+    class StubConnection:
+        """ Stand-in for a MIDI/CSCP Connection, messages are the time they were stored """
+        def __init__(self, notify=None):
+            self.messages = []
+            self.notify = notify
+            self.status = "Connected"
+
+        def receive(self):
+            self.messages.append(time.perf_counter())
+            if self.notify:
+                self.notify()
+
+        def get_message(self):
+            r = False
+            if self.messages:
+                r = self.messages[0]
+                self.messages = self.messages[1:]
+            return r
+
+        def get_messages(self, max_n):
+            r = self.messages[:max_n]
+            self.messages = self.messages[len(r):]
+            return r
+
+        def send(self, msg):
+            pass
+
+    class BenchBridge(Bridge):
+        def __init__(self, midi, cscp, wake=None):
+            Bridge.__init__(self, midi, cscp, {}, wake, coalescing=False)
+            self.latencies = []
+
+        def handle_midi(self, midi_in):
+            self.latencies.append(time.perf_counter() - midi_in)
+
+        def handle_cscp(self, cscp_in):
+            self.latencies.append(time.perf_counter() - cscp_in)
+
+    class BusySpinBridge(BenchBridge):
+        """ The main loop as it was - polls each connection forever """
+        def run(self):
+            self.running = True
+            while self.running:
+                midi_in = self.midi.get_message()
+                if midi_in:
+                    self.handle_midi(midi_in)
+                cscp_in = self.cscp.get_message()
+                if cscp_in:
+                    self.handle_cscp(cscp_in)
+
+    def bench(bridge, idle_time=2.0, message_qty=200, interval=0.005):
+        thread = threading.Thread(target=bridge.run, daemon=True)
+        thread.start()
+
+        # Idle - nothing received
+        cpu_start = time.process_time()
+        time.sleep(idle_time)
+        idle_cpu = 100 * (time.process_time() - cpu_start) / idle_time
+
+        # Trickle of messages in both directions, latency is the time each waits to be handled
+        for i in range(message_qty):
+            if i % 2:
+                bridge.midi.receive()
+            else:
+                bridge.cscp.receive()
+            time.sleep(interval)
+
+        bridge.stop()
+        thread.join()
+
+        latencies = sorted(bridge.latencies)
+        p50 = latencies[len(latencies) // 2] * 1e6
+        p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+        return idle_cpu, p50, p99, len(latencies)
+
+    wake = threading.Event()
+    loops = (("busy-spin", BusySpinBridge(StubConnection(), StubConnection())),
+             ("event-driven", BenchBridge(StubConnection(wake.set), StubConnection(wake.set), wake)))
+
+    for name, test_bridge in loops:
+        cpu, p50, p99, handled = bench(test_bridge)
+        print("{:>13}: idle CPU {:6.1f}%  latency p50 {:7.1f}us  p99 {:7.1f}us  ({} messages)"
+              .format(name, cpu, p50, p99, handled))
@@ -0,0 +1,121 @@
+# CSCP_MIDI_buffer
+# Used by the CSCP-MIDI application.
+# Provides the MessageBuffer class used by the MIDI & CSCP connections to store received messages
+# until the bridge gets them. A FIFO backed by a deque, so adding and removing is O(1) no matter how many
+# messages are waiting, with a maximum size and a choice of what to do when it's full
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import collections
+import threading
+
+# Overflow policies - what put() does when the buffer is full
+DROP_OLDEST = 'drop_oldest'  # Discard the oldest message to make room (default, the newest values matter most)
+DROP_NEWEST = 'drop_newest'  # Discard the message being put
+BLOCK = 'block'  # Wait for the consumer to make room. Don't use with the async connections, it would block the loop
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class MessageBuffer:
+    """
+    Thread safe FIFO of received messages, one thread putting, one getting.
+    Counts overflows and records the most messages it has held so it can be sized for production
+    """
+    def __init__(self, max_size=4096, overflow=DROP_OLDEST):
+        """
+        :param max_size: int, maximum number of messages held
+        :param overflow: one of OVERFLOW_POLICIES
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '{}', expected one of {}".format(overflow, OVERFLOW_POLICIES))
+        if max_size < 1:
+            raise ValueError("MessageBuffer max_size must be at least 1")
+
+        self.max_size = max_size
+        self.overflow = overflow
+        self.messages = collections.deque()
+        self.not_full = threading.Condition()
+
+        self.overflow_count = 0  # Messages dropped, or (BLOCK) times put() had to wait
+        self.high_water = 0  # Most messages held at once
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        # Iterate over a copy, the receiver thread may be adding to the buffer
+        return iter(list(self.messages))
+
+    def put(self, msg):
+        """
+        Add a message to the end of the buffer, applying the overflow policy if full
+        :param msg: message object
+        :return: True if the message was stored, False if it was dropped
+        """
+        if len(self.messages) >= self.max_size:
+            self.overflow_count += 1
+
+            if self.overflow == DROP_NEWEST:
+                return False
+
+            elif self.overflow == DROP_OLDEST:
+                try:
+                    self.messages.popleft()
+                except IndexError:
+                    pass  # Consumer emptied it in the meantime
+
+            else:
+                with self.not_full:
+                    while len(self.messages) >= self.max_size:
+                        self.not_full.wait()
+
+        self.messages.append(msg)
+        if len(self.messages) > self.high_water:
+            self.high_water = len(self.messages)
+        return True
+
+    def get(self):
+        """
+        Remove and return the oldest message
+        :return: message object, or False if the buffer is empty
+        """
+        try:
+            r = self.messages.popleft()
+        except IndexError:
+            return False
+
+        if self.overflow == BLOCK:
+            with self.not_full:
+                self.not_full.notify()
+        return r
+
+    def get_many(self, max_n):
+        """
+        Remove and return up to max_n of the oldest messages, in the order they were received
+        :param max_n: int
+        :return: list of message objects, empty if the buffer is empty
+        """
+        r = []
+        popleft = self.messages.popleft
+        try:
+            for _ in range(min(max_n, len(self.messages))):
+                r.append(popleft())
+        except IndexError:
+            pass
+
+        if r and self.overflow == BLOCK:
+            with self.not_full:
+                self.not_full.notify()
+        return r
+
+    def stats(self):
+        """
+        :return: dict of the buffer's current size and counters
+        """
+        return {'size': len(self.messages),
+                'max size': self.max_size,
+                'high water': self.high_water,
+                'overflows': self.overflow_count}
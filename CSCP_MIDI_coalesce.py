@@ -0,0 +1,80 @@
+# CSCP_MIDI_coalesce
+# Used by the CSCP-MIDI application.
+# Provides coalesce() to thin out a batch of received messages before they are converted.
+# Sweeping a fader sends hundreds of moves a second, if they arrive faster than they can be handled
+# only the newest value for each fader is worth sending on - the rest are already out of date.
+# Toggles (cut, pfl etc.) are never dropped and keep their order.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+# CSCP operations that carry a continuous value - only the latest per strip matters
+CSCP_CONTINUOUS = ('fader_move', 'main_fader_move')
+
+# MIDI message types that carry a continuous value - only the latest per channel matters
+# (control_change is left out as the Korg's buttons also send CCs in CC mode)
+MIDI_CONTINUOUS = ('pitchwheel',)
+
+
+def cscp_key(msg):
+    """
+    :param msg: CSCP Message object
+    :return: (operation, strip) if msg is a continuous control, else None
+    """
+    if msg.operation in CSCP_CONTINUOUS:
+        return msg.operation, msg.strip
+    return None
+
+
+def midi_key(msg):
+    """
+    :param msg: mido message
+    :return: (type, channel) if msg is a continuous control, else None
+    """
+    if msg.type in MIDI_CONTINUOUS:
+        return msg.type, msg.channel
+    return None
+
+
+def coalesce(messages, key):
+    """
+    Drops all but the newest message for each continuous control in a batch.
+    The kept message stays at the position of the newest, everything else keeps its order
+    :param messages: list of messages, oldest first
+    :param key: function taking a message, returning a hashable key for continuous controls or None for others,
+                e.g. cscp_key or midi_key
+    :return: list of messages, oldest first
+    """
+    if len(messages) < 2:
+        return messages
+
+    seen = set()
+    r = []
+    # Work back from the newest, so the first of each key seen is the one to keep
+    for msg in reversed(messages):
+        k = key(msg)
+        if k is not None:
+            if k in seen:
+                continue
+            seen.add(k)
+        r.append(msg)
+
+    r.reverse()
+    return r
+
+
+if __name__ == '__main__':
+    import mido
+
+    test_batch = [mido.Message('pitchwheel', channel=0, pitch=0),
+                  mido.Message('pitchwheel', channel=1, pitch=100),
+                  mido.Message('note_on', note=8, velocity=127),
+                  mido.Message('pitchwheel', channel=0, pitch=200),
+                  mido.Message('note_on', note=8, velocity=0),
+                  mido.Message('pitchwheel', channel=0, pitch=300),
+                  ]
+
+    for message in coalesce(test_batch, midi_key):
+        print(message)
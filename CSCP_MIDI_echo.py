@@ -0,0 +1,77 @@
+# CSCP_MIDI_echo
+# Used by the CSCP-MIDI application.
+# Provides the EchoSuppressor class, used by the bridge to stop fader feedback loops.
+# A fader move from MIDI is sent to the mixer, which echoes the move back. Sent on to the DAW that moves its
+# fader, which sends the move as MIDI again... and the scaling between MIDI & CSCP values rounds each time,
+# so the values come back slightly off and the faders jitter.
+# The bridge remembers the values it recently sent for each fader and drops received moves that match them.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import collections
+import time
+
+WINDOW = 0.5  # Seconds after sending a value that a matching received value is treated as its echo
+HISTORY = 32  # Max recently sent values remembered per fader
+
+# How far a received value can be from a sent value and still be an echo, allowing for rounding when scaling
+# between MIDI pitch (16384 steps) and CSCP fader level (1025 steps)
+CSCP_TOLERANCE = 1  # CSCP fader levels
+MIDI_TOLERANCE = 16  # MIDI pitch values, i.e. one CSCP fader level
+
+
+class EchoSuppressor:
+    """
+    Remembers values recently sent to a device, per control (e.g. per fader),
+    to recognise the device echoing them back
+    """
+    def __init__(self, tolerance, window=WINDOW):
+        """
+        :param tolerance: int, max difference between a sent and received value for it to be an echo
+        :param window: float, seconds a sent value is remembered for
+        """
+        self.tolerance = tolerance
+        self.window = window
+        self.sent_values = {}  # key: deque of (time sent, value), oldest first
+        self.suppressed_count = 0
+
+    def sent(self, key, value, now=None):
+        """
+        Record a value being sent
+        :param key: hashable control identifier, e.g. CSCP_MIDI_coalesce.cscp_key(msg)
+        :param value: int, value sent
+        :param now: float, time.monotonic(), looked up if not given
+        """
+        if now is None:
+            now = time.monotonic()
+        history = self.sent_values.get(key)
+        if history is None:
+            history = self.sent_values[key] = collections.deque(maxlen=HISTORY)
+        history.append((now, value))
+
+    def is_echo(self, key, value, now=None):
+        """
+        Checks whether a received value is an echo of one recently sent, counting it if so
+        :param key: hashable control identifier, as passed to sent()
+        :param value: int, value received
+        :param now: float, time.monotonic(), looked up if not given
+        :return: True if the received value should be dropped
+        """
+        history = self.sent_values.get(key)
+        if not history:
+            return False
+
+        if now is None:
+            now = time.monotonic()
+        # Forget values sent too long ago
+        while history and now - history[0][0] > self.window:
+            history.popleft()
+
+        for sent_time, sent_value in history:
+            if abs(value - sent_value) <= self.tolerance:
+                self.suppressed_count += 1
+                return True
+        return False
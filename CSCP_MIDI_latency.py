@@ -0,0 +1,153 @@
+# CSCP_MIDI_latency
+# Used by the CSCP-MIDI application.
+# Measures how long messages spend in each stage of the bridge, to prove (or not!) that it adds < 1ms.
+# Each stage's durations go into a fixed size Histogram per operation, so memory use doesn't grow
+# and recording costs about the same as a dict lookup and a couple of sums - cheap enough to leave on.
+#
+# Stages, CSCP -> MIDI:
+#   unpack  - socket receive to CSCP_unpack finding the messages in the data (per chunk of received data)
+#   decode  - building the CSCP_message.Message
+#   queue   - waiting in the connection's buffer for the bridge
+#   convert - CSCP_to_MIDI.convert_message
+#   send    - sending the MIDI message
+#   total   - socket receive to sent
+# MIDI -> CSCP has the same stages except unpack & decode, mido does those before we see the message
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import math
+
+CSCP_TO_MIDI = 'CSCP -> MIDI'
+MIDI_TO_CSCP = 'MIDI -> CSCP'
+STAGES = {CSCP_TO_MIDI: ('unpack', 'decode', 'queue', 'convert', 'send', 'total'),
+          MIDI_TO_CSCP: ('queue', 'convert', 'send', 'total')}
+
+# Histogram buckets are log scale, SUB_BUCKETS per doubling of microseconds, up to 2^OCTAVES us (~2 minutes)
+SUB_BUCKETS = 16
+OCTAVES = 27
+BUCKET_QTY = SUB_BUCKETS * (OCTAVES + 1)
+
+
+class Histogram:
+    """
+    Fixed memory histogram of durations, resolution is within ~6% of the value
+    """
+    def __init__(self):
+        self.counts = [0] * BUCKET_QTY
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        us = seconds * 1e6
+        if us < 1:
+            index = 0
+        else:
+            # us = mantissa * 2**exponent, mantissa in range 0.5 to 1
+            mantissa, exponent = math.frexp(us)
+            index = min(exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS), BUCKET_QTY - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """ Add another Histogram's counts to this one's """
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """
+        :param percent: float, e.g. 99 for the 99th percentile
+        :return: float, seconds - upper edge of the bucket holding the percentile, 0 if nothing recorded
+        """
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(_bucket_top(i), self.max)
+        return self.max
+
+
+def _bucket_top(index):
+    """ :return: float, seconds - the upper edge of a Histogram bucket """
+    if index == 0:
+        return 1e-6
+    exponent, sub_bucket = divmod(index, SUB_BUCKETS)
+    return (0.5 + (sub_bucket + 1) / (2 * SUB_BUCKETS)) * 2 ** exponent / 1e6
+
+
+class LatencyRecorder:
+    """
+    Holds a Histogram per direction, stage & operation
+    Recorded from both a connection's receiver thread and the bridge, never by two threads for the same stage
+    """
+    def __init__(self):
+        self.histograms = {}  # (direction, stage, operation): Histogram
+
+    def record(self, direction, stage, operation, seconds):
+        key = (direction, stage, operation)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.record(seconds)
+
+    def summary(self):
+        """
+        :return: dict, {(direction, stage, operation): Histogram} including an operation 'all'
+                 for each stage, combining all the operations
+        """
+        r = {}
+        for (direction, stage, operation), histogram in list(self.histograms.items()):
+            combined = r.get((direction, stage, 'all'))
+            if combined is None:
+                combined = r[(direction, stage, 'all')] = Histogram()
+            combined.merge(histogram)
+            if operation:
+                r[(direction, stage, operation)] = histogram
+        return r
+
+    def report(self):
+        """
+        :return: string, table of the stage timings in microseconds
+        """
+        summary = self.summary()
+        lines = ["{:<13}{:<9}{:<18}{:>9}{:>9}{:>9}{:>9}{:>10}"
+                 .format('Direction', 'Stage', 'Operation', 'Count', 'p50', 'p95', 'p99', 'max')]
+        for direction in STAGES:
+            for stage in STAGES[direction]:
+                keys = sorted(key for key in summary if key[:2] == (direction, stage))
+                # 'all' first, then each operation
+                keys.sort(key=lambda k: k[2] != 'all')
+                for key in keys:
+                    h = summary[key]
+                    lines.append("{:<13}{:<9}{:<18}{:>9}{:>9.1f}{:>9.1f}{:>9.1f}{:>10.1f}"
+                                 .format(direction, stage, key[2], h.count, h.percentile(50) * 1e6,
+                                         h.percentile(95) * 1e6, h.percentile(99) * 1e6, h.max * 1e6))
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    recorder = LatencyRecorder()
+    for _ in range(100000):
+        recorder.record(CSCP_TO_MIDI, 'convert', 'fader_move', random.expovariate(1 / 20e-6))
+    recorder.record(CSCP_TO_MIDI, 'convert', 'cut_toggle', 5e-6)
+    print(recorder.report())
+
+    start = time.perf_counter()
+    for _ in range(100000):
+        recorder.record(CSCP_TO_MIDI, 'convert', 'fader_move', 20e-6)
+    print("\nrecord() costs {:.2f}us".format((time.perf_counter() - start) / 100000 * 1e6))
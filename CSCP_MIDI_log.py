@@ -0,0 +1,87 @@
+# CSCP_MIDI_log
+# Used by the CSCP-MIDI application.
+# Sets up logging so that writing log messages never holds up the bridge -
+# records are put on a queue and formatted & written by a background thread.
+# Each module logs with logging.getLogger(__name__) and guards per message logging with
+# log.isEnabledFor(logging.DEBUG), so no strings are built for messages unless debug logging is on.
+# Trace provides a compact one line format for logging CSCP & MIDI messages.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    The standard QueueHandler formats the message before queueing it, i.e. in the thread that logged it.
+    This leaves that for the listener's thread, the arguments logged (message objects) aren't changed after
+    """
+    def prepare(self, record):
+        return record
+
+
+def setup(level=logging.INFO, path=None):
+    """
+    Configure logging for the app - everything logged goes through a queue to a background thread
+    that writes it to the console, and to a file if path is given
+    :param level: logging level, e.g. logging.DEBUG to log every message handled
+    :param path: optional string, file to also write the log to
+    :return: logging.handlers.QueueListener, already started (and stopped when the app exits)
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if path:
+        handlers.append(logging.FileHandler(path))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)  # Writes out anything still queued
+    return listener
+
+
+class Trace:
+    """
+    Wraps a CSCP Message object or mido message for logging in a compact single line,
+    only formatted if the log record is actually written, e.g.
+        CSCP fader_move s3 v744 [f106008000000302e893]
+        MIDI pitchwheel ch0 -8192 [e00000]
+    """
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        msg = self.message
+        if hasattr(msg, 'operation'):
+            if not msg.operation:
+                return "CSCP {}".format(msg.type)  # ACK/NAK
+            return "CSCP {} s{} v{} [{}]".format(msg.operation, msg.strip, msg.value,
+                                                  msg.encoded.hex() if msg.encoded else '')
+        if msg.type == 'pitchwheel':
+            detail = "ch{} {}".format(msg.channel, msg.pitch)
+        elif msg.type in ('note_on', 'note_off'):
+            detail = "ch{} n{} v{}".format(msg.channel, msg.note, msg.velocity)
+        elif msg.type == 'control_change':
+            detail = "ch{} cc{} v{}".format(msg.channel, msg.control, msg.value)
+        else:
+            detail = ""
+        return "MIDI {} {} [{}]".format(msg.type, detail, msg.hex().replace(' ', '').lower())
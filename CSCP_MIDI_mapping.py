@@ -0,0 +1,391 @@
+# CSCP_MIDI_mapping
+# Used by the CSCP-MIDI application.
+# Compiles a json control mapping file into flat dispatch tables, one per direction, so converting a message
+# is an index into a table of ready made conversion functions - rather than walking the nested mapping dicts
+# with str() keys and catching KeyErrors for every message, as MIDI_to_CSCP & CSCP_to_MIDI.convert_message do.
+# The mapping is checked as it's compiled, so a bad mapping file is reported when it's loaded
+# rather than silently dropping messages later.
+# MappingWatcher reloads the mapping file when it's edited, without restarting the bridge or its connections.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import json
+import logging
+import os
+import struct
+import threading
+
+import mido
+
+import CSCP_encode
+import CSCP_MIDI_scale
+import CSCP_schema as schema
+import CSCP_to_MIDI
+import MIDI_to_CSCP
+
+MIDI_CHANNELS = 16
+MIDI_NOTES = 128
+MAX_STRIP = 0xFFFF  # Strips are 2 bytes
+
+# MIDI message types the control_map can map, and the message attribute picking out the control
+MIDI_CONTROLS = {'pitchwheel': 'channel',
+                 'note_on': 'note'}
+
+WATCH_INTERVAL = 1  # Seconds between checking the mapping file for changes
+
+log = logging.getLogger(__name__)
+
+
+class MappingError(ValueError):
+    """ The mapping file can't be used, the message says what's wrong with it """
+
+
+def _int(value, where, low, high):
+    """
+    :param value: value from the mapping, an int or a string of one, e.g. a dict key
+    :param where: string, where value is in the mapping, for the error message
+    :return: int, value, if it's in range low to high
+    """
+    try:
+        r = int(value)
+    except (TypeError, ValueError):
+        raise MappingError("{}: '{}' isn't a number".format(where, value))
+    if not low <= r <= high:
+        raise MappingError("{}: {} isn't in range {} to {}".format(where, r, low, high))
+    return r
+
+
+def _table(section, where, key_high, value_high, value_low=0):
+    """
+    Checks a {"number": number} table, e.g. "ch_to_strip", converting its keys & values to ints
+    :return: dict, int: int
+    """
+    if not isinstance(section, dict):
+        raise MappingError("{} should be a table of numbers".format(where))
+    return {_int(key, where, 0, key_high): _int(value, '{} "{}"'.format(where, key), value_low, value_high)
+            for key, value in section.items()}
+
+
+def _operation(section, where):
+    """ :return: string, the "command" in section, if it's a CSCP operation """
+    if not isinstance(section, dict) or "command" not in section:
+        raise MappingError("{} needs a \"command\"".format(where))
+    command = section["command"]
+    if command not in schema.OPERATION_CODES:
+        raise MappingError("{}: unknown CSCP command '{}'".format(where, command))
+    return command
+
+
+def _value_high(operation, where):
+    """ :return: int, highest value operation's messages can hold, if it writes a number to a strip """
+    layout = schema.LAYOUTS[(operation, 'write')]
+    if layout.fields != ['strip', 'value'] or layout.tail:
+        raise MappingError("{}: '{}' can't be mapped to a note, it doesn't write a number to a strip".format(
+            where, operation))
+    return (1 << 8 * struct.calcsize('>' + layout.struct.format[-1])) - 1
+
+
+def _fader_to_cscp(operation, strip, levels):
+    """ :return: function converting a pitchwheel message to a fader move on strip """
+    def convert(message):
+        return MIDI_to_CSCP.frame_cache.message(operation, strip, levels[message.pitch - CSCP_MIDI_scale.PITCH_MIN])
+    return convert
+
+
+def _note_to_cscp(operations):
+    """ :param operations: dict, velocity: CSCP message, :return: function converting a note_on message """
+    def convert(message):
+        return operations.get(message.velocity, False)
+    return convert
+
+
+def _fader_to_midi(channel, pitches):
+    """
+    :return: function converting a fader move to a pitchwheel message on channel
+    Making a mido message takes longer than the rest of the conversion, so each level's is kept once made
+    """
+    made = [None] * (CSCP_MIDI_scale.LEVEL_MAX + 1)
+
+    def convert(msg):
+        level = min(msg.value, CSCP_MIDI_scale.LEVEL_MAX)
+        midi = made[level]
+        if midi is None:
+            midi = made[level] = mido.Message('pitchwheel', channel=channel, pitch=pitches[level])
+        return midi
+    return convert
+
+
+def _toggle_to_midi(note):
+    """ :return: function converting a toggle to a note_on message """
+    # TODO - handle two-way toggling of controls properly! see CSCP_to_MIDI.convert_message
+    # Reaper only toggles, with a velocity of 127, so the same message is sent whatever the toggle's value
+    midi = mido.Message('note_on', note=note, velocity=127)
+
+    def convert(msg):
+        return midi
+    return convert
+
+
+class Mapping:
+    """
+    A control mapping compiled for converting messages, see compile_mapping()
+    Messages returned are shared with other conversions, so mustn't be changed
+    """
+    def __init__(self, source, scale, midi_tables, cscp_tables):
+        """
+        :param source: dict, the mapping json it was compiled from
+        :param scale: CSCP_MIDI_scale.Scale for the mapping's faders
+        :param midi_tables: dict, MIDI message type: list of conversion functions (or None),
+                            indexed by MIDI_CONTROLS attribute
+        :param cscp_tables: dict, CSCP operation: list of conversion functions (or None), indexed by strip
+        """
+        self.source = source
+        self.scale = scale
+        self.midi_tables = midi_tables
+        self.cscp_tables = cscp_tables
+
+    def midi_to_cscp(self, message):
+        """
+        :param message: MIDI message from mido
+        :return: CSCP_encode Message, False if the mapping doesn't map message
+        """
+        table = self.midi_tables.get(message.type)
+        if table is None:
+            return False
+        convert = table[getattr(message, MIDI_CONTROLS[message.type])]
+        return convert(message) if convert else False
+
+    def cscp_to_midi(self, msg):
+        """
+        :param msg: CSCP Message received from the mixer
+        :return: mido MIDI message, False if the mapping doesn't map msg
+        """
+        table = self.cscp_tables.get(msg.operation)
+        if table is None:
+            return False
+        strip = msg.strip
+        convert = table[strip] if type(strip) == int and 0 <= strip < len(table) else None
+        return convert(msg) if convert else False
+
+    def subscription(self):
+        """ :return: dict, the CSCP operations & strips cscp_to_midi() converts, see CSCP_subscription """
+        return {operation: [strip for strip, convert in enumerate(table) if convert]
+                for operation, table in self.cscp_tables.items()}
+
+
+def _compile_midi_to_cscp(control_map, scale):
+    """ :return: dict, MIDI message type: list of conversion functions, see Mapping """
+    if not isinstance(control_map, dict):
+        raise MappingError('"control_map" should be a table of MIDI message types')
+    tables = {}
+    for midi_type, section in control_map.items():
+        where = 'control_map "{}"'.format(midi_type)
+        if midi_type not in MIDI_CONTROLS:
+            raise MappingError("{}: MIDI message type not supported, only {}".format(
+                where, ', '.join(MIDI_CONTROLS)))
+
+        if midi_type == 'pitchwheel':
+            operation = _operation(section, where)
+            if operation not in CSCP_encode.FADER_OPERATIONS:
+                raise MappingError("{}: '{}' can't be mapped to a pitchwheel, only {}".format(
+                    where, operation, ', '.join(CSCP_encode.FADER_OPERATIONS)))
+            channels = _table(section.get("ch_to_strip", {}), where + ' "ch_to_strip"', MIDI_CHANNELS - 1, MAX_STRIP)
+            table = [None] * MIDI_CHANNELS
+            for channel, strip in channels.items():
+                table[channel] = _fader_to_cscp(operation, strip, scale.pitch_to_level)
+        else:
+            if not isinstance(section, dict):
+                raise MappingError("{} should be a table of notes".format(where))
+            table = [None] * MIDI_NOTES
+            for note, control in section.items():
+                note_where = '{} "{}"'.format(where, note)
+                note = _int(note, where, 0, MIDI_NOTES - 1)
+                operation = _operation(control, note_where)
+                strip = _int(control.get("strip"), note_where + ' "strip"', 0, MAX_STRIP)
+                values = _table(control.get("velocity", {}), note_where + ' "velocity"', 127,
+                                _value_high(operation, note_where))
+                # Made here rather than taken from the frame cache, which is only for the bridge's thread
+                try:
+                    messages = {velocity: CSCP_encode.Message(operation, strip, value)
+                                for velocity, value in values.items()}
+                except (struct.error, ValueError, TypeError, AttributeError) as e:
+                    raise MappingError("{}: can't make a '{}' message - {}".format(note_where, operation, e))
+                table[note] = _note_to_cscp(messages)
+        tables[midi_type] = table
+    return tables
+
+
+def _compile_cscp_to_midi(section, scale):
+    """ :return: dict, CSCP operation: list of conversion functions, see Mapping """
+    if not isinstance(section, dict):
+        raise MappingError('"CSCP to MIDI" should be a table')
+    if section.get("fader_move", "pitchwheel") != "pitchwheel":
+        raise MappingError('"CSCP to MIDI" "fader_move": only "pitchwheel" is supported')
+
+    tables = {}
+    for operation, name in CSCP_to_MIDI.MAPPED_OPERATIONS.items():
+        where = '"CSCP to MIDI" "{}"'.format(name)
+        if operation == 'fader_move':
+            targets = _table(section.get(name, {}), where, MAX_STRIP, MIDI_CHANNELS - 1)
+        else:
+            targets = _table(section.get(name, {}), where, MAX_STRIP, MIDI_NOTES - 1)
+        table = [None] * (max(targets) + 1 if targets else 0)
+        for strip, target in targets.items():
+            if operation == 'fader_move':
+                table[strip] = _fader_to_midi(target, scale.level_to_pitch)
+            else:
+                table[strip] = _toggle_to_midi(target)
+        tables[operation] = table
+    return tables
+
+
+def compile_mapping(source):
+    """
+    :param source: dict, loaded mapping json
+    :return: Mapping
+    :raises MappingError: if source isn't a usable mapping
+    """
+    if not isinstance(source, dict):
+        raise MappingError("Mapping should be a table of \"control_map\" & \"CSCP to MIDI\"")
+    try:
+        scale = CSCP_MIDI_scale.from_mapping(source)
+    except (ValueError, TypeError, ZeroDivisionError, AttributeError) as e:
+        raise MappingError('control_map "pitchwheel": invalid "min", "max" or "curve" - {}'.format(e))
+    return Mapping(source, scale, _compile_midi_to_cscp(source.get("control_map", {}), scale),
+                   _compile_cscp_to_midi(source.get("CSCP to MIDI", {}), scale))
+
+
+def load(path):
+    """
+    :param path: string, json control mapping file
+    :return: Mapping
+    :raises MappingError: if the file isn't valid json or isn't a usable mapping
+    :raises FileNotFoundError, TypeError: as for open()
+    """
+    with open(path, "r") as f:
+        try:
+            source = json.load(f)
+        except json.decoder.JSONDecodeError as e:
+            raise MappingError("'{}' file is invalid! {}".format(path, e))
+    try:
+        return compile_mapping(source)
+    except MappingError as e:
+        raise MappingError("'{}': {}".format(path, e))
+
+
+class MappingWatcher:
+    """
+    Watches a bridge's mapping file, swapping in the new mapping when the file changes
+    Checks the file's modified time & size on a bridge timer, so it's only a stat() in between handling messages.
+    A changed file is compiled on its own thread, then swapped in on the bridge's next timer tick -
+    the bridge only pauses to assign the new Mapping. If the new mapping is invalid, the old one is kept
+    """
+    def __init__(self, bridge, path, interval=WATCH_INTERVAL):
+        """
+        :param bridge: CSCP_MIDI_bridge.Bridge, using the mapping loaded from path
+        :param path: string, json control mapping file
+        :param interval: float, seconds between checking the file
+        """
+        self.bridge = bridge
+        self.path = path
+        self.signature = self._signature()
+        self.compiling = None  # Thread compiling a changed file
+        self.compiled = None  # Mapping compiled from a changed file, waiting to be swapped in
+        self.reload_count = 0
+        self.failed_count = 0
+        self.last_error = None
+        bridge.add_timer(interval, self.check)
+
+    def _signature(self):
+        """ :return: (modified time, size) of the file, None if it can't be read """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _compile(self):
+        """ Compile the changed file, run on its own thread """
+        try:
+            self.compiled = load(self.path)
+        except (MappingError, OSError) as e:
+            self.failed_count += 1
+            self.last_error = str(e)
+            log.warning("Mapping not reloaded, keeping the previous one - %s", e)
+
+    def check(self):
+        """ Bridge timer callback - swap in a compiled mapping, or start compiling the file if it's changed """
+        compiled = self.compiled
+        if compiled is not None:
+            self.compiled = None
+            self.bridge.set_mapping(compiled)
+            self.reload_count += 1
+            log.info("Reloaded mapping '%s'", self.path)
+
+        if self.compiling is not None and self.compiling.is_alive():
+            return  # Check again once it's done, in case the file changed again while compiling
+        signature = self._signature()
+        if signature is not None and signature != self.signature:
+            self.signature = signature
+            self.compiling = threading.Thread(target=self._compile, daemon=True)
+            self.compiling.start()
+
+    def stats(self):
+        """ :return: dict of the watcher's counters """
+        return {'reloaded': self.reload_count,
+                'failed': self.failed_count,
+                'last error': self.last_error}
+
+
+if __name__ == '__main__':
+    import timeit
+
+    with open("korg_sonar_reaper.json", "r") as f:
+        control_map = json.load(f)
+    mapping = load("korg_sonar_reaper.json")
+
+    midi_messages = (mido.Message('pitchwheel', channel=2, pitch=1234), mido.Message('note_on', note=9, velocity=127),
+                     mido.Message('note_on', note=17, velocity=0), mido.Message('note_on', note=60, velocity=127))
+    cscp_messages = (CSCP_encode.Message('fader_move', 3, 744), CSCP_encode.Message('cut_toggle', 2, 0),
+                     CSCP_encode.Message('fader_move', 40, 744))
+
+    # Compiled conversions give the same as the dict walking ones
+    for message in midi_messages:
+        print(message, '>', mapping.midi_to_cscp(message))
+        compiled = mapping.midi_to_cscp(message)
+        reference = MIDI_to_CSCP.convert_message(message, control_map, mapping.scale)
+        assert (compiled and reference and compiled.encoded == reference.encoded) or (not compiled and not reference)
+    for msg in cscp_messages:
+        print(msg, '>', mapping.cscp_to_midi(msg))
+        assert mapping.cscp_to_midi(msg) == CSCP_to_MIDI.convert_message(msg, control_map, mapping.scale)
+    print(mapping.subscription())
+
+    for bad in ({"control_map": {"pitchwheel": {"command": "fader_mvoe"}}},
+                {"control_map": {"note_on": {"8": {"command": "pfl_toggle", "strip": "one"}}}},
+                {"control_map": {"pitchwheel": {"command": "fader_move", "ch_to_strip": {"16": 0}}}},
+                {"control_map": {"pitchwheel": {"command": "fader_move", "curve": "squiggly"}}},
+                {"control_map": {"pitchwheel": {"command": "fader_move", "min": 8191, "max": -8192}}},
+                {"control_map": {"pitchwheel": {"command": "cut_toggle"}}},
+                {"control_map": {"note_on": {"8": {"command": "read_fader_label", "strip": 0}}}},
+                {"control_map": {"note_on": {"8": {"command": "cut_toggle", "strip": 0, "velocity": {"127": 300}}}}},
+                {"control_map": {"control_change": {}}},
+                {"CSCP to MIDI": {"pfl_strip_to_note": {"0": 200}}}):
+        try:
+            compile_mapping(bad)
+        except MappingError as e:
+            print('MappingError:', e)
+
+    print('\nus per message:  {:>12}{:>12}'.format('dict walk', 'compiled'))
+    for message in midi_messages[:2]:
+        print('{:<17}{:>12.2f}{:>12.2f}'.format(message.type, *(
+            timeit.timeit(test, number=100000) * 10 for test in
+            (lambda: MIDI_to_CSCP.convert_message(message, control_map, mapping.scale),
+             lambda: mapping.midi_to_cscp(message)))))
+    for msg in cscp_messages[:2]:
+        print('{:<17}{:>12.2f}{:>12.2f}'.format(msg.operation, *(
+            timeit.timeit(test, number=100000) * 10 for test in
+            (lambda: CSCP_to_MIDI.convert_message(msg, control_map, mapping.scale),
+             lambda: mapping.cscp_to_midi(msg)))))
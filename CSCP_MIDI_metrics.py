@@ -0,0 +1,219 @@
+# CSCP_MIDI_metrics
+# Used by the CSCP-MIDI application.
+# Opt-in reporting of the bridge's counters (messages per direction & operation, ACK/NAKs, invalid checksums,
+# buffer sizes, reconnects...) so throughput problems can be seen without reading scrolling prints.
+# Either serve them over HTTP in Prometheus text format (MetricsServer),
+# or periodically write them to a JSON file (JsonDump), including messages per second.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import http.server
+import json
+import os
+import threading
+import time
+
+ADDRESS = '127.0.0.1'  # Only serve metrics to this machine by default
+PORT = 9150
+
+# name: (Prometheus type, help text)
+METRICS = {'cscp_midi_messages_total': ('counter', 'Messages handled by the bridge'),
+           'cscp_midi_unmapped_total': ('counter', 'Messages dropped as the mapping has no conversion for their strip/control'),
+           'cscp_midi_coalesced_total': ('counter', 'Fader moves dropped by coalescing'),
+           'cscp_midi_echoes_suppressed_total': ('counter', 'Fader moves dropped as echoes of moves sent'),
+           'cscp_midi_receive_queue_depth': ('gauge', 'Messages waiting in a connection\'s receive buffer'),
+           'cscp_midi_receive_queue_high_water': ('gauge', 'Most messages held in a connection\'s receive buffer'),
+           'cscp_midi_receive_queue_overflows_total': ('counter', 'Receive buffer overflows'),
+           'cscp_midi_send_queue_depth': ('gauge', 'Messages waiting to be sent to the mixer'),
+           'cscp_midi_send_delayed_total': ('counter', 'Messages held back by send pacing'),
+           'cscp_midi_send_replaced_total': ('counter', 'Held back fader moves replaced by a newer move'),
+           'cscp_midi_filtered_total': ('counter', 'CSCP messages dropped as not subscribed to'),
+           'cscp_midi_acks_total': ('counter', 'ACKs received from the mixer'),
+           'cscp_midi_naks_total': ('counter', 'NAKs received from the mixer'),
+           'cscp_midi_invalid_checksums_total': ('counter', 'CSCP messages received with an invalid checksum'),
+           'cscp_midi_false_headers_total': ('counter', 'Possible CSCP message starts found to be data'),
+           'cscp_midi_garbage_bytes_total': ('counter', 'Received bytes that were not part of a valid CSCP message'),
+           'cscp_midi_residual_bytes': ('gauge', 'Received bytes held waiting for the rest of a CSCP message'),
+           'cscp_midi_reconnects_total': ('counter', 'Times the CSCP connection was lost'),
+           'cscp_midi_status_transitions_total': ('counter', 'CSCP connection status changes'),
+           'cscp_midi_connected': ('gauge', '1 if the CSCP connection status is Connected'),
+           'cscp_midi_syncs_total': ('counter', 'Complete reads of every strip\'s state from the mixer'),
+           'cscp_midi_sync_seconds': ('gauge', 'Seconds the last read of every strip\'s state took'),
+           'cscp_midi_sync_timed_out_total': ('counter', 'Strip state reads given up on for lack of a response'),
+           'cscp_midi_requests_in_flight': ('gauge', 'Messages sent to the mixer waiting for a response'),
+           'cscp_midi_requests_waiting': ('gauge', 'Messages waiting for room in the request window'),
+           'cscp_midi_requests_timed_out_total': ('counter', 'Messages sent to the mixer with no response in time'),
+           }
+
+
+def _direction_label(direction):
+    """ 'CSCP -> MIDI' to 'cscp_to_midi' """
+    return direction.replace(' -> ', '_to_').lower()
+
+
+def collect(bridge):
+    """
+    Gathers the bridge's & its connections' counters
+    :param bridge: CSCP_MIDI_bridge.Bridge object
+    :return: list of (metric name, labels dict, value) tuples, names as in METRICS
+    """
+    r = []
+    bridge_stats = bridge.stats()
+    for direction, counts in bridge_stats['messages'].items():
+        for operation, count in counts.items():
+            r.append(('cscp_midi_messages_total',
+                      {'direction': _direction_label(direction), 'operation': str(operation)}, count))
+    for stat, name in (('unmapped', 'cscp_midi_unmapped_total'),
+                       ('coalesced', 'cscp_midi_coalesced_total'),
+                       ('echoes suppressed', 'cscp_midi_echoes_suppressed_total')):
+        for direction, count in bridge_stats[stat].items():
+            r.append((name, {'direction': _direction_label(direction)}, count))
+
+    cscp_stats = bridge.cscp.stats()
+    for connection, stats in (('cscp', cscp_stats), ('midi', bridge.midi.stats())):
+        receive_buffer = stats['receive buffer']
+        r.append(('cscp_midi_receive_queue_depth', {'connection': connection}, receive_buffer['size']))
+        r.append(('cscp_midi_receive_queue_high_water', {'connection': connection}, receive_buffer['high water']))
+        r.append(('cscp_midi_receive_queue_overflows_total', {'connection': connection}, receive_buffer['overflows']))
+
+    # Async connection doesn't pace sending
+    if 'send scheduler' in cscp_stats:
+        scheduler = cscp_stats['send scheduler']
+        r.append(('cscp_midi_send_queue_depth', {}, scheduler['queued']))
+        r.append(('cscp_midi_send_delayed_total', {}, scheduler['delayed']))
+        r.append(('cscp_midi_send_replaced_total', {}, scheduler['replaced']))
+
+    for operation, count in cscp_stats['filtered'].items():
+        r.append(('cscp_midi_filtered_total', {'operation': operation}, count))
+    r.append(('cscp_midi_acks_total', {}, cscp_stats['ACKs']))
+    r.append(('cscp_midi_naks_total', {}, cscp_stats['NAKs']))
+    r.append(('cscp_midi_invalid_checksums_total', {}, cscp_stats['invalid checksums']))
+    r.append(('cscp_midi_false_headers_total', {}, cscp_stats['false headers']))
+    r.append(('cscp_midi_garbage_bytes_total', {}, cscp_stats['garbage bytes']))
+    r.append(('cscp_midi_residual_bytes', {}, cscp_stats['residual bytes']))
+    r.append(('cscp_midi_reconnects_total', {}, cscp_stats['reconnects']))
+    for (previous, status), count in cscp_stats['status transitions'].items():
+        r.append(('cscp_midi_status_transitions_total', {'from': previous, 'to': status}, count))
+    r.append(('cscp_midi_connected', {}, 1 if cscp_stats['status'] == 'Connected' else 0))
+
+    if bridge.sync is not None:
+        sync_stats = bridge.sync.stats()
+        r.append(('cscp_midi_syncs_total', {}, sync_stats['syncs']))
+        if sync_stats['last sync seconds'] is not None:
+            r.append(('cscp_midi_sync_seconds', {}, sync_stats['last sync seconds']))
+        r.append(('cscp_midi_sync_timed_out_total', {}, sync_stats['timed out']))
+
+    if bridge.requests is not None:
+        requests_stats = bridge.requests.stats()
+        r.append(('cscp_midi_requests_in_flight', {}, requests_stats['in flight']))
+        r.append(('cscp_midi_requests_waiting', {}, requests_stats['waiting']))
+        r.append(('cscp_midi_requests_timed_out_total', {}, requests_stats['timed out']))
+    return r
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(bridge):
+    """
+    :param bridge: CSCP_MIDI_bridge.Bridge object
+    :return: string, the bridge's metrics in Prometheus text exposition format
+    """
+    samples = {}
+    for name, labels, value in collect(bridge):
+        samples.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        if name not in samples:
+            continue
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for labels, value in samples[name]:
+            if labels:
+                label_text = ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+                lines.append("{}{{{}}} {}".format(name, label_text, value))
+            else:
+                lines.append("{} {}".format(name, value))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves the bridge's metrics at http://<address>:<port>/metrics from its own thread
+    """
+    def __init__(self, bridge, port=PORT, address=ADDRESS):
+        """
+        :param bridge: CSCP_MIDI_bridge.Bridge object
+        :param port: int, TCP port to listen on
+        :param address: string, IP address to listen on
+        """
+        self.bridge = bridge
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] != '/metrics':
+                    handler.send_error(404)
+                    return
+                body = prometheus_text(bridge).encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass  # Don't print every request
+
+        self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JsonDump:
+    """
+    Writes the bridge's metrics to a JSON file each time it's called, e.g. from Bridge.add_timer()
+    Counters are also given as a rate per second since the previous call
+    """
+    def __init__(self, bridge, path):
+        """
+        :param bridge: CSCP_MIDI_bridge.Bridge object
+        :param path: string, file to write, replaced on each call
+        """
+        self.bridge = bridge
+        self.path = path
+        self.previous = {}
+        self.previous_time = None
+
+    def __call__(self):
+        now = time.monotonic()
+        interval = now - self.previous_time if self.previous_time else None
+
+        metrics = []
+        current = {}
+        for name, labels, value in collect(self.bridge):
+            sample = {'name': name, 'labels': labels, 'value': value}
+            key = (name, tuple(sorted(labels.items())))
+            current[key] = value
+            if interval and METRICS[name][0] == 'counter':
+                sample['per second'] = round((value - self.previous.get(key, 0)) / interval, 3)
+            metrics.append(sample)
+
+        self.previous = current
+        self.previous_time = now
+
+        # Write to a temporary file and swap it in, so the file is never seen half written
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'time': time.time(), 'metrics': metrics}, f, indent=1)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,167 @@
+# CSCP_MIDI_scale
+# Used by the CSCP-MIDI application.
+# Converts between MIDI values (14 bit pitchwheel & 7 bit CC) and CSCP fader levels (0 - 1024) with lookup tables
+# built once per mapping, so each conversion is just indexing an array.
+# Level -> MIDI tables are made as inverses of the MIDI -> level tables, so a value sent one way and echoed back
+# comes back as the same value rather than drifting by a step each time it goes round.
+# A mapping can name the taper curve from controller travel to mixer fader level, e.g. in the mapping json:
+#     "pitchwheel" : {"command" : "fader_move", "min" : -8192, "max" : 8192, "curve" : "audio-log", ...
+# curve being "linear" (default), "audio-log", or a list of [travel, level] breakpoints, both 0 to 1,
+# e.g. [[0, 0], [0.75, 0.9], [1, 1]] for the top quarter of the controller's travel to cover the top 10%
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import array
+import bisect
+
+PITCH_MIN = -8192
+PITCH_MAX = 8191
+CC_MAX = 127
+LEVEL_MAX = 1024  # CSCP fader level range is 0 - 1024
+
+LINEAR = 'linear'
+AUDIO_LOG = 'audio-log'
+AUDIO_LOG_BASE = 81  # Audio taper, half travel gives 10% level
+
+
+def _curve_function(curve):
+    """
+    :param curve: LINEAR, AUDIO_LOG or list of [travel, level] breakpoints
+    :return: function taking controller travel 0 to 1, returning fader level 0 to 1
+    """
+    if curve == LINEAR:
+        return lambda x: x
+    if curve == AUDIO_LOG:
+        return lambda x: (AUDIO_LOG_BASE ** x - 1) / (AUDIO_LOG_BASE - 1)
+    if isinstance(curve, str):
+        raise ValueError("Unknown fader curve '{}'".format(curve))
+
+    points = sorted((float(x), float(y)) for x, y in curve)
+    if len(points) < 2 or any(b[1] < a[1] for a, b in zip(points, points[1:])):
+        raise ValueError("Fader curve needs 2 or more breakpoints, with levels rising: {}".format(curve))
+    if any(not (0 <= x <= 1 and 0 <= y <= 1) for x, y in points):
+        raise ValueError("Fader curve breakpoints' travel & level need to be 0 to 1: {}".format(curve))
+    xs = [x for x, y in points]
+
+    def breakpoints(x):
+        i = min(max(bisect.bisect_right(xs, x), 1), len(points) - 1)
+        (x0, y0), (x1, y1) = points[i - 1], points[i]
+        if x1 == x0:
+            return y1
+        return y0 + (y1 - y0) * (min(max(x, x0), x1) - x0) / (x1 - x0)
+    return breakpoints
+
+
+def _inverse(table, size, bottom, top):
+    """
+    Makes the inverse of a table of rising values, e.g. pitch -> level into level -> pitch
+    Each value maps back to the middle of the run of indexes giving that value, so converting there and back
+    lands on the same value - apart from the lowest & highest values, which map to the ends of the controller's
+    travel (or as near as their runs allow), so the mixer's fader at an end stop moves the controller to its end.
+    Values the table skips map to the index giving the nearest value
+    :param table: array, rising values in range 0 to size - 1
+    :param size: int, length of the inverse table
+    :param bottom: int, index of the bottom of the controller's travel
+    :param top: int, index of the top of the controller's travel
+    :return: list of indexes into table
+    """
+    r = []
+    for value in range(size):
+        first = bisect.bisect_left(table, value)
+        last = bisect.bisect_right(table, value) - 1
+        if first <= last:
+            if value == table[0]:
+                r.append(min(max(bottom, first), last))
+            elif value == table[-1]:
+                r.append(min(max(top, first), last))
+            else:
+                r.append((first + last) // 2)
+        elif first == 0:
+            r.append(0)
+        elif first == len(table) or value - table[first - 1] <= table[first] - value:
+            r.append(first - 1)
+        else:
+            r.append(first)
+    return r
+
+
+class Scale:
+    """
+    Lookup tables converting MIDI values to CSCP fader levels and back
+    """
+    def __init__(self, curve=LINEAR, midi_min=PITCH_MIN, midi_max=PITCH_MAX):
+        """
+        :param curve: LINEAR, AUDIO_LOG or list of [travel, level] breakpoints
+        :param midi_min: int, pitch at the bottom of the controller's travel
+        :param midi_max: int, pitch at the top of the controller's travel
+        """
+        if not midi_min < midi_max:
+            raise ValueError("min {} needs to be less than max {}".format(midi_min, midi_max))
+        self.curve = curve
+        function = _curve_function(curve)
+
+        def level(travel):
+            return round(function(min(max(travel, 0.0), 1.0)) * LEVEL_MAX)
+
+        pitch_range = midi_max - midi_min
+        self.pitch_to_level = array.array('H', (level((pitch - midi_min) / pitch_range)
+                                                for pitch in range(PITCH_MIN, PITCH_MAX + 1)))
+        self.level_to_pitch = array.array('h', (i + PITCH_MIN for i in _inverse(
+            self.pitch_to_level, LEVEL_MAX + 1, midi_min - PITCH_MIN, midi_max - PITCH_MIN)))
+        self.cc_to_level = array.array('H', (level(cc / CC_MAX) for cc in range(CC_MAX + 1)))
+        self.level_to_cc = array.array('B', _inverse(self.cc_to_level, LEVEL_MAX + 1, 0, CC_MAX))
+
+    def level(self, pitch):
+        """ :return: int, CSCP fader level for a MIDI pitchwheel value """
+        return self.pitch_to_level[pitch - PITCH_MIN]
+
+    def pitch(self, level):
+        """ :return: int, MIDI pitchwheel value for a CSCP fader level """
+        return self.level_to_pitch[level]
+
+    def cc_level(self, cc_value):
+        """ :return: int, CSCP fader level for a 7 bit MIDI CC value """
+        return self.cc_to_level[cc_value]
+
+    def cc(self, level):
+        """ :return: int, 7 bit MIDI CC value for a CSCP fader level """
+        return self.level_to_cc[level]
+
+
+def from_mapping(mapping):
+    """
+    :param mapping: dict, loaded mapping json
+    :return: Scale for the mapping's pitchwheel min, max & curve
+    """
+    pitchwheel = mapping.get("control_map", {}).get("pitchwheel", {})
+    return Scale(pitchwheel.get("curve", LINEAR), pitchwheel.get("min", PITCH_MIN), pitchwheel.get("max", PITCH_MAX))
+
+
+DEFAULT = Scale()  # Linear over the full pitchwheel range, used when no Scale is given
+
+
+if __name__ == '__main__':
+    import timeit
+
+    for curve in (LINEAR, AUDIO_LOG, [[0, 0], [0.75, 0.9], [1, 1]]):
+        scale = Scale(curve)
+        # Level -> pitch -> level always comes back the same
+        exact = all(scale.level(scale.pitch(level)) == level for level in range(LEVEL_MAX + 1))
+        # Pitch -> level -> pitch -> level is stable after the first trip
+        stable = all(scale.level(scale.pitch(scale.level(p))) == scale.level(p) for p in range(PITCH_MIN, PITCH_MAX + 1))
+        # Not exact where the curve is too shallow for each CC value to have its own level
+        cc_exact = all(scale.cc(scale.cc_level(cc)) == cc for cc in range(CC_MAX + 1))
+        print('{!s:<30} level round trip exact: {}, pitch round trip stable: {}, CC round trip exact: {}'
+              .format(curve, exact, stable, cc_exact))
+        print('    pitch -8192, -4096, 0, 4096, 8191 -> levels',
+              [scale.level(p) for p in (-8192, -4096, 0, 4096, 8191)],
+              ', levels 0, 512, 1024 -> pitch', [scale.pitch(level) for level in (0, 512, 1024)])
+
+    scale = Scale()
+    print('\nlevel() us: {:.3f}'.format(timeit.timeit(lambda: scale.level(1234), number=100000) * 10))
+    print('table lookup us: {:.3f}'.format(timeit.timeit(lambda: scale.pitch_to_level[1234 + 8192],
+                                                         number=100000) * 10))
+    print('build Scale ms: {:.1f}'.format(timeit.timeit(lambda: Scale(AUDIO_LOG), number=10) * 100))
@@ -0,0 +1,231 @@
+# CSCP_async_connection
+# Used by the CSCP-MIDI application when running in async mode.
+# asyncio version of CSCP_connection - handles the IP connection with a mixer using asyncio streams,
+# so one event loop can look after many mixers without a thread per connection.
+# Pings, reconnects and receive timeouts are just timers on the event loop.
+# Provides the same public methods as CSCP_connection.Connection
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import asyncio
+import logging
+
+import CSCP_capture
+import CSCP_MIDI_buffer as buffer
+import CSCP_pacing as pacing
+import CSCP_unpack as unpack
+import CSCP_message
+import CSCP_subscription
+import CSCP_encode as encode
+
+TIMEOUT = 3  # how long to wait when starting connection
+RECEIVE_TIMEOUT = 10  # how long to wait for data before pinging the mixer
+RETRY_INTERVAL = 5  # how long to wait before trying to connect again
+BUFFER_SIZE = 4096  # Max received messages held waiting to be handled
+OVERFLOW = buffer.DROP_OLDEST  # What to do when that's exceeded. Not BLOCK, that would stall the event loop
+
+# Output pacing, as CSCP_connection, see CSCP_pacing
+SEND_RATE = 500  # Max messages per second sent to the mixer on average, None for no limit
+SEND_BURST = 50  # Max messages sent back to back before SEND_RATE applies
+FADER_INTERVAL = 0.01  # Min seconds between moves of the same fader, 0 for no limit
+
+log = logging.getLogger(__name__)
+
+
+class Connection:
+    """
+    An asyncio CSCP Connection object
+    Must be created from within a running event loop, it starts a task on that loop that
+    makes and monitors the connection, attempting reconnect when not connected or connection is lost
+    When connected, validates received messages and stores them as CSCP Message objects
+    Provides methods to get received messages and to send CSCP messages
+    """
+    def __init__(self, ip_address, tcp_port, notify=None, buffer_size=BUFFER_SIZE, overflow=OVERFLOW,
+                 send_rate=SEND_RATE, send_burst=SEND_BURST, fader_interval=FADER_INTERVAL,
+                 subscription=None, capture=None):
+        """
+        :param ip_address: string, mixer's IP address
+        :param tcp_port: int, mixer's CSCP port
+        :param notify: optional callable, called on the event loop whenever messages are received,
+                       e.g. asyncio.Event.set to wake up whatever is waiting on them
+        :param buffer_size: int, maximum number of received messages held
+        :param overflow: policy when the buffer is full, one of CSCP_MIDI_buffer.OVERFLOW_POLICIES
+        :param send_rate: float, max messages per second sent to the mixer, None for no limit
+        :param send_burst: int, max messages sent back to back before send_rate applies
+        :param fader_interval: float, min seconds between moves of the same fader, 0 for no limit
+        :param subscription: optional dict, operation name: strips (or None for all), the only messages to pass on,
+                             see CSCP_subscription. Others are dropped as they're unpacked. None to pass everything
+        :param capture: optional CSCP_capture.Recorder, everything received is recorded to it
+        """
+        self.address = ip_address
+        self.port = tcp_port
+        self.notify = notify
+        self.capture = capture
+        self.reader = None
+        self.writer = None
+        self.status = 'Starting'
+        self.status_transitions = {}  # (from, to): count of status changes
+        self.reconnect_count = 0
+        self.unpack_stats = {'invalid checksum': 0}
+        self.messages = buffer.MessageBuffer(buffer_size, overflow)
+        self.subscription = CSCP_subscription.Subscription(subscription)
+
+        # Count of ACK & NAK responses received from the mixer
+        self.ack_count = 0
+        self.nak_count = 0
+
+        # Everything sent goes through the scheduler, which paces messages so as not to flood the mixer
+        self.scheduler = pacing.AsyncOutputScheduler(self._send, send_rate, send_burst, fader_interval)
+
+        # Holds residual data from the end of a received chunk that may be the start of a message
+        # continued in the next chunk, see CSCP_connection
+        self.unpacker = unpack.Unpacker(self.unpack_stats)
+
+        self.receiver = asyncio.get_running_loop().create_task(self._run())
+
+    async def _connect(self):
+        """
+        Try to open a connection to the mixer
+        :return: True if connected, else False
+        """
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.address, self.port),
+                                                              TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            log.warning('Failed to create connection with IP address %s on port %s', self.address, self.port)
+            self.writer = None
+            return False
+
+        # Send a message to get some data back
+        self.send(encode.read_back('read_console_info'))
+        self._set_status("Connected")
+        return True
+
+    async def _run(self):
+        """
+        Started as a task by init
+        Make and monitor a connection, reconnecting if it is lost
+        """
+        while True:
+            if not self.status == 'Connection Lost!':
+                self._set_status('Not Connected')
+
+            if await self._connect():
+                # Only returns if the connection is lost
+                await self._receive()
+                self._set_status("Connection Lost!")
+                self.reconnect_count += 1
+                self.close()
+            else:
+                await asyncio.sleep(RETRY_INTERVAL)  # Wait before trying to connect again
+
+    async def _receive(self):
+        """ Listen for incoming messages until the connection is lost """
+        self.unpacker.reset()
+        if self.capture:
+            self.capture.record(CSCP_capture.CSCP_CONNECTED, b'')
+        pinged = False
+
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(1024), RECEIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                data = None
+            except OSError:
+                return
+
+            if data:
+                pinged = False
+                if self.capture:
+                    self.capture.record(CSCP_capture.CSCP, data)
+                # Unpack messages from received bytes, completing any message started in the previous chunk
+                messages = self.unpacker.feed(data)
+                if messages:
+                    for msg in messages:
+                        if type(msg) == int:
+                            if msg == 5:
+                                self.nak_count += 1
+                            else:
+                                self.ack_count += 1
+                        elif not self.subscription.wants(msg):
+                            continue  # Not subscribed to, dropped before building a message
+                        self.messages.put(CSCP_message.Message(msg))
+                    if self.notify:
+                        self.notify()
+
+            elif data == b'':
+                # End of stream, mixer closed the connection
+                return
+
+            elif pinged:
+                # No data received even after mixer being pinged
+                return
+
+            else:
+                # No data received, send a message to see if the mixer is still there
+                pinged = True
+                self.send(encode.read_back('read_console_name'))
+
+    def _set_status(self, status):
+        """ Update self.status, counting the change """
+        if status != self.status:
+            transition = (self.status, status)
+            self.status_transitions[transition] = self.status_transitions.get(transition, 0) + 1
+            self.status = status
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def _send(self, msg):
+        """ Called by self.scheduler when it's OK to send msg """
+        if self.writer:
+            self.writer.write(msg)
+
+    # PUBLIC METHODS
+    def send(self, msg):
+        """
+        Public method to send a message to the mixer, doesn't wait for it to be sent
+        Messages are sent in order, but may be held back briefly if sending too fast
+        :param msg: bytes, e.g. CSCP_encode.Message.encoded
+        :return: True if msg replaced a fader move still waiting to be sent, see CSCP_pacing.OutputScheduler.send
+        """
+        return self.scheduler.send(msg)
+
+    def get_message(self):
+        """
+        public / called externally
+        - removes and returns the oldest message in the buffer
+        :return: CSCP Message object
+        """
+        return self.messages.get()
+
+    def get_messages(self, max_n):
+        """
+        public / called externally
+        - removes and returns up to max_n of the oldest messages in the buffer
+        :param max_n: int
+        :return: list of CSCP Message objects, oldest first (empty if none received)
+        """
+        return self.messages.get_many(max_n)
+
+    def stats(self):
+        """
+        :return: dict of connection counters, for tuning buffer size & send pacing
+        """
+        return {'status': self.status,
+                'status transitions': dict(self.status_transitions),
+                'reconnects': self.reconnect_count,
+                'ACKs': self.ack_count,
+                'NAKs': self.nak_count,
+                'invalid checksums': self.unpack_stats['invalid checksum'],
+                'false headers': self.unpack_stats['false header'],
+                'garbage bytes': self.unpack_stats['garbage bytes'],
+                'residual bytes': self.unpacker.residual_size(),
+                'filtered': self.subscription.stats(),
+                'receive buffer': self.messages.stats(),
+                'send scheduler': self.scheduler.stats()}
@@ -0,0 +1,159 @@
+# CSCP_bulk
+# Tools for checking & unpacking a large amount of CSCP data in one go,
+# e.g. a captured session being analysed offline or a saved label/path info dump.
+# Finds every SOH that could start a message, then validates all their checksums together with NumPy,
+# from a running sum of the whole buffer - rather than summing each message's payload in turn.
+# Falls back to a pure Python loop if NumPy isn't installed.
+# Live connections use CSCP_unpack.Unpacker, 1024 byte chunks are too small for this to be worthwhile.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import sys
+
+import CSCP_utils as utils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Bulk checks work without it, just slower
+
+
+def candidate_offsets(buffer):
+    """
+    Finds every SOH in buffer whose message, going by the byte count following it, would fit in buffer
+    :param buffer: bytes or bytearray
+    :return: (start, end) indexes of each possible message, in order -
+             a NumPy array, shape (n, 2), if NumPy is installed, else a list of tuples
+    """
+    if numpy is not None:
+        data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        starts = numpy.flatnonzero(data[:-1] == utils.CSCP_HEADER_START)
+        ends = starts + data[starts + utils.BYTE_COUNT_BYTE].astype(numpy.int64) + 4
+        keep = ends <= len(data)
+        return numpy.column_stack((starts[keep], ends[keep]))
+
+    r = []
+    i = buffer.find(utils.CSCP_HEADER_START)
+    while 0 <= i < len(buffer) - 1:
+        end = i + buffer[i + utils.BYTE_COUNT_BYTE] + 4
+        if end <= len(buffer):
+            r.append((i, end))
+        i = buffer.find(utils.CSCP_HEADER_START, i + 1)
+    return r
+
+
+def validate_checksums(buffer, offsets):
+    """
+    Checks the checksums of many messages at once
+    A message's payload plus its two's complement checksum sums to 0 (in 8 bits), so with a running sum of the
+    whole buffer, each message's check is the difference between the running sum at either end of its payload
+    :param buffer: bytes or bytearray
+    :param offsets: (start, end) indexes of messages in buffer, e.g. from candidate_offsets()
+    :return: True for each message with a valid checksum -
+             a NumPy bool array if NumPy is installed, else a list of bools
+    """
+    if numpy is not None:
+        data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        # uint8 wraps around, so the running sum is already modulo 256
+        running_sum = numpy.zeros(len(data) + 1, dtype=numpy.uint8)
+        numpy.cumsum(data, dtype=numpy.uint8, out=running_sum[1:])
+        bounds = numpy.asarray(offsets, dtype=numpy.int64).reshape(-1, 2)
+        totals = running_sum[bounds[:, 1]] - running_sum[bounds[:, 0] + utils.CSCP_HEADER_LENGTH]
+        return totals == 0
+
+    with memoryview(buffer) as view:
+        return [(sum(view[start + utils.CSCP_HEADER_LENGTH:end]) & 0xFF) == 0 for start, end in offsets]
+
+
+def unpack_buffer(buffer):
+    """
+    Extracts all the valid messages, the same as feeding buffer to a CSCP_unpack.Unpacker
+    (scanning resumes after each valid message, and at the next SOH after an invalid one)
+    ACKs & NAKs aren't included
+    :param buffer: bytes or bytearray
+    :return: list of bytes, each valid message
+    """
+    offsets = candidate_offsets(buffer)
+    valid = validate_checksums(buffer, offsets)
+    if numpy is not None:
+        offsets = offsets[valid].tolist()
+    else:
+        offsets = [message for message, message_valid in zip(offsets, valid) if message_valid]
+
+    r = []
+    unpacked_to = 0
+    for start, end in offsets:
+        # Skip SOHs within the previous valid message
+        if start >= unpacked_to:
+            r.append(bytes(buffer[start:end]))
+            unpacked_to = end
+    return r
+
+
+if __name__ == '__main__':
+    # python CSCP_bulk.py <capture file> - counts the messages in a file of received CSCP data,
+    # otherwise benchmarks validate_checksums against checking each message in turn
+    import collections
+    import logging
+    import random
+    import time
+
+    import CSCP_decode as decode
+    import CSCP_encode as encode
+    import CSCP_unpack as unpack
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            capture = f.read()
+        counts = collections.Counter(decode.Message(message).operation for message in unpack_buffer(capture))
+        for operation, count in counts.most_common():
+            print('{:<25}{:>9}'.format(str(operation), count))
+        sys.exit()
+
+    # Synthetic stream of fader moves & labels, with some bytes corrupted
+    random.seed(1)
+    frames = []
+    size = 0
+    while size < 4 * 1024 * 1024:
+        if random.random() < 0.8:
+            frames.append(encode.Message('fader_move', random.randrange(64), random.randrange(1024)).encoded)
+        else:
+            label = bytes(random.choice(b'ABCDEFGH 0123456789') for _ in range(random.randrange(4, 24)))
+            payload = bytes((0x80, 11, 0, random.randrange(64))) + label
+            frames.append(bytes((utils.CSCP_HEADER_START, len(payload), 0xff)) + payload
+                          + bytes(((-sum(payload)) & 0xFF,)))
+        size += len(frames[-1])
+    stream = bytearray(b''.join(frames))
+    for _ in range(1000):
+        stream[random.randrange(len(stream))] = random.randrange(256)
+
+    offsets = candidate_offsets(stream)
+    print('{:.1f}MB stream, {} messages, {} possible messages'.format(len(stream) / 1024 / 1024, len(frames),
+                                                                       len(offsets)))
+
+    start = time.perf_counter()
+    per_message = [unpack._is_checksum_valid(stream, i, end - i - 4) for i, end in
+                   (offsets.tolist() if numpy is not None else offsets)]
+    per_message_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mask = validate_checksums(stream, offsets)
+    bulk_time = time.perf_counter() - start
+
+    print('per message loop (CSCP_utils.twoscomp): {:.3f}s'.format(per_message_time))
+    print('validate_checksums ({}): {:.3f}s'.format('NumPy' if numpy is not None else 'pure Python', bulk_time))
+    print('same results:', per_message == list(mask), ', valid:', sum(mask))
+
+    start = time.perf_counter()
+    messages = unpack_buffer(stream)
+    bulk_time = time.perf_counter() - start
+    logging.disable(logging.WARNING)  # Don't log each invalid checksum
+    unpacker = unpack.Unpacker()
+    start = time.perf_counter()
+    unpacked = [m for m in unpacker.feed(stream) if type(m) == bytes]
+    unpacker_time = time.perf_counter() - start
+    print('unpack_buffer: {:.3f}s, Unpacker: {:.3f}s, same messages: {} ({})'.format(
+        bulk_time, unpacker_time, messages == unpacked, len(messages)))
@@ -0,0 +1,268 @@
+# CSCP_capture
+# Used by the CSCP-MIDI application.
+# Records everything received from the mixer & the MIDI device to a capture file, and replays a capture
+# through the unpacker & the mapping's conversions, for reproducing problems seen on site and for load testing.
+# The connections hand each received chunk/message to a Recorder, which just queues it with the time -
+# a background thread does the writing, so recording doesn't slow handling messages.
+# A capture file is a header then a record per chunk/message, appended as they're received:
+#   time (seconds since the capture started, 8 byte float), source (1 byte), length (4 bytes), data
+# CSCP records are the raw bytes as received from the socket, MIDI records are each message's bytes.
+# Replay at the speed it was recorded, N times faster, or as fast as possible:
+#   python CSCP_capture.py <capture file> [mapping json] [speed, e.g. 50, or max]
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import collections
+import hashlib
+import logging
+import struct
+import threading
+import time
+
+import mido
+
+import CSCP_message
+import CSCP_subscription
+import CSCP_unpack as unpack
+
+MAGIC = b'CSCAP\x01'  # File type & format version
+RECORD = struct.Struct('<dBI')  # Time, source, data length
+
+# Record sources
+CSCP = 0  # Chunk of bytes received from the mixer
+MIDI = 1  # MIDI message received from the MIDI device
+CSCP_CONNECTED = 2  # The CSCP connection was made, no data. A part message before this won't be completed
+
+WRITE_INTERVAL = 0.1  # Seconds between the writer thread writing out what's been recorded
+
+log = logging.getLogger(__name__)
+
+
+class Recorder:
+    """
+    Appends received data to a capture file
+    record() can be called from any thread, it only queues the data
+    """
+    def __init__(self, path):
+        """
+        :param path: string, capture file, overwritten
+        """
+        self.path = path
+        self.start = time.monotonic()
+        self.records = collections.deque()  # (time, source, data) waiting to be written
+        self.record_count = 0
+        self.byte_count = 0
+        self.running = True
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.writer = threading.Thread(target=self._run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def record(self, source, data):
+        """
+        :param source: CSCP, MIDI or CSCP_CONNECTED
+        :param data: bytes received, or a mido message (its bytes are taken by the writer thread)
+        """
+        self.records.append((time.monotonic(), source, data))
+
+    def _write(self):
+        """ Write out everything recorded so far, called by the writer thread """
+        records = self.records
+        chunks = []
+        while records:
+            timestamp, source, data = records.popleft()
+            if not isinstance(data, (bytes, bytearray)):
+                data = bytes(data.bytes())
+            chunks.append(RECORD.pack(timestamp - self.start, source, len(data)))
+            chunks.append(data)
+            self.record_count += 1
+            self.byte_count += len(data)
+        if chunks:
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+
+    def _run(self):
+        while self.running:
+            time.sleep(WRITE_INTERVAL)
+            self._write()
+
+    def close(self):
+        """ Write out anything still waiting and close the file """
+        self.running = False
+        self.writer.join()
+        self._write()
+        self.file.close()
+        log.info("Captured %d records, %d bytes, to '%s'", self.record_count, self.byte_count, self.path)
+
+    def stats(self):
+        """ :return: dict of the recorder's counters """
+        return {'records': self.record_count,
+                'bytes': self.byte_count,
+                'waiting': len(self.records)}
+
+
+def write(path, records):
+    """
+    Write records to a capture file in one go, e.g. an edited or synthetic capture
+    :param path: string, capture file, overwritten
+    :param records: iterable of (time, source, data bytes or mido message)
+    """
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for timestamp, source, data in records:
+            if not isinstance(data, (bytes, bytearray)):
+                data = bytes(data.bytes())
+            f.write(RECORD.pack(timestamp, source, len(data)))
+            f.write(data)
+
+
+def read(path):
+    """
+    :param path: string, capture file
+    :return: generator of (time, source, data bytes) for each record
+    :raises ValueError: if the file isn't a capture
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("'{}' is not a capture file".format(path))
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        timestamp, source, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break  # Last record cut short, e.g. the app was killed while writing
+        yield timestamp, source, data[offset:offset + length]
+        offset += length
+
+
+class Replayer:
+    """
+    Feeds a capture through CSCP_unpack and a compiled mapping's conversions, to a stub output
+    that counts the converted messages and keeps a digest of them, so two replays can be compared
+    """
+    def __init__(self, mapping, subscription=True):
+        """
+        :param mapping: CSCP_MIDI_mapping.Mapping
+        :param subscription: bool, if True, drop the CSCP messages the mapping doesn't convert before
+                             decoding them, as CSCP-MIDI's connection does
+        """
+        self.mapping = mapping
+        self.subscription = CSCP_subscription.Subscription(mapping.subscription() if subscription else None)
+        self.unpacker = unpack.Unpacker()
+        self.digest = hashlib.sha1()
+        self.counts = {'CSCP chunks': 0, 'CSCP messages': 0, 'ACKs': 0, 'NAKs': 0, 'MIDI messages': 0,
+                       'sent to MIDI': 0, 'sent to mixer': 0}
+        self.late = 0  # Most seconds a record was handled after it was due
+        self.elapsed = 0
+
+    def _cscp(self, data):
+        self.counts['CSCP chunks'] += 1
+        for msg in self.unpacker.feed(data):
+            if type(msg) == int:
+                # Responses to what was sent, counted as the connection does - there's nothing to convert
+                self.counts['NAKs' if msg == unpack.NAK else 'ACKs'] += 1
+                continue
+            if not self.subscription.wants(msg):
+                continue
+            self.counts['CSCP messages'] += 1
+            midi = self.mapping.cscp_to_midi(CSCP_message.Message(msg))
+            if midi:
+                self.counts['sent to MIDI'] += 1
+                self.digest.update(bytes(midi.bytes()))
+
+    def _midi(self, data):
+        self.counts['MIDI messages'] += 1
+        msg = self.mapping.midi_to_cscp(mido.Message.from_bytes(data))
+        if msg:
+            self.counts['sent to mixer'] += 1
+            self.digest.update(msg.encoded)
+
+    def replay(self, records, speed=1.0):
+        """
+        :param records: iterable of (time, source, data), e.g. from read()
+        :param speed: float, times faster than recorded, None to go as fast as possible
+        :return: dict, counts of what was replayed & converted, with the digest of the converted messages
+        """
+        start = time.perf_counter()
+        for timestamp, source, data in records:
+            if speed:
+                wait = start + timestamp / speed - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    self.late = max(self.late, -wait)
+            if source == CSCP:
+                self._cscp(data)
+            elif source == MIDI:
+                self._midi(data)
+            elif source == CSCP_CONNECTED:
+                self.unpacker.reset()
+        self.elapsed = time.perf_counter() - start
+        return self.stats()
+
+    def stats(self):
+        """ :return: dict, counts of what was replayed & converted, with the digest of the converted messages """
+        r = dict(self.counts)
+        r['seconds'] = self.elapsed
+        r['most late'] = self.late
+        r['digest'] = self.digest.hexdigest()
+        return r
+
+
+if __name__ == '__main__':
+    import os
+    import random
+    import sys
+    import tempfile
+
+    import CSCP_encode as encode
+    import CSCP_MIDI_mapping
+
+    mapping = CSCP_MIDI_mapping.load(sys.argv[2] if len(sys.argv) > 2 else "korg_sonar_reaper.json")
+
+    if len(sys.argv) > 1:
+        speed = None if len(sys.argv) > 3 and sys.argv[3] == 'max' else float(sys.argv[3]) if len(sys.argv) > 3 else 1
+        for name, value in Replayer(mapping).replay(read(sys.argv[1]), speed).items():
+            print('{:<15}{}'.format(name, value))
+        sys.exit()
+
+    # No capture given - make a synthetic 10s rehearsal, fader moves & labels from the mixer
+    # and fader moves from the controller, then replay it at 50x and as fast as possible
+    random.seed(1)
+    directory = tempfile.mkdtemp()
+    records = [(0, CSCP_CONNECTED, b'')]
+    t = 0
+    while t < 10:
+        t += random.expovariate(2000)
+        if random.random() < 0.7:
+            frames = b''.join(encode.Message('fader_move', random.randrange(16), random.randrange(1025),
+                                             recipient='controller').encoded for _ in range(random.randrange(1, 8)))
+            frames += encode.Message('read_fader_label', random.randrange(96), 'Ch', recipient='controller').encoded
+            records.append((t, CSCP, frames))
+        else:
+            records.append((t, MIDI, mido.Message('pitchwheel', channel=random.randrange(8),
+                                                  pitch=random.randrange(-8192, 8192))))
+    path = os.path.join(directory, 'rehearsal.cscap')
+    write(path, records)
+
+    # What recording costs the connections
+    recorder = Recorder(os.path.join(directory, 'recorded.cscap'))
+    record_start = time.perf_counter()
+    for t, source, data in records:
+        recorder.record(source, data)
+    record_time = time.perf_counter() - record_start
+    recorder.close()
+    print('record() us: {:.3f}, capture: {} records, {:.1f}KB, same as recorded: {}'.format(
+        record_time / len(records) * 1e6, len(records), os.path.getsize(path) / 1024,
+        [r[1:] for r in read(path)] == [r[1:] for r in read(recorder.path)]))
+
+    for speed in (50, None):
+        result = Replayer(mapping).replay(read(path), speed)
+        print('\nspeed {}:'.format(speed or 'max'))
+        for name, value in result.items():
+            print('    {:<15}{}'.format(name, value))
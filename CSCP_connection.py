@@ -10,16 +10,31 @@
 # See Project_Notes.txt for info on the implementation - how the app works.
 
 
+import logging
 import socket
 import threading
 import time
 
+import CSCP_capture
+import CSCP_MIDI_buffer as buffer
+import CSCP_MIDI_latency
+import CSCP_pacing as pacing
 import CSCP_unpack as unpack
-import CSCP_decode as parse
+import CSCP_message
+import CSCP_subscription
 import CSCP_encode as encode
 
 TIMEOUT = 3  # how long to wait when starting connection and receiving data.
 RECEIVE_TIMEOUT = 10
+BUFFER_SIZE = 4096  # Max received messages held waiting to be handled
+OVERFLOW = buffer.DROP_OLDEST  # What to do when that's exceeded, see CSCP_MIDI_buffer
+
+# Output pacing, see CSCP_pacing. Tune these using the NAK count if the mixer is refusing messages
+SEND_RATE = 500  # Max messages per second sent to the mixer on average, None for no limit
+SEND_BURST = 50  # Max messages sent back to back before SEND_RATE applies
+FADER_INTERVAL = 0.01  # Min seconds between moves of the same fader, 0 for no limit
+
+log = logging.getLogger(__name__)
 
 
 class Connection:
@@ -31,19 +46,50 @@ class Connection:
     When connected, validates received messages and stores them as CSCP Message objects
     Provides methods to get received messages and to send CSCP Message objects
     """
-    def __init__(self, ip_address, tcp_port):
-
+    def __init__(self, ip_address, tcp_port, notify=None, buffer_size=BUFFER_SIZE, overflow=OVERFLOW,
+                 send_rate=SEND_RATE, send_burst=SEND_BURST, fader_interval=FADER_INTERVAL, latency=None,
+                 subscription=None, capture=None):
+        """
+        :param ip_address: string, mixer's IP address
+        :param tcp_port: int, mixer's CSCP port
+        :param notify: optional callable, called (from the receiver thread) whenever messages are received,
+                       e.g. threading.Event.set to wake up whatever is waiting on them
+        :param buffer_size: int, maximum number of received messages held
+        :param overflow: policy when the buffer is full, one of CSCP_MIDI_buffer.OVERFLOW_POLICIES
+        :param send_rate: float, max messages per second sent to the mixer, None for no limit
+        :param send_burst: int, max messages sent back to back before send_rate applies
+        :param fader_interval: float, min seconds between moves of the same fader, 0 for no limit
+        :param latency: optional CSCP_MIDI_latency.LatencyRecorder, to record unpack & decode times.
+                        Received messages are then timestamped (.received & .decoded) for the bridge to time
+        :param subscription: optional dict, operation name: strips (or None for all), the only messages to pass on,
+                             see CSCP_subscription. Others are dropped as they're unpacked. None to pass everything
+        :param capture: optional CSCP_capture.Recorder, everything received is recorded to it
+        """
         self.address = ip_address
         self.port = tcp_port
+        self.notify = notify
+        self.latency = latency
+        self.capture = capture
         self.sock = False
         self.status = 'Starting'
-        self.messages = []
+        self.status_transitions = {}  # (from, to): count of status changes
+        self.reconnect_count = 0
+        self.unpack_stats = {'invalid checksum': 0}
+        self.messages = buffer.MessageBuffer(buffer_size, overflow)
+        self.subscription = CSCP_subscription.Subscription(subscription)
+
+        # Count of ACK & NAK responses received from the mixer
+        self.ack_count = 0
+        self.nak_count = 0
+
+        # Everything sent goes through the scheduler, which paces messages so as not to flood the mixer
+        self.scheduler = pacing.OutputScheduler(self._send, send_rate, send_burst, fader_interval)
 
         # Potentially, there may be residual data at the end of chunk of received data
         # that cannot be parsed but might be the beginning of a message
         # whose remainder is in the next chunk data to be received
-        # So will save any such residual data and prepend to the next chunk received
-        self.residual_data = False
+        # The unpacker holds on to any such residual data and completes the message with the next chunk received
+        self.unpacker = unpack.Unpacker(self.unpack_stats)
 
         # Set up to run in thread
         self.receiver = threading.Thread(target=self._run)
@@ -63,12 +109,15 @@ class Connection:
             #print('CSCP_connection: Socket connection established with address {} on port {}'.format(self.address, self.port))
 
             # Send a message to get some data back
+            self.unpacker.reset()  # Any part message from a previous connection won't be completed
+            if self.capture:
+                self.capture.record(CSCP_capture.CSCP_CONNECTED, b'')
             ping = encode.read_back('read_console_info')
             self.send(ping)
-            self.status = "Connected"
+            self._set_status("Connected")
 
         except socket.timeout:
-            print('CSCP_connection: Failed to create connection with IP address {} on port {}'.format(self.address, self.port))
+            log.warning('Failed to create connection with IP address %s on port %s', self.address, self.port)
             self.close()
             self.sock = False
 
@@ -80,7 +129,7 @@ class Connection:
         # if not connected, try to create a socket connection every 5s.
         while not self.sock:
             if not self.status == 'Connection Lost!':
-                self.status = 'Not Connected'
+                self._set_status('Not Connected')
             self._connect()
             time.sleep(5)  # Wait before trying to connect again
 
@@ -99,17 +148,44 @@ class Connection:
             # print('CSCP_connection run: data received', data, 'pinged', self.pinged)
 
             if data:
+                received = time.perf_counter()
                 self.pinged = False
-                # Unpack messages from received bytes, checking residual data from previous call
-                # to check if a message spanned 2 received chunks
-                messages, self.residual_data = unpack.unpack_data(data, self.residual_data)
+                if self.capture:
+                    self.capture.record(CSCP_capture.CSCP, data)
+                # Unpack messages from received bytes, the unpacker completes any message
+                # that spanned 2 received chunks
+                messages = self.unpacker.feed(data)
                 if messages:
+                    if self.latency:
+                        unpacked = time.perf_counter()
+                        self.latency.record(CSCP_MIDI_latency.CSCP_TO_MIDI, 'unpack', '', unpacked - received)
+
                     for msg in messages:
-                        self.messages.append(parse.Message(msg))
+                        if type(msg) == int:
+                            if msg == 5:
+                                self.nak_count += 1
+                            else:
+                                self.ack_count += 1
+                        elif not self.subscription.wants(msg):
+                            continue  # Not subscribed to, dropped before building a message
+
+                        if self.latency:
+                            start = time.perf_counter()
+                            message = CSCP_message.Message(msg)
+                            message.received = received
+                            message.decoded = time.perf_counter()
+                            self.latency.record(CSCP_MIDI_latency.CSCP_TO_MIDI, 'decode',
+                                                message.operation or message.type, message.decoded - start)
+                        else:
+                            message = CSCP_message.Message(msg)
+                        self.messages.put(message)
+                    if self.notify:
+                        self.notify()
 
             elif self.pinged:
                 # No data received even after mixer being pinged
-                self.status = "Connection Lost!"
+                self._set_status("Connection Lost!")
+                self.reconnect_count += 1
                 #print("DEBUG CSCP_connect, dropping connection!")
                 self.close()
                 self._connect()
@@ -123,6 +199,13 @@ class Connection:
                 ping = encode.read_back('read_console_name')
                 self.send(ping)
 
+    def _set_status(self, status):
+        """ Update self.status, counting the change """
+        if status != self.status:
+            transition = (self.status, status)
+            self.status_transitions[transition] = self.status_transitions.get(transition, 0) + 1
+            self.status = status
+
     def close(self):
         self.sock.close()
         try:
@@ -133,18 +216,25 @@ class Connection:
         except:
             pass
 
+    def _send(self, msg):
+        """ Called by self.scheduler when it's OK to send msg """
+        try:
+            self.sock.sendall(msg)
+        except (socket.timeout, OSError, AttributeError):
+            # Timed out, or the connection has been lost/closed, _run will handle reconnecting
+            pass
+
     # PUBLIC METHODS
     def send(self, msg):
         """
         Public method to send a message to the mixer
-        :param msg: CSCP_encode.Message object
+        Messages are sent in order, but may be held back briefly if sending too fast
+        :param msg: bytes, e.g. CSCP_encode.Message.encoded
+        :return: True if msg replaced a fader move still waiting to be sent, see CSCP_pacing.OutputScheduler.send
         """
-        try:
-            # TODO - take message object so dont have to pass msg.encoded in main
-            # Will need to fix the ping read console info message from encode.
-            self.sock.sendall(msg)
-        except socket.timeout:
-            pass
+        # TODO - take message object so dont have to pass msg.encoded in main
+        # Will need to fix the ping read console info message from encode.
+        return self.scheduler.send(msg)
 
     def get_message(self):
         """
@@ -152,11 +242,33 @@ class Connection:
         - removes and returns the oldest message in the buffer
         :return: CSCP Message object
         """
-        r = False
-        if self.messages:
-            r = self.messages[0]
-            self.messages = self.messages[1:]
-        return r
+        return self.messages.get()
+
+    def get_messages(self, max_n):
+        """
+        public / called externally
+        - removes and returns up to max_n of the oldest messages in the buffer
+        :param max_n: int
+        :return: list of CSCP Message objects, oldest first (empty if none received)
+        """
+        return self.messages.get_many(max_n)
+
+    def stats(self):
+        """
+        :return: dict of connection counters, for tuning buffer size & send pacing
+        """
+        return {'status': self.status,
+                'status transitions': dict(self.status_transitions),
+                'reconnects': self.reconnect_count,
+                'ACKs': self.ack_count,
+                'NAKs': self.nak_count,
+                'invalid checksums': self.unpack_stats['invalid checksum'],
+                'false headers': self.unpack_stats['false header'],
+                'garbage bytes': self.unpack_stats['garbage bytes'],
+                'residual bytes': self.unpacker.residual_size(),
+                'filtered': self.subscription.stats(),
+                'receive buffer': self.messages.stats(),
+                'send scheduler': self.scheduler.stats()}
 
     # TODO - CHECK I NO LONGER NEED THIS
     """ 
@@ -178,13 +290,13 @@ if __name__ == '__main__':
     connection = Connection(address, port)
 
     test_message = b'\xf1\x06\x00\x80\x00\x00\x03\x02\xe8\x93'
-    #decoded = parse.Message(test_message)
+    #decoded = CSCP_message.Message(test_message)
     #print("DEBUG test message", decoded)
 
     i = 0
     strip = 0
     while True:
-        print('\n', i, 'qty:', len(connection.messages), 'residual data', connection.residual_data)
+        print('\n', i, 'qty:', len(connection.messages), 'residual data', connection.unpacker.residual())
         for message in connection.messages:
             print("Controller received:", message)
         if connection.status == "Connected" and i % 1 == 0:
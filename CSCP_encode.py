@@ -2,6 +2,7 @@
 # Provides a CSCP Message class
 # Instantiates using human readable values
 # Creates attribute Message.encoded - a CSCP encoded byte string with checksum, ready to send to a mixer
+# Provides FrameCache, holding ready made Messages for the controls sent most often
 
 # Copyright Peter Walker 2020.
 # Feedback/Requests - peter.allan.walker@gmail.com
@@ -9,76 +10,31 @@
 # See Readme.txt for info on how to use this app.
 # See Project_Notes.txt for info on the implementation - how the app works.
 
-import struct  # used to convert decimal values > 255 into 2 hex bytes
-import CSCP_utils as utils
+import collections
 
-# TODO - CSCP_decode provides a Message class possibly identical to this one, it's just initialised differently,
-#  so should combine them into a single class
+import CSCP_message
+import CSCP_schema as schema
 
+# FrameCache
+TOGGLE_OPERATIONS = ('cut_toggle', 'pfl_toggle')  # 2 values per strip, made up front
+FADER_OPERATIONS = ('fader_move', 'main_fader_move')  # 1025 levels per strip, kept once used
+TOGGLE_STRIPS = 128  # Strips toggles are made for up front
+CACHE_SIZE = 16384  # Max fader messages kept, each ~250 bytes, so ~4MB
 
-class Message:
+
+class Message(CSCP_message.Message):
+    """
+    The same CSCP_message.Message as received messages, instantiated from human readable values
+    """
+    __slots__ = ()
 
     def __init__(self, operation, strip=None, value=None, msg_type='write', recipient='mixer'):
-        self.recipient = recipient
+        # Layout of each operation's message is in CSCP_utils.SCHEMA
+        self.encoded = schema.encode(operation, schema.message_fields(strip, value), msg_type, recipient)
         self.type = msg_type
         self.operation = operation
-        self.strip = strip
-        self.value = value
-        self.encoded = self._encode()
-        self.byte_count = utils.OP_BYTE_COUNTS[self.operation]
-
-    def __str__(self):
-        return "CSCP Message - Recipient: {}, Type: {}, Operation: {}, Fader Strip: {}, Value: {}, encoded: {}".format(self.recipient, self.type, self.operation, self.strip, self.value, repr(self.encoded))
-
-    def _encode(self):
-        """ Takes CSCP data in Message object format
-            Returns complete byte string ready to send to mixer
-            # NOTE, this version only handles strip fader, pfl/solo & cut/mute messages
-        """
-        # Look up CSCP header value constants from CSCP_utils.py
-        soh = utils.CSCP_HEADER_START  # CSCP Start Of Header byte value
-        bc = utils.OP_BYTE_COUNTS[self.operation]  # Byte count of message based on message type/operation
-        # Device type / message recipient (Mixer vs controller)
-        dev = list(utils.DEVICES.keys())[
-            list(utils.DEVICES.values()).index(self.recipient)]  # Dictionary lookup key by value
-
-        # Command bytes (denotes message type, e.g. "fader_move")
-        # Following uses a neat way to get dictionary lookup key by value,
-        # got it from Stack-Exchange or similar, lost the link :(
-        # ...think this is what's meant by 'list comprehension'... TODO - learn list comprehension!
-        cmdmsb = list(utils.TYPE.keys())[list(utils.TYPE.values()).index(self.type)]
-        cmdlsb = list(utils.OPERATIONS.keys())[
-            list(utils.OPERATIONS.values()).index(self.operation)]
-
-        header = [soh, bc, dev]
-        payload = [cmdmsb, cmdlsb]
-
-        # Convert single decimal value to two bytes (still decimal)
-        # Note, the order of assignment being returned from struct.pack is lsb, msb!
-        fdrlsb, fdrmsb = struct.pack('<H', self.strip)
-        payload += [fdrmsb, fdrlsb]
-
-        # Cannot just check true/false as 0 is valid value that returns False
-        if self.value or self.value == 0:
-            values = []
-            if bc == 5:
-                values.append(self.value)
-
-            elif bc == 6:
-                # Convert value to two bytes (still decimal)
-                vallsb, valmsb = struct.pack('<H', self.value)
-                values = [valmsb, vallsb]
-
-            if values:
-                for value in values:
-                    payload.append(value)
-
-        checksum = int(utils.calc_checksum(payload), 16)
-        message = header + payload
-        message.append(checksum)
-        message = bytes(message)
-
-        return message
+        self._strip = strip
+        self._value = value
 
 
 def read_back(lookup='read_console_name'):
@@ -93,31 +49,66 @@ def read_back(lookup='read_console_name'):
         # TODO -   (will require adaptation of the above Message Class)
         # TODO -   or perhaps provide an additional CSCP_connection.send()
     """
-    # "DEV" byte. Sourced from dictionary lookup key by value
-    recipient_device = list(utils.DEVICES.keys())[
-        list(utils.DEVICES.values()).index('mixer')]
-    # "CMD MSB" byte. Sourced from dictionary lookup key by value
-    message_type = list(utils.TYPE.keys())[list(utils.TYPE.values()).index('read')]
-    # "CMD LSB" byte. Sourced from Dictionary lookup key by value
-    operation = list(utils.OPERATIONS.keys())[
-        list(utils.OPERATIONS.values()).index(lookup)]
-    # CMD MSB & CMD LSB. No data required for this message type
-    payload = [message_type, operation]
+    return schema.encode(lookup, {}, 'read', 'mixer')
 
-    checksum = int(utils.calc_checksum(payload), 16)
-    byte_count = calc_byte_count(payload)
-    header = [utils.CSCP_HEADER_START, byte_count, recipient_device]
 
-    message = header + payload
-    message.append(checksum)
-    message = bytes(message)
-
-    return bytes(message)
-
-
-def calc_byte_count(payload):
-    # Surprisingly simple
-    return len(payload)
+class FrameCache:
+    """
+    Ready made Messages to send to the mixer, so converting a MIDI message is a dict lookup, not an encode.
+    Toggles are made for TOGGLE_STRIPS strips up front. Fader moves are kept as they're made,
+    dropping the least recently used when there are more than max_size
+    Messages are shared, so mustn't be changed. Not thread safe, used by the bridge's thread
+    """
+    def __init__(self, max_size=CACHE_SIZE, toggle_strips=TOGGLE_STRIPS, recipient='mixer'):
+        """
+        :param max_size: int, max fader messages kept
+        :param toggle_strips: int, make toggle messages for strips 0 up to this
+        :param recipient: string, 'mixer' or 'controller'
+        """
+        self.max_size = max_size
+        self.recipient = recipient
+        self.toggles = {(operation, strip, value): Message(operation, strip, value, recipient=recipient)
+                        for operation in TOGGLE_OPERATIONS for strip in range(toggle_strips) for value in (0, 1)}
+        self.faders = collections.OrderedDict()  # (operation, strip, value): Message, least recently used first
+        self.hit_count = 0
+        self.miss_count = 0
+        self.evicted_count = 0
+
+    def message(self, operation, strip, value):
+        """
+        :return: CSCP_encode.Message, a write of value to strip
+        """
+        key = (operation, strip, value)
+        msg = self.toggles.get(key)
+        if msg is not None:
+            self.hit_count += 1
+            return msg
+
+        faders = self.faders
+        msg = faders.get(key)
+        if msg is not None:
+            self.hit_count += 1
+            faders.move_to_end(key)
+            return msg
+
+        self.miss_count += 1
+        msg = Message(operation, strip, value, recipient=self.recipient)
+        if operation in FADER_OPERATIONS and self.max_size:
+            faders[key] = msg
+            if len(faders) > self.max_size:
+                faders.popitem(last=False)
+                self.evicted_count += 1
+        return msg
+
+    def stats(self):
+        """
+        :return: dict of the cache's counters
+        """
+        return {'toggles': len(self.toggles),
+                'faders': len(self.faders),
+                'hits': self.hit_count,
+                'misses': self.miss_count,
+                'evicted': self.evicted_count}
 
 
 if __name__ == '__main__':
@@ -127,3 +118,32 @@ if __name__ == '__main__':
     print("Test input:", test)
     test_message = Message(test[0], test[1], test[2])
     print("CSCP Message Object:\n", test_message)
+
+    # Encodes per second, Message vs FrameCache
+    # Faders being moved sweep through neighbouring levels, random levels on every fader is the worst case
+    import random
+    import time
+
+    def sweeps(strips, qty=200000):
+        levels = [random.randrange(1025) for _ in range(strips)]
+        r = []
+        for _ in range(qty):
+            strip = random.randrange(strips)
+            levels[strip] = min(1024, max(0, levels[strip] + random.randrange(-8, 9)))
+            r.append(('fader_move', strip, levels[strip]))
+        return r
+
+    tests = (('sweeps, 8 faders', sweeps(8)), ('sweeps, 96 faders', sweeps(96)),
+             ('random, 96 faders', [('fader_move', random.randrange(96), random.randrange(1025))
+                                    for _ in range(200000)]))
+    print('\n{:<20}{:>14}{:>14}{:>10}'.format('', 'Message/s', 'FrameCache/s', 'hit %'))
+    for name, moves in tests:
+        cache = FrameCache()
+        rates = []
+        for encode in (Message, cache.message):
+            start = time.perf_counter()
+            for operation, strip, value in moves:
+                encode(operation, strip, value)
+            rates.append(len(moves) / (time.perf_counter() - start))
+        print('{:<20}{:>14.0f}{:>14.0f}{:>10.1f}'.format(name, rates[0], rates[1],
+                                                          100 * cache.hit_count / len(moves)))
@@ -0,0 +1,112 @@
+# CSCP_message
+# Provides the CSCP Message class, used for both received messages (CSCP_decode) and messages to send (CSCP_encode)
+# Wraps the message bytes, working out the operation & type straight away but only decoding the strip & value
+# the first time they're used - most messages received (labels, path info...) are dropped by the bridge as
+# unmapped, so are never fully decoded. Uses __slots__ to keep each message small.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import CSCP_utils as utils
+import CSCP_schema as schema
+
+_NOT_DECODED = object()  # Strip & value until they're looked up
+
+ACK = 4
+NAK = 5
+
+
+class Message:
+    """
+    A CSCP message, or an ACK/NAK
+    CSCP connections timestamp the messages they receive with .received & .decoded, when timing latency
+    """
+    __slots__ = ('encoded', 'type', 'operation', '_strip', '_value', 'received', 'decoded')
+
+    def __init__(self, message_bytes):
+        """
+        :param message_bytes: bytes, a complete valid CSCP message as unpacked by CSCP_unpack,
+                              or an int for an ACK/NAK
+        """
+        if type(message_bytes) == int:
+            self.encoded = False
+            self.operation = False
+            self.type = 'ACK' if message_bytes == ACK else 'NAK'
+            self._strip = False
+            self._value = False
+        else:
+            self.encoded = message_bytes
+            self.type = 'write' if message_bytes[utils.CMDMSB] & schema.WRITE_BIT else 'read'
+            self.operation = utils.OPERATIONS.get(message_bytes[utils.CMDLSB], 'unknown')
+            self._strip = _NOT_DECODED
+
+    def _decode(self):
+        self._strip, self._value = schema.strip_and_value(schema.decode_fields(self.encoded))
+
+    @property
+    def strip(self):
+        if self._strip is _NOT_DECODED:
+            self._decode()
+        return self._strip
+
+    @property
+    def value(self):
+        if self._strip is _NOT_DECODED:
+            self._decode()
+        return self._value
+
+    @property
+    def recipient(self):
+        if not self.encoded:
+            return False
+        return utils.DEVICES.get(self.encoded[utils.DEVICE_BYTE], 'unknown')
+
+    @property
+    def byte_count(self):
+        if not self.encoded:
+            return False
+        return self.encoded[utils.BYTE_COUNT_BYTE]
+
+    def __str__(self):
+        return "CSCP Message - Recipient: {}, Type: {}, Operation: {}, Fader Strip: {}, Value: {}, encoded: {}".format(self.recipient, self.type, self.operation, self.strip, self.value, repr(self.encoded))
+
+
+if __name__ == '__main__':
+    import timeit
+    import tracemalloc
+
+    label = b'\xf1\r\xff\x80\x0b\x00\x00Mic -R tn\xbb'
+    fader_move = b'\xf1\x06\x00\x80\x00\x00\x03\x02\xe8\x93'
+
+    print(Message(label))
+    print(Message(fader_move))
+    print(Message(ACK))
+
+    class EagerMessage:
+        """ Received messages before Message - decoded in full, with a __dict__ """
+        def __init__(self, message_bytes):
+            self.encoded = message_bytes
+            self.byte_count = message_bytes[utils.BYTE_COUNT_BYTE]
+            self.recipient, self.type, self.operation, fields = schema.decode(message_bytes)
+            self.strip, self.value = schema.strip_and_value(fields)
+
+    def dropped(cls):
+        return cls(label).operation
+
+    def converted(cls):
+        msg = cls(fader_move)
+        return msg.operation, msg.strip, msg.value
+
+    print('\nus per message:           {:>9}{:>9}'.format('eager', 'Message'))
+    for name, test in (('unmapped label, dropped', dropped), ('fader move, converted', converted)):
+        times = [timeit.timeit(lambda: test(cls), number=100000) * 10 for cls in (EagerMessage, Message)]
+        print('{:<26}{:>9.2f}{:>9.2f}'.format(name, *times))
+
+    for cls in (EagerMessage, Message):
+        tracemalloc.start()
+        held = [cls(label) for _ in range(10000)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('{} bytes per held label message: {:.0f}'.format(cls.__name__, size / len(held)))
@@ -0,0 +1,230 @@
+# CSCP_pacing
+# Used by CSCP_connection & CSCP_async_connection.
+# Limits how fast frames are sent to the mixer so a fast controller or a bulk operation can't flood
+# the console's CSCP port. Provides a TokenBucket rate limiter and an OutputScheduler that sends frames
+# in order, holding back any that would exceed the rate, or that would move a fader more often than
+# a minimum interval. While a fader move is held back, a newer move for the same fader replaces it.
+# AsyncOutputScheduler does the same on an asyncio event loop, with a timer in place of the sender thread.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import asyncio
+import collections
+import threading
+import time
+
+import CSCP_utils as utils
+
+# CMD LSB values of operations limited to one move per fader per interval
+# (write fader_move & main_fader_move)
+PACED_OPERATIONS = (0, 2)
+
+
+def fader_key(frame):
+    """
+    :param frame: bytes, encoded CSCP message
+    :return: (operation byte, strip) for fader move frames, else None
+    """
+    if (len(frame) > utils.FDRMSB + 1 and frame[utils.CMDLSB] in PACED_OPERATIONS
+            and frame[utils.CMDMSB] == 0x80):
+        return frame[utils.CMDLSB], (frame[utils.FDRMSB] << 8) | frame[utils.FDRMSB + 1]
+    return None
+
+
+class TokenBucket:
+    """
+    Allows an average of rate events per second, with bursts of up to burst events
+    Not thread safe, OutputScheduler only uses it while holding its lock
+    """
+    def __init__(self, rate, burst):
+        """
+        :param rate: float, tokens added per second
+        :param burst: int, maximum tokens held
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self, now):
+        """
+        :param now: float, time.monotonic()
+        :return: float, seconds until a token is available, 0 if one is available now
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutputScheduler:
+    """
+    Sends frames in the order they are given, pacing them with a TokenBucket and a per-fader minimum interval.
+    Frames that can go straight away are sent by the caller's thread, others are queued for the scheduler's
+    own thread to send when allowed
+    """
+    def __init__(self, send, rate=None, burst=1, fader_interval=0):
+        """
+        :param send: function taking frame bytes, does the actual sending
+        :param rate: float, max frames per second on average, None for no limit
+        :param burst: int, max frames sent back to back before the rate applies
+        :param fader_interval: float, min seconds between moves of the same fader, 0 for no limit
+        """
+        self._send = send
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.fader_interval = fader_interval
+
+        self.queue = collections.deque()  # [key, frame] entries, oldest first
+        self.queued_faders = {}  # key: entry in self.queue, for faders with a move waiting to be sent
+        self.last_fader_move = {}  # key: time of the last move sent for that fader
+        self.lock = threading.Condition()
+
+        self.sent_count = 0
+        self.delayed_count = 0  # Frames that had to be queued
+        self.replaced_count = 0  # Queued fader moves replaced by a newer move before they were sent
+
+        self._start()
+
+    def _start(self):
+        """ Start the thread sending queued frames """
+        self.sender = threading.Thread(target=self._run)
+        self.sender.daemon = True
+        self.sender.start()
+
+    def _wait_time(self, key, now):
+        """ :return: float, seconds until a frame with the given fader_key can be sent """
+        wait = self.bucket.wait_time(now) if self.bucket else 0
+        if key and self.fader_interval:
+            last = self.last_fader_move.get(key)
+            if last is not None:
+                wait = max(wait, last + self.fader_interval - now)
+        return wait
+
+    def _transmit(self, key, frame, now):
+        """ Called while holding self.lock, so frames can't be sent out of order """
+        if self.bucket:
+            self.bucket.take()
+        if key:
+            self.last_fader_move[key] = now
+        self.sent_count += 1
+        self._send(frame)
+
+    def _run(self):
+        """ Called by init's self.sender thread. Sends queued frames as they become allowed """
+        with self.lock:
+            while True:
+                if not self.queue:
+                    self.lock.wait()
+                    continue
+
+                key, frame = self.queue[0]
+                now = time.monotonic()
+                wait = self._wait_time(key, now)
+                if wait > 0:
+                    self.lock.wait(wait)
+                    continue
+
+                self.queue.popleft()
+                if key:
+                    del self.queued_faders[key]
+                self._transmit(key, frame, now)
+
+    def send(self, frame):
+        """
+        Send a frame now if allowed, else queue it
+        :param frame: bytes, encoded CSCP message
+        :return: True if frame replaced a queued fader move, so the mixer will only get (and answer) one of them
+        """
+        key = fader_key(frame) if self.fader_interval else None
+
+        with self.lock:
+            if key in self.queued_faders:
+                # Last value wins, replace the waiting move but keep its place in the queue
+                self.queued_faders[key][1] = frame
+                self.replaced_count += 1
+                return True
+
+            now = time.monotonic()
+            if not self.queue and self._wait_time(key, now) <= 0:
+                self._transmit(key, frame, now)
+                return
+
+            entry = [key, frame]
+            self.queue.append(entry)
+            if key:
+                self.queued_faders[key] = entry
+            self.delayed_count += 1
+            self.lock.notify()
+        return False
+
+    def stats(self):
+        """
+        :return: dict of the scheduler's counters
+        """
+        return {'queued': len(self.queue),
+                'sent': self.sent_count,
+                'delayed': self.delayed_count,
+                'replaced': self.replaced_count}
+
+
+class AsyncOutputScheduler(OutputScheduler):
+    """
+    OutputScheduler for an asyncio event loop - must be created, and sent to, from within the running loop.
+    Queued frames are sent by a timer on the loop rather than by a thread, so there's no locking
+    """
+    def _start(self):
+        self.loop = asyncio.get_running_loop()
+        self.timer = None  # asyncio.TimerHandle for sending the frame at the front of the queue
+
+    def _run(self):
+        """ Called by self.timer. Sends queued frames that are allowed, then waits for the next one """
+        self.timer = None
+        while self.queue:
+            key, frame = self.queue[0]
+            now = time.monotonic()
+            wait = self._wait_time(key, now)
+            if wait > 0:
+                self.timer = self.loop.call_later(wait, self._run)
+                return
+
+            self.queue.popleft()
+            if key:
+                del self.queued_faders[key]
+            self._transmit(key, frame, now)
+
+    def send(self, frame):
+        """
+        Send a frame now if allowed, else queue it
+        :param frame: bytes, encoded CSCP message
+        :return: True if frame replaced a queued fader move, so the mixer will only get (and answer) one of them
+        """
+        key = fader_key(frame) if self.fader_interval else None
+        if key in self.queued_faders:
+            # Last value wins, replace the waiting move but keep its place in the queue
+            self.queued_faders[key][1] = frame
+            self.replaced_count += 1
+            return True
+
+        now = time.monotonic()
+        if not self.queue and self._wait_time(key, now) <= 0:
+            self._transmit(key, frame, now)
+            return False
+
+        entry = [key, frame]
+        self.queue.append(entry)
+        if key:
+            self.queued_faders[key] = entry
+        self.delayed_count += 1
+        if self.timer is None:
+            self.timer = self.loop.call_later(self._wait_time(key, now), self._run)
+        return False
@@ -0,0 +1,305 @@
+# CSCP_requests
+# Used by the CSCP-MIDI application.
+# Provides RequestTracker, keeping track of the messages sent to the mixer that are waiting for a response,
+# so the sender can find out how each went - rather than sending and hoping.
+# The mixer answers each write with an ACK or NAK, in the order the writes were sent, so these are matched
+# to writes first in first out. Reads are answered with a write of the same operation & strip.
+# At most a window of requests are sent and waiting at once, others wait their turn in the tracker,
+# so a burst of requests goes out as fast as the mixer answers them without flooding it.
+# The connection's pacing (CSCP_pacing) may replace a fader move it's holding back with a newer one,
+# the connection's send() saying so - the newer write then waits on the older one's ACK rather than its own.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+import CSCP_pacing as pacing
+import CSCP_schema as schema
+import CSCP_utils as utils
+
+WINDOW = 32  # Max requests sent & waiting for a response
+TIMEOUT = 1  # Seconds to wait for a response
+CHECK_INTERVAL = 0.1  # Seconds between checking for requests that have timed out
+
+
+class RequestTimeout(TimeoutError):
+    """ No response from the mixer in time """
+
+
+class _Request:
+    __slots__ = ('frame', 'key', 'timeout', 'deadline', 'callback')
+
+    def __init__(self, frame, key, timeout, callback):
+        self.frame = frame
+        self.key = key  # None for writes, (operation, strip) for reads
+        self.timeout = timeout
+        self.deadline = None  # time.monotonic() to give up, once sent
+        self.callback = callback
+
+
+def response_key(frame):
+    """
+    :param frame: bytes, encoded CSCP message
+    :return: (CMD LSB, strip) the response to a read would have, None for a write
+    """
+    if frame[utils.CMDMSB] & schema.WRITE_BIT:
+        return None
+    strip = frame[utils.FDRMSB] << 8 | frame[utils.FDRMSB + 1] if len(frame) > utils.FDRMSB + 2 else None
+    return frame[utils.CMDLSB], strip
+
+
+class RequestTracker:
+    """
+    Sends messages to the mixer through a window of requests waiting for a response, matching responses to them
+    send() is for the bridge's thread, request() can be used from any thread.
+    Give the tracker to the bridge, which passes it the messages it receives and calls check() on a timer.
+    Callbacks are called from the bridge's thread, so should be quick.
+    If a write's ACK is lost it times out, and a late ACK would be matched to the next write,
+    so everything written to the mixer needs to go through the tracker for ACKs to line up
+    """
+    def __init__(self, cscp, window=WINDOW, timeout=TIMEOUT):
+        """
+        :param cscp: CSCP_connection.Connection object, or the async version
+        :param window: int, max requests sent and waiting for a response
+        :param timeout: float, default seconds to wait for a response
+        """
+        self.cscp = cscp
+        self.window = window
+        self.timeout = timeout
+        self.interval = CHECK_INTERVAL
+        self.lock = threading.Lock()
+        self.waiting = collections.deque()  # _Requests not sent yet, the window being full
+        self.waiting_faders = {}  # pacing.fader_key: _Request in self.waiting, for fader moves without a callback
+        self.writes = collections.deque()  # _Requests sent, waiting for an ACK/NAK, oldest first
+        self.reads = {}  # response_key: deque of _Requests sent, waiting for the response
+        self.in_flight = 0
+        self.ack_count = 0
+        self.nak_count = 0
+        self.response_count = 0
+        self.timed_out_count = 0
+        self.replaced_count = 0
+        self.merged_count = 0  # Writes replaced by the connection before being sent, see _merge()
+        self.unmatched_count = 0  # ACK/NAKs with no write waiting for one
+        self.expired = []  # Merged requests whose older write had already timed out, given RequestTimeout by check()
+
+    def send(self, frame, callback=None, timeout=None):
+        """
+        Send a message to the mixer, now if the window has room, else once it has
+        :param frame: bytes, encoded CSCP message
+        :param callback: optional function, called with the result - True for an ACK, False for a NAK,
+                         the response Message for a read, or RequestTimeout if there was no response in time
+        :param timeout: float, seconds to wait for a response, None for the tracker's timeout
+        """
+        request = _Request(frame, response_key(frame), self.timeout if timeout is None else timeout, callback)
+        with self.lock:
+            if self.in_flight < self.window and not self.waiting:
+                self._send(request)
+                return
+            # A newer move for a fader that's still waiting replaces the older one
+            fader = pacing.fader_key(frame) if callback is None else None
+            if fader is not None:
+                waiting = self.waiting_faders.get(fader)
+                if waiting is not None:
+                    waiting.frame = frame
+                    self.replaced_count += 1
+                    return
+                self.waiting_faders[fader] = request
+            self.waiting.append(request)
+
+    def request(self, frame, timeout=None):
+        """
+        As send(), returning a concurrent.futures.Future of the result,
+        its exception being RequestTimeout if there's no response in time
+        (asyncio.wrap_future() makes it awaitable)
+        """
+        future = concurrent.futures.Future()
+
+        def done(result):
+            if isinstance(result, RequestTimeout):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        self.send(frame, done, timeout)
+        return future
+
+    def _send(self, request):
+        """ Called while holding self.lock """
+        request.deadline = time.monotonic() + request.timeout
+        if request.key is None:
+            self.writes.append(request)
+        else:
+            self.reads.setdefault(request.key, collections.deque()).append(request)
+        self.in_flight += 1
+        if self.cscp.send(request.frame) and request.key is None:
+            self._merge(request)
+
+    def _merge(self, request):
+        """
+        The connection replaced a fader move it hadn't sent yet with request's frame, so only one ACK will come
+        for the two - hand request over to the older write's place, called while holding self.lock
+        """
+        self.writes.pop()  # request, just added
+        self.in_flight -= 1
+        self.merged_count += 1
+        fader = pacing.fader_key(request.frame)
+        replaced = next((older for older in reversed(self.writes) if pacing.fader_key(older.frame) == fader), None)
+        if replaced is None:
+            # The older write has already timed out, its late ACK will be matched to the next write
+            if request.callback is not None:
+                self.expired.append(request)
+            return
+        replaced.frame = request.frame
+        if request.callback is not None:
+            if replaced.callback is None:
+                replaced.callback = request.callback
+            else:
+                first, second = replaced.callback, request.callback
+
+                def both(result):
+                    first(result)
+                    second(result)
+                replaced.callback = both
+
+    def _fill(self):
+        """ Send waiting requests while the window has room, called while holding self.lock """
+        while self.waiting and self.in_flight < self.window:
+            request = self.waiting.popleft()
+            fader = pacing.fader_key(request.frame) if request.callback is None else None
+            if fader is not None and self.waiting_faders.get(fader) is request:
+                del self.waiting_faders[fader]
+            self._send(request)
+
+    def received(self, msg):
+        """
+        Called by the bridge with each message from the mixer, completing the request it answers
+        :param msg: CSCP Message
+        """
+        request = None
+        result = None
+        with self.lock:
+            if msg.type in ('ACK', 'NAK'):
+                if msg.type == 'ACK':
+                    self.ack_count += 1
+                else:
+                    self.nak_count += 1
+                if self.writes:
+                    request = self.writes.popleft()
+                    result = msg.type == 'ACK'
+                else:
+                    self.unmatched_count += 1
+            elif self.reads:
+                encoded = msg.encoded
+                key = (encoded[utils.CMDLSB],
+                       encoded[utils.FDRMSB] << 8 | encoded[utils.FDRMSB + 1] if len(encoded) > utils.FDRMSB + 2
+                       else None)
+                requests = self.reads.get(key)
+                if not requests and key[1] is not None:
+                    requests = self.reads.get((key[0], None))  # e.g. read_console_info, no strip in the read
+                    key = (key[0], None)
+                if requests:
+                    request = requests.popleft()
+                    if not requests:
+                        del self.reads[key]
+                    result = msg
+                    self.response_count += 1
+            if request is None:
+                return
+            self.in_flight -= 1
+            self._fill()
+        if request.callback is not None:
+            request.callback(result)
+
+    def check(self):
+        """ Bridge timer callback - gives up on requests that haven't had a response in time """
+        now = time.monotonic()
+        with self.lock:
+            expired, self.expired = self.expired, []  # Already out of the window
+            merged = len(expired)
+            if not self.in_flight and not merged:
+                return
+            # Writes are answered in order, only the oldest can have missed its ACK
+            while self.writes and self.writes[0].deadline <= now:
+                expired.append(self.writes.popleft())
+            for key in list(self.reads):
+                requests = self.reads[key]
+                while requests and requests[0].deadline <= now:
+                    expired.append(requests.popleft())
+                if not requests:
+                    del self.reads[key]
+            self.in_flight -= len(expired) - merged
+            self.timed_out_count += len(expired)
+            self._fill()
+        for request in expired:
+            if request.callback is not None:
+                request.callback(RequestTimeout("No response from the mixer to {!r}".format(request.frame)))
+
+    def stats(self):
+        """ :return: dict of the tracker's counters """
+        return {'in flight': self.in_flight,
+                'waiting': len(self.waiting),
+                'ACKs': self.ack_count,
+                'NAKs': self.nak_count,
+                'responses': self.response_count,
+                'timed out': self.timed_out_count,
+                'replaced': self.replaced_count,
+                'merged': self.merged_count,
+                'unmatched': self.unmatched_count}
+
+
+if __name__ == '__main__':
+    # Against a stand-in mixer answering each request after a round trip -
+    # sending 1000 fader moves one at a time (waiting for each ACK) vs through the window
+    import heapq
+
+    import CSCP_decode as decode
+    import CSCP_encode as encode
+    import CSCP_message
+
+    ROUND_TRIP = 0.002
+
+    class StubMixer:
+        def __init__(self):
+            self.responses = []  # heap of (due, count, response)
+            self.count = 0
+
+        def send(self, frame):
+            self.count += 1
+            request = decode.Message(frame)
+            if request.type == 'write':
+                response = CSCP_message.ACK if request.strip != 13 else CSCP_message.NAK
+            else:
+                response = encode.Message(request.operation, request.strip, 'Ch {}'.format(request.strip),
+                                          recipient='controller').encoded
+            heapq.heappush(self.responses, (time.perf_counter() + ROUND_TRIP, self.count, response))
+
+        def answer(self, tracker):
+            due, _, response = heapq.heappop(self.responses)
+            time.sleep(max(0, due - time.perf_counter()))
+            tracker.received(CSCP_message.Message(response))
+
+    for window in (1, WINDOW):
+        mixer = StubMixer()
+        tracker = RequestTracker(mixer, window)
+        results = []
+        start = time.perf_counter()
+        for strip in range(1000):
+            tracker.send(encode.Message('fader_move', strip, 512).encoded, results.append)
+        while mixer.responses:
+            mixer.answer(tracker)
+        print('window {:>3}: 1000 writes answered in {:.3f}s, ACKs {}, NAKs {}'.format(
+            window, time.perf_counter() - start, results.count(True), results.count(False)))
+
+    mixer = StubMixer()
+    tracker = RequestTracker(mixer)
+    label = tracker.request(schema.encode('read_fader_label', {'strip': 7}, 'read'))
+    lost = tracker.request(schema.encode('read_fader_label', {'strip': 8}, 'read'), timeout=0)
+    mixer.responses.pop()  # Lose the response to strip 8
+    mixer.answer(tracker)
+    tracker.check()
+    print(label.result().value, repr(lost.exception()), tracker.stats())
@@ -0,0 +1,234 @@
+# CSCP_schema
+# Compiles the protocol description in CSCP_utils.SCHEMA into an encoder & decoder per operation,
+# so CSCP_encode & CSCP_decode are a table lookup and a struct pack/unpack, rather than
+# searching dicts for keys by value and branching on the operation name.
+# Adding an operation is an entry in CSCP_utils.SCHEMA, nothing here needs changing.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import struct
+
+import CSCP_utils as utils
+
+PAYLOAD_START = utils.FDRMSB  # Fields start after the CMD MSB & CMD LSB bytes
+TEXT_KINDS = ('str', 'cstr')  # Field kinds taking up the rest of the message
+WRITE_BIT = 0x80  # CMD MSB bit set for write messages
+
+# Inverse lookup tables, name: decimal value
+OPERATION_CODES = {operation: code for code, operation in utils.OPERATIONS.items()}
+DEVICE_CODES = {device: code for code, device in utils.DEVICES.items()}
+TYPE_CODES = {msg_type: code for code, msg_type in utils.TYPE.items()}
+
+
+def _default_read_fields(write_fields):
+    """ Read messages just give the strip to read, if the operation has one """
+    names = [field[0] for field in write_fields]
+    if 'strip' in names:
+        return write_fields[:names.index('strip') + 1]
+    return ()
+
+
+class Layout:
+    """
+    One operation's message layout, for either read or write messages, compiled from its SCHEMA fields
+    """
+    def __init__(self, code, operation, msg_type, fields):
+        """
+        :param code: int, CMD LSB value
+        :param operation: string, e.g. 'fader_move'
+        :param msg_type: string, 'read' or 'write'
+        :param fields: tuple of SCHEMA fields
+        """
+        self.code = code
+        self.operation = operation
+        self.type = msg_type
+        self.fields = []  # Names of the values in the struct, in order
+        self.tables = {}  # name: lookup table, for fields that translate to names
+        self.inverse_tables = {}  # name: {translated name: value}
+        self.tail = None  # (name, kind, length) of a text or bitmask field after the struct
+
+        formats = []
+        for field in fields:
+            name, kind = field[:2]
+            if kind in TEXT_KINDS or kind == 'bits':
+                if field is not fields[-1]:
+                    raise ValueError("CSCP schema: {} field {} must be last".format(operation, name))
+                self.tail = (name, kind, field[2] if kind == 'bits' else None)
+                continue
+            formats.append(kind)
+            if name:
+                self.fields.append(name)
+            if len(field) > 2:
+                self.tables[name] = field[2]
+                self.inverse_tables[name] = {v: k for k, v in field[2].items()}
+
+        # The whole message up to the tail: SOH, BC, DEV, CMD MSB, CMD LSB, fields...
+        self.struct = struct.Struct('>BBBBB' + ''.join(formats))
+        self.fields_size = self.struct.size - PAYLOAD_START
+        self.cmdmsb = TYPE_CODES[msg_type]
+
+        # Smallest byte count a message with this layout can have, the exact byte count if its length is fixed
+        self.min_byte_count = self.struct.size - utils.CSCP_HEADER_LENGTH
+        if self.tail and self.tail[1] == 'bits':
+            self.min_byte_count += self.tail[2]
+        self.byte_count = None if self.tail and self.tail[1] in TEXT_KINDS else self.min_byte_count
+
+    def decode(self, message):
+        """
+        :param message: bytes, a complete valid CSCP message
+        :return: dict of the message's fields, name: value
+        """
+        r = dict(zip(self.fields, self.struct.unpack_from(message)[PAYLOAD_START:]))
+        for name, table in self.tables.items():
+            r[name] = table.get(r[name], r[name])
+
+        if self.tail:
+            name, kind, length = self.tail
+            data = message[self.struct.size:-1]
+            if kind == 'str':
+                r[name] = data.decode('utf-8', errors='replace')
+            elif kind == 'cstr':
+                r[name] = data.split(b'\x00', 1)[0].decode('utf-8', errors='replace')
+            else:
+                r[name] = tuple(bit for bit in range(len(data) * 8) if data[bit // 8] & (0x80 >> bit % 8))
+        return r
+
+    def encode(self, fields, device):
+        """
+        :param fields: dict, name: value for each of the layout's fields. Names are accepted for lookup fields
+        :param device: int, DEV byte value
+        :return: bytes, complete CSCP message with checksum
+        """
+        try:
+            values = [fields[name] for name in self.fields]
+            if self.tail:
+                tail = fields[self.tail[0]]
+        except KeyError as e:
+            raise ValueError("CSCP {} {} message needs a {}".format(self.type, self.operation, e.args[0]))
+
+        for name, inverse in self.inverse_tables.items():
+            i = self.fields.index(name)
+            values[i] = inverse.get(values[i], values[i])
+
+        if not self.tail:
+            tail = b''
+        elif self.tail[1] == 'bits':
+            mask = bytearray(self.tail[2])
+            for bit in tail:
+                mask[bit // 8] |= 0x80 >> bit % 8
+            tail = mask
+        else:
+            tail = tail.encode('utf-8') + (b'\x00' if self.tail[1] == 'cstr' else b'')
+
+        message = bytearray(self.struct.size + len(tail) + 1)
+        self.struct.pack_into(message, 0, utils.CSCP_HEADER_START,
+                              self.struct.size - utils.CSCP_HEADER_LENGTH + len(tail),
+                              device, self.cmdmsb, self.code, *values)
+        message[self.struct.size:-1] = tail
+        message[-1] = -sum(message[utils.CSCP_HEADER_LENGTH:-1]) & 0xFF  # Two's complement of the payload sum
+        return bytes(message)
+
+
+# Compile the schema
+LAYOUTS = {}  # (operation, msg_type): Layout
+DECODE_LAYOUTS = {}  # CMD LSB value: (write Layout, read Layout)
+for _code, _operation in utils.SCHEMA.items():
+    _write = _operation['write']
+    _read = _operation.get('read', _default_read_fields(_write))
+    for _msg_type, _fields in (('write', _write), ('read', _read)):
+        LAYOUTS[(_operation['name'], _msg_type)] = Layout(_code, _operation['name'], _msg_type, _fields)
+    DECODE_LAYOUTS[_code] = (LAYOUTS[(_operation['name'], 'write')], LAYOUTS[(_operation['name'], 'read')])
+
+# Messages with an unknown CMD LSB are decoded as if they just give a strip
+UNKNOWN_LAYOUT = Layout(None, 'unknown', 'write', (utils.STRIP,))
+
+# Byte counts of the messages this app sends - reads for 'read_' operations, else writes
+BYTE_COUNTS = {}
+for (_name, _msg_type), _layout in LAYOUTS.items():
+    if _layout.byte_count is not None and _msg_type == ('read' if _name.startswith('read_') else 'write'):
+        BYTE_COUNTS[_name] = _layout.byte_count
+
+
+def encode(operation, fields, msg_type='write', recipient='mixer'):
+    """
+    :param operation: string, e.g. 'fader_move'
+    :param fields: dict, name: value of the operation's fields for the message type, e.g. {'strip': 3, 'value': 744}
+    :param msg_type: string, 'write' or 'read'
+    :param recipient: string, 'mixer' or 'controller'
+    :return: bytes, complete CSCP message with checksum
+    """
+    return LAYOUTS[(operation, msg_type)].encode(fields, DEVICE_CODES[recipient])
+
+
+def decode_fields(message):
+    """
+    :param message: bytes, a complete valid CSCP message, e.g. from CSCP_unpack
+    :return: dict of the message's fields
+    """
+    layouts = DECODE_LAYOUTS.get(message[utils.CMDLSB])
+    if layouts is None:
+        layout = UNKNOWN_LAYOUT
+    elif message[utils.BYTE_COUNT_BYTE] >= layouts[0].min_byte_count:
+        # Layout goes by what the message holds, e.g. the mixer sends read_console_info responses as writes
+        layout = layouts[0]
+    else:
+        layout = layouts[1]
+
+    try:
+        return layout.decode(message)
+    except struct.error:  # Shorter than the layout
+        return {}
+
+
+def decode(message):
+    """
+    :param message: bytes, a complete valid CSCP message, e.g. from CSCP_unpack
+    :return: recipient, type, operation (strings) & dict of the message's fields
+    """
+    recipient = utils.DEVICES.get(message[utils.DEVICE_BYTE], 'unknown')
+    msg_type = 'write' if message[utils.CMDMSB] & WRITE_BIT else 'read'
+    return recipient, msg_type, utils.OPERATIONS.get(message[utils.CMDLSB], 'unknown'), decode_fields(message)
+
+
+def message_fields(strip, value):
+    """
+    :return: dict of fields for encode(), from a Message's strip & value
+    """
+    fields = {}
+    if strip is not None:
+        fields['strip'] = strip
+    if isinstance(value, dict):
+        fields.update(value)
+    elif value is not None:
+        fields['value'] = value
+    return fields
+
+
+def strip_and_value(fields):
+    """
+    :param fields: dict, from decode()
+    :return: a Message's strip & value from its fields, False for either the message doesn't have
+    """
+    strip = fields.get('strip', False)
+    if 'value' in fields:
+        return strip, fields['value']
+    value = {name: v for name, v in fields.items() if name != 'strip'}
+    return strip, value or False
+
+
+if __name__ == '__main__':
+    import timeit
+
+    for (name, msg_type), layout in LAYOUTS.items():
+        print('{:<25}{:<7}{:<30}{}'.format(name, msg_type, layout.struct.format,
+                                           layout.byte_count if layout.byte_count else 'variable'))
+
+    print('\n', decode(encode('main_send_toggle', {'strip': 1, 'value': (0, 9, 191)})))
+    encoded = encode('fader_move', {'strip': 3, 'value': 744})
+    print(encoded, decode(encoded))
+    print('encode us: {:.2f}'.format(timeit.timeit(lambda: encode('fader_move', {'strip': 3, 'value': 744}),
+                                                   number=100000) * 10))
+    print('decode us: {:.2f}'.format(timeit.timeit(lambda: decode(encoded), number=100000) * 10))
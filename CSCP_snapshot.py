@@ -0,0 +1,291 @@
+# CSCP_snapshot
+# Used by the CSCP-MIDI application.
+# Saves the console's layout - fader & mains quantities, labels and path info - from the bridge's
+# CSCP_state.MixerState to a file, one per console name & CSCP version, and loads it at the next start up.
+# The mixer state is then complete before the mixer has even connected, rather than waiting on reading every
+# strip from it. Once connected, the strip sync (CSCP_sync) still reads every strip, any that have changed
+# being patched into the state and the snapshot saved again.
+# Each file is a fixed header followed by one array per field, laid out as MixerState holds them,
+# so loading is memory mapping the file and copying each array out in one go.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import array
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+
+import CSCP_utils as utils
+
+SNAPSHOT_DIR = "snapshots"
+EXTENSION = ".cscp"
+SAVE_INTERVAL = 10  # Seconds between saving the snapshot, if the console's layout has changed
+
+# File layout, little endian:
+#   header - magic, format version, CSCP version, fader quantity, mains quantity, console name length, console name
+#            (quantities are 4 bytes, as strips are numbered 0 - 0xFFFF so a state can hold 0x10000)
+#   path types (1 byte per strip), path widths (1 byte per strip), path ids (2 bytes per strip),
+#   label lengths (1 byte per strip, NO_LABEL if not known), labels (LABEL_SIZE bytes per strip)
+MAGIC = b'CSMS'
+FORMAT = 2
+NAME_SIZE = 64
+HEADER = struct.Struct('<4sBHIIB{}s'.format(NAME_SIZE))
+LABEL_SIZE = 32  # Longer labels are cut short
+NO_LABEL = 0xFF
+
+log = logging.getLogger(__name__)
+
+
+def key(console_info):
+    """ :return: (console name, CSCP version) from the read_console_info response, None if it's not known """
+    if 'console name' not in console_info:
+        return None
+    return console_info['console name'], console_info['CSCP version']
+
+
+def file_name(console_key):
+    """ :return: string, snapshot file name for a (console name, CSCP version) """
+    name, version = console_key
+    return '{}_v{}{}'.format(re.sub(r'[^A-Za-z0-9_-]', '_', name) or 'console', version, EXTENSION)
+
+
+def _to_little_endian(a):
+    """ :return: bytes of array a, little endian """
+    if sys.byteorder == 'big':
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def save(state, path):
+    """
+    Write the state's console layout to a snapshot file, replacing it in one go so a reader never sees half a file
+    :param state: CSCP_state.MixerState, with its console info received
+    :param path: string, file path
+    """
+    info = state.console_info
+    name = info['console name'].encode('utf-8')[:NAME_SIZE]
+    n = state.faders
+    lengths = bytearray(n)
+    labels = bytearray(n * LABEL_SIZE)
+    for strip, label in enumerate(state.labels):
+        if label is None:
+            lengths[strip] = NO_LABEL
+            continue
+        encoded = label.encode('utf-8')[:LABEL_SIZE]
+        lengths[strip] = len(encoded)
+        labels[strip * LABEL_SIZE:strip * LABEL_SIZE + len(encoded)] = encoded
+
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT, info['CSCP version'], n, state.mains, len(name), name))
+            f.write(state.path_types[:n])
+            f.write(state.path_widths[:n])
+            f.write(_to_little_endian(state.path_ids[:n]))
+            f.write(lengths)
+            f.write(labels)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def load(state, path):
+    """
+    Read a snapshot file into the state, sizing it to the snapshot's fader quantity
+    :param state: CSCP_state.MixerState
+    :param path: string, file path
+    :return: dict, the console info from the snapshot
+    :raises ValueError: if the file isn't a snapshot, :raises OSError: if it can't be read
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if len(data) < HEADER.size:
+            raise ValueError("'{}' is not a console snapshot".format(path))
+        magic, version, cscp_version, n, mains, name_length, name = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT or len(data) != HEADER.size + n * (5 + LABEL_SIZE):
+            raise ValueError("'{}' is not a console snapshot".format(path))
+
+        state.resize(n, mains)
+        offset = HEADER.size
+        state.path_types[:n] = data[offset:offset + n]
+        offset += n
+        state.path_widths[:n] = data[offset:offset + n]
+        offset += n
+        path_ids = array.array('H', data[offset:offset + 2 * n])
+        if sys.byteorder == 'big':
+            path_ids.byteswap()
+        state.path_ids[:n] = path_ids
+        offset += 2 * n
+        lengths = data[offset:offset + n]
+        offset += n
+        labels = state.labels
+        for strip, length in enumerate(lengths):
+            if length != NO_LABEL:
+                start = offset + strip * LABEL_SIZE
+                labels[strip] = data[start:start + length].decode('utf-8', errors='replace')
+
+    info = {'CSCP version': cscp_version, 'fader quantity': n, 'mains quantity': mains,
+            'console name': name[:name_length].decode('utf-8', errors='replace')}
+    state.console_info = info
+    state.console_name = info['console name']
+    return info
+
+
+class Snapshot:
+    """
+    Keeps a MixerState's console layout saved, loading the right console's snapshot when the mixer connects
+    Give it to the bridge, which passes it the messages it receives (before the state gets them),
+    and calls check() on a timer to save any changes
+    """
+    def __init__(self, state, directory=SNAPSHOT_DIR):
+        """
+        :param state: CSCP_state.MixerState
+        :param directory: string, folder holding the snapshot files
+        """
+        self.state = state
+        self.directory = directory
+        self.interval = SAVE_INTERVAL
+        self.loaded_key = None  # (console name, CSCP version) of the snapshot in the state
+        self.changed = False  # The console's layout has changed since the snapshot was saved/loaded
+        self.patched_count = 0  # Labels & path info found to differ from the snapshot
+        self.save_count = 0
+
+    def _path(self, console_key):
+        return os.path.join(self.directory, file_name(console_key))
+
+    def load_latest(self):
+        """
+        Load the most recently saved snapshot, i.e. the console used last time, at start up
+        :return: dict, its console info, None if there are no snapshots
+        """
+        try:
+            paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                     if name.endswith(EXTENSION)]
+        except OSError:
+            return None
+        for path in sorted(paths, key=os.path.getmtime, reverse=True):
+            try:
+                info = load(self.state, path)
+            except (OSError, ValueError) as e:
+                log.warning("Skipping console snapshot - %s", e)
+                continue
+            self.loaded_key = key(info)
+            log.info("Loaded console snapshot '%s'", path)
+            return info
+        return None
+
+    def received(self, msg):
+        """
+        Called by the bridge with each message from the mixer, before the state is updated from it
+        :param msg: CSCP Message
+        """
+        operation = msg.operation
+        if operation == 'read_console_info':
+            info = msg.value
+            if not isinstance(info, dict) or 'console name' not in info:
+                return
+            console_key = key(info)
+            if console_key != self.loaded_key:
+                # A different console to the snapshot, use its own snapshot if there is one
+                self.state.resize(0)
+                try:
+                    load(self.state, self._path(console_key))
+                    log.info("Loaded console snapshot for '%s'", console_key[0])
+                except (OSError, ValueError):
+                    pass
+                self.loaded_key = console_key
+                self.changed = True
+            elif info.get('fader quantity') != self.state.faders or info.get('mains quantity') != self.state.mains:
+                self.changed = True
+
+        elif operation in ('read_fader_label', 'fader_path_info') and msg.type == 'write':
+            strip = msg.strip
+            state = self.state
+            if type(strip) != int:
+                return
+            if operation == 'read_fader_label':
+                same = strip < state.faders and state.labels[strip] == msg.value
+            else:
+                same = strip < state.faders and msg.encoded[utils.VALMSB:utils.VALMSB + 4] == bytes(
+                    (state.path_types[strip], state.path_widths[strip])) + state.path_ids[strip].to_bytes(2, 'big')
+            if not same:
+                self.patched_count += 1
+                self.changed = True
+
+    def save(self):
+        """ Save the state's console layout, if the console info has been received or loaded """
+        if key(self.state.console_info) is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            save(self.state, self._path(key(self.state.console_info)))
+        except Exception as e:
+            # Called from a bridge timer, so whatever's wrong mustn't stop the bridge
+            log.warning("Console snapshot not saved - %s", e)
+            return
+        self.changed = False
+        self.save_count += 1
+
+    def check(self):
+        """ Bridge timer callback - save the snapshot if the console's layout has changed """
+        if self.changed:
+            self.save()
+
+    def stats(self):
+        """ :return: dict of the snapshot's counters """
+        return {'console': self.loaded_key[0] if self.loaded_key else None,
+                'patched': self.patched_count,
+                'saved': self.save_count}
+
+
+if __name__ == '__main__':
+    import tempfile
+    import timeit
+
+    import CSCP_decode as decode
+    import CSCP_encode as encode
+    import CSCP_schema as schema
+    import CSCP_state
+
+    for faders in (48, 192, 4096):
+        state = CSCP_state.MixerState()
+        state.console_info = {'CSCP version': 1, 'fader quantity': faders, 'mains quantity': 4,
+                              'console name': 'Summa'}
+        state.resize(faders, 4)
+        for strip in range(faders):
+            state.update(decode.Message(encode.Message('read_fader_label', strip, 'Ch {}'.format(strip),
+                                                       recipient='controller').encoded))
+            state.update(decode.Message(encode.Message('fader_path_info', strip, {
+                'path_type': 1, 'path_width': 2, 'path_id': strip}, recipient='controller').encoded))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, file_name(key(state.console_info)))
+            save(state, path)
+            loaded = CSCP_state.MixerState()
+            load(loaded, path)
+            same = (loaded.labels == state.labels and loaded.path_ids == state.path_ids
+                    and loaded.path_types == state.path_types and loaded.console_info == state.console_info)
+            load_time = timeit.timeit(lambda: load(CSCP_state.MixerState(), path), number=100) * 10
+            print('{:>5} strips: {:>7} bytes, load {:.2f}ms, same after loading: {}'.format(
+                faders, os.path.getsize(path), load_time, same))
+
+            # A restart - the snapshot is loaded, then the mixer connects & the sync finds a renamed strip
+            snapshot = Snapshot(CSCP_state.MixerState(), directory)
+            print('loaded', snapshot.load_latest())
+            info = schema.encode('read_console_info', {'CSCP version': 1, 'fader quantity': faders,
+                                                       'mains quantity': 4, 'console name': 'Summa'},
+                                 recipient='controller')
+            for message in (info, encode.Message('read_fader_label', 3, 'Ch 3', recipient='controller').encoded,
+                            encode.Message('read_fader_label', 5, 'Vox', recipient='controller').encoded):
+                snapshot.received(decode.Message(message))
+                snapshot.state.update(decode.Message(message))
+            snapshot.check()
+            print(snapshot.stats(), snapshot.state.label(5))
@@ -0,0 +1,276 @@
+# CSCP_state
+# Used by the CSCP-MIDI application.
+# Provides MixerState, a copy of the mixer's current state kept up to date from the CSCP messages received -
+# fader levels, cut & PFL states, labels, path info and the console info. Fed by the bridge, so converters
+# (and anything showing the mixer's state) can look up what a strip is doing without asking the mixer.
+# Held in arrays & bitsets, one entry/bit per strip, sized from the fader quantity the mixer reports,
+# so looking up or updating a strip is an index, and a large console is a few KB.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import array
+
+import CSCP_utils as utils
+
+DEFAULT_FADERS = 64  # Strips held until the mixer says how many it has, grown if a higher strip turns up
+MAX_FADERS = 0x10000  # Strips are 2 bytes
+
+# Operations the state is kept from - subscribe to these as well as what the mapping needs, see CSCP_subscription
+SUBSCRIPTION = {'fader_move': None,
+                'main_fader_move': None,
+                'cut_toggle': None,
+                'pfl_toggle': None,
+                'read_fader_label': None,
+                'fader_path_info': None,
+                'read_console_info': None,
+                'read_console_name': None}
+
+
+def _bitset(size):
+    return bytearray((size + 7) // 8)
+
+
+def _get_bit(bits, i):
+    return bool(bits[i >> 3] & (0x80 >> (i & 7)))
+
+
+def _set_bit(bits, i, value):
+    if value:
+        bits[i >> 3] |= 0x80 >> (i & 7)
+    else:
+        bits[i >> 3] &= ~(0x80 >> (i & 7)) & 0xFF
+
+
+def _resized(old, new):
+    """ :return: new, with as much of old copied in as fits """
+    n = min(len(old), len(new))
+    new[:n] = old[:n]
+    return new
+
+
+class MixerState:
+    """
+    The mixer's current state, as far as it's been received
+    Updated from the bridge's thread, reading it from other threads is fine - each value is read whole
+    Levels, cuts etc of strips not heard from yet are 0/False, labels None. known(strip) says if a strip's
+    fader level has been received
+    """
+    def __init__(self, faders=DEFAULT_FADERS, mains=0):
+        """
+        :param faders: int, strips to make room for, until the mixer reports its fader quantity
+        :param mains: int, main faders to make room for, until the mixer reports its mains quantity
+        """
+        self.console_info = {}  # 'CSCP version', 'fader quantity', 'mains quantity', 'console name'
+        self.console_name = None
+        self.update_count = 0
+        self.faders = 0
+        self.mains = 0
+        self.levels = array.array('H')
+        self.cuts = bytearray()  # Bitset, CSCP's cut values - set is uncut/passing audio
+        self.cuts_known = bytearray()  # Bitset, set once a strip's cut state has been received
+        self.pfls = bytearray()  # Bitset
+        self.levels_known = bytearray()  # Bitset, set once a strip's level has been received
+        self.labels = []
+        self.path_types = bytearray()  # utils.PATH_TYPES values
+        self.path_widths = bytearray()  # utils.AUDIO_WIDTHS values
+        self.path_ids = array.array('H')
+        self.main_levels = array.array('H')
+        self.resize(faders, mains)
+
+        # CSCP operation: method updating the state from a message
+        self.handlers = {'fader_move': self._fader_move,
+                         'main_fader_move': self._main_fader_move,
+                         'cut_toggle': self._cut_toggle,
+                         'pfl_toggle': self._pfl_toggle,
+                         'read_fader_label': self._label,
+                         'fader_path_info': self._path_info,
+                         'read_console_info': self._console_info,
+                         'read_console_name': self._console_name}
+
+    def resize(self, faders, mains=None):
+        """
+        Make room for a number of strips, keeping the state of those already held
+        :param faders: int, number of strips
+        :param mains: int, number of main faders, None to leave as is
+        """
+        faders = min(faders, MAX_FADERS)
+        if faders != self.faders:
+            self.levels = _resized(self.levels, array.array('H', bytes(2 * faders)))
+            self.cuts = _resized(self.cuts, _bitset(faders))
+            self.cuts_known = _resized(self.cuts_known, _bitset(faders))
+            self.pfls = _resized(self.pfls, _bitset(faders))
+            self.levels_known = _resized(self.levels_known, _bitset(faders))
+            self.labels = _resized(self.labels, [None] * faders)
+            self.path_types = _resized(self.path_types, bytearray(faders))
+            self.path_widths = _resized(self.path_widths, bytearray(faders))
+            self.path_ids = _resized(self.path_ids, array.array('H', bytes(2 * faders)))
+            self.faders = faders
+        if mains is not None and mains != self.mains:
+            self.main_levels = _resized(self.main_levels, array.array('H', bytes(2 * mains)))
+            self.mains = mains
+
+    def _strip(self, msg):
+        """ :return: int, msg's strip, making room for it if needed, None if it hasn't got one """
+        strip = msg.strip
+        if type(strip) != int:
+            return None
+        if strip >= self.faders:
+            # Grow in steps, in case strips keep going up one at a time, e.g. syncing labels
+            self.resize(max(strip + 1, min(self.faders * 2, MAX_FADERS)))
+        return strip
+
+    def update(self, msg):
+        """
+        Update the state from a message received from the mixer
+        :param msg: CSCP Message, ACKs/NAKs & operations the state doesn't keep are ignored
+        :return: True if msg updated the state
+        """
+        handler = self.handlers.get(msg.operation)
+        if handler is None or msg.type != 'write':
+            return False
+        self.update_count += 1
+        return handler(msg) is not False
+
+    def _fader_move(self, msg):
+        strip = self._strip(msg)
+        if strip is None or type(msg.value) != int:
+            return False
+        self.levels[strip] = msg.value
+        _set_bit(self.levels_known, strip, True)
+
+    def _main_fader_move(self, msg):
+        strip = msg.strip
+        if type(strip) != int or type(msg.value) != int:
+            return False
+        if strip >= self.mains:
+            self.resize(self.faders, strip + 1)
+        self.main_levels[strip] = msg.value
+
+    def _cut_toggle(self, msg):
+        strip = self._strip(msg)
+        if strip is None:
+            return False
+        _set_bit(self.cuts, strip, msg.value)
+        _set_bit(self.cuts_known, strip, True)
+
+    def _pfl_toggle(self, msg):
+        strip = self._strip(msg)
+        if strip is None:
+            return False
+        _set_bit(self.pfls, strip, msg.value)
+
+    def _label(self, msg):
+        strip = self._strip(msg)
+        if strip is None:
+            return False
+        self.labels[strip] = msg.value
+
+    def _path_info(self, msg):
+        strip = self._strip(msg)
+        # Taken from the bytes, as the decoded fields are translated to names
+        encoded = msg.encoded
+        if strip is None or len(encoded) < utils.VALMSB + 5:
+            return False
+        self.path_types[strip] = encoded[utils.VALMSB]
+        self.path_widths[strip] = encoded[utils.VALMSB + 1]
+        self.path_ids[strip] = encoded[utils.VALMSB + 2] << 8 | encoded[utils.VALMSB + 3]
+
+    def _console_info(self, msg):
+        info = msg.value
+        if not isinstance(info, dict) or 'fader quantity' not in info:
+            return False  # The read request, not the response
+        self.console_info = info
+        self.console_name = info.get('console name')
+        self.resize(info['fader quantity'], info.get('mains quantity'))
+
+    def _console_name(self, msg):
+        if type(msg.value) != str:
+            return False
+        self.console_name = msg.value
+
+    def level(self, strip):
+        """ :return: int, strip's fader level 0 - 1024 """
+        return self.levels[strip] if strip < self.faders else 0
+
+    def known(self, strip):
+        """ :return: True if strip's fader level has been received """
+        return strip < self.faders and _get_bit(self.levels_known, strip)
+
+    def cut(self, strip):
+        """
+        :return: True if strip is cut, False if it isn't or its cut state hasn't been received.
+        CSCP's cut values are reversed, 1 being uncut
+        """
+        return strip < self.faders and _get_bit(self.cuts_known, strip) and not _get_bit(self.cuts, strip)
+
+    def pfl(self, strip):
+        """ :return: True if strip's PFL is on """
+        return strip < self.faders and _get_bit(self.pfls, strip)
+
+    def label(self, strip):
+        """ :return: string, strip's label, None if not received """
+        return self.labels[strip] if strip < self.faders else None
+
+    def path_info(self, strip):
+        """ :return: dict of strip's path type, width (as names) & id """
+        if strip >= self.faders:
+            return {'path_type': utils.PATH_TYPES[0], 'path_width': utils.AUDIO_WIDTHS[0], 'path_id': 0}
+        return {'path_type': utils.PATH_TYPES.get(self.path_types[strip], self.path_types[strip]),
+                'path_width': utils.AUDIO_WIDTHS.get(self.path_widths[strip], self.path_widths[strip]),
+                'path_id': self.path_ids[strip]}
+
+    def main_level(self, main):
+        """ :return: int, main fader's level 0 - 1024 """
+        return self.main_levels[main] if main < self.mains else 0
+
+    def subscription(self):
+        """ :return: dict, the CSCP operations the state is kept from, see CSCP_subscription """
+        return dict(SUBSCRIPTION)
+
+    def stats(self):
+        """ :return: dict of the state's size & counters """
+        return {'faders': self.faders,
+                'mains': self.mains,
+                'levels known': sum(bin(byte).count('1') for byte in self.levels_known),
+                'updates': self.update_count}
+
+
+if __name__ == '__main__':
+    import sys
+    import timeit
+
+    import CSCP_decode as decode
+    import CSCP_encode as encode
+    import CSCP_schema as schema
+
+    state = MixerState()
+    info = schema.encode('read_console_info', {'CSCP version': 1, 'fader quantity': 96, 'mains quantity': 4,
+                                               'console name': 'Summa'}, recipient='controller')
+    received = [info,
+                encode.Message('fader_move', 3, 744, recipient='controller').encoded,
+                encode.Message('cut_toggle', 3, 0, recipient='controller').encoded,
+                encode.Message('pfl_toggle', 3, 1, recipient='controller').encoded,
+                b'\xf1\r\xff\x80\x0b\x00\x03Mic -R tn\xbb',
+                encode.Message('fader_path_info', 3, {'path_type': 'Input Channel', 'path_width': 'Stereo',
+                                                      'path_id': 300}, recipient='controller').encoded,
+                encode.Message('fader_move', 120, 512, recipient='controller').encoded]
+    for message in received:
+        state.update(decode.Message(message))
+
+    print(state.console_info)
+    print('strip 3 - level: {}, cut: {}, pfl: {}, label: {}, path: {}'.format(
+        state.level(3), state.cut(3), state.pfl(3), state.label(3), state.path_info(3)))
+    print('strip 120 - level: {}, known: {}, strip 4 known: {}'.format(state.level(120), state.known(120),
+                                                                         state.known(4)))
+    print(state.stats())
+
+    fader_move = decode.Message(received[1])
+    print('\nupdate() us: {:.3f}'.format(timeit.timeit(lambda: state.update(fader_move), number=100000) * 10))
+    print('level() us: {:.3f}'.format(timeit.timeit(lambda: state.level(3), number=100000) * 10))
+    big = MixerState(4096)
+    size = sum(sys.getsizeof(a) for a in (big.levels, big.cuts, big.pfls, big.levels_known,
+                                          big.cuts_known, big.labels, big.path_types, big.path_widths, big.path_ids))
+    print('4096 strips: {:.1f}KB'.format(size / 1024))
@@ -0,0 +1,116 @@
+# CSCP_subscription
+# Used by CSCP_connection.
+# Lets a connection only pass on the operations (and optionally strips) the app has a use for.
+# The mixer sends plenty the mapping ignores - labels, path info, routing changes... - so rather than build a
+# message object for each and queue it for the bridge to drop, the connection checks the CMD LSB byte
+# (and strip bytes) of each unpacked message first, counting and dropping those that aren't wanted.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import CSCP_utils as utils
+
+_NOT_SUBSCRIBED = object()
+
+
+class Subscription:
+    """
+    Set of operations, each for all strips or a set of strips
+    """
+    def __init__(self, operations=None):
+        """
+        :param operations: dict, operation name: iterable of strip numbers, or None for all strips,
+                           e.g. {'fader_move': [0, 1, 2], 'read_console_info': None}
+                           None to pass everything
+        """
+        self.codes = None  # CMD LSB value: frozenset of strips or None, None to pass everything
+        self.dropped_counts = {}  # CMD LSB value: messages dropped
+        self.update(operations)
+
+    def update(self, operations):
+        """ Replace the subscribed operations, :param operations: as for init """
+        if operations is None:
+            self.codes = None
+            return
+
+        codes = {}
+        for code, operation in utils.SCHEMA.items():
+            if operation['name'] not in operations:
+                continue
+            strips = operations[operation['name']]
+            # Can only pick out strips for operations with the usual 2 byte strip
+            if strips is None or operation['write'][:1] != (utils.STRIP,):
+                codes[code] = None
+            else:
+                codes[code] = frozenset(strips)
+        self.codes = codes  # Swapped in whole, so the connection's thread never sees it half built
+
+    def operations(self):
+        """ :return: dict, operation name: set of strips or None - in the form update() takes, None for everything """
+        if self.codes is None:
+            return None
+        return {utils.OPERATIONS[code]: None if strips is None else set(strips) for code, strips in self.codes.items()}
+
+    def wants(self, message):
+        """
+        Checks an unpacked message is subscribed to, counting it if not
+        :param message: bytes, complete valid CSCP message
+        :return: True to pass the message on
+        """
+        codes = self.codes
+        if codes is None:
+            return True
+
+        code = message[utils.CMDLSB]
+        strips = codes.get(code, _NOT_SUBSCRIBED)
+        if strips is None:
+            return True
+        if (strips is not _NOT_SUBSCRIBED and len(message) > utils.FDRMSB + 1
+                and (message[utils.FDRMSB] << 8 | message[utils.FDRMSB + 1]) in strips):
+            return True
+
+        self.dropped_counts[code] = self.dropped_counts.get(code, 0) + 1
+        return False
+
+    def stats(self):
+        """ :return: dict, operation name: messages dropped """
+        return {utils.OPERATIONS.get(code, 'unknown'): count for code, count in self.dropped_counts.items()}
+
+
+def merge(*subscriptions):
+    """
+    Combines subscriptions, e.g. what the mapping needs plus what the mixer state needs
+    :param subscriptions: dicts, operation name: iterable of strips or None, or None for everything
+    :return: dict in the same form, subscribing to everything any of them subscribe to, None for everything
+    """
+    r = {}
+    for operations in subscriptions:
+        if operations is None:
+            return None
+        for operation, strips in operations.items():
+            if operation in r and r[operation] is None:
+                continue
+            if strips is None:
+                r[operation] = None
+            else:
+                r[operation] = r.get(operation, set()) | set(strips)
+    return r
+
+
+if __name__ == '__main__':
+    import timeit
+
+    import CSCP_encode as encode
+
+    subscription = Subscription({'fader_move': [0, 1, 2], 'cut_toggle': None})
+    fader_move = encode.Message('fader_move', 1, 744).encoded
+    other_fader = encode.Message('fader_move', 40, 744).encoded
+    label = b'\xf1\r\xff\x80\x0b\x00\x00Mic -R tn\xbb'
+    for message in (fader_move, other_fader, label, encode.Message('cut_toggle', 40, 1).encoded):
+        print(message, subscription.wants(message))
+    print(subscription.stats(), subscription.operations())
+    print(merge({'fader_move': [0, 1]}, {'fader_move': [5], 'read_console_info': None}))
+
+    print('wants() us: {:.3f}'.format(timeit.timeit(lambda: subscription.wants(label), number=100000) * 10))
@@ -0,0 +1,175 @@
+# CSCP_sync
+# Used by the CSCP-MIDI application.
+# Reads the state of every strip from the mixer when a connection is made, so the bridge's CSCP_state.MixerState
+# is complete straight away rather than filling in as the mixer happens to send things.
+# The CSCP connection asks for the console info as it connects, the response gives the fader quantity,
+# then a label & path info read is sent for each strip. Rather than send one read and wait for its response
+# before the next (192 strips would take 384 round trips), up to a window of reads are kept in flight,
+# a new one being sent as each response comes in. Reads with no response are sent again, then given up on.
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+# See Readme.txt for info on how to use this app.
+# See Project_Notes.txt for info on the implementation - how the app works.
+
+import collections
+import logging
+import time
+
+import CSCP_schema as schema
+
+SYNC_OPERATIONS = ('read_fader_label', 'fader_path_info')  # Read for each strip
+WINDOW = 32  # Max reads waiting for a response. Keep within CSCP_connection.SEND_BURST so they aren't held back
+TIMEOUT = 0.5  # Seconds to wait for a response before sending the read again
+RETRIES = 1  # Times a read is sent again before giving up on it
+CHECK_INTERVAL = 0.1  # Seconds between checking for reads that have timed out
+
+log = logging.getLogger(__name__)
+
+
+class Sync:
+    """
+    Reads each strip's state from the mixer once the console info says how many strips there are
+    Give it to the bridge, which passes it the messages it receives and calls check() on a timer
+    """
+    def __init__(self, cscp, operations=SYNC_OPERATIONS, window=WINDOW, timeout=TIMEOUT, retries=RETRIES):
+        """
+        :param cscp: CSCP_connection.Connection object, the async version, or a CSCP_requests.RequestTracker
+        :param operations: tuple of operation names, read for each strip
+        :param window: int, max reads sent and waiting for a response
+        :param timeout: float, seconds to wait for a response before sending a read again
+        :param retries: int, times a read is sent again before giving up on it
+        """
+        self.cscp = cscp
+        self.operations = operations
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.interval = CHECK_INTERVAL
+        self.waiting = collections.deque()  # (operation, strip) still to send
+        self.in_flight = {}  # (operation, strip): [time sent, times sent]
+        self.started = None  # time.perf_counter() the current sync started, None if not syncing
+        self.strips = 0
+        self.sync_count = 0
+        self.sync_time = None  # Seconds the last complete sync took
+        self.sent_count = 0
+        self.resent_count = 0
+        self.timed_out_count = 0
+
+    def subscription(self):
+        """ :return: dict, the CSCP operations sync needs passed on, see CSCP_subscription """
+        r = {operation: None for operation in self.operations}
+        r['read_console_info'] = None
+        return r
+
+    def start(self, strips):
+        """
+        Read every strip's state, abandoning any sync already going
+        :param strips: int, fader quantity
+        """
+        self.strips = strips
+        self.waiting = collections.deque((operation, strip) for strip in range(strips)
+                                         for operation in self.operations)
+        self.in_flight = {}
+        self.started = time.perf_counter()
+        log.info("Syncing %d strips from the mixer", strips)
+        self._fill()
+
+    def _send(self, key, times_sent):
+        operation, strip = key
+        self.in_flight[key] = [time.monotonic(), times_sent]
+        self.cscp.send(schema.encode(operation, {'strip': strip}, 'read', 'mixer'))
+        self.sent_count += 1
+
+    def _fill(self):
+        """ Send reads until the window is full, finishing the sync if there's nothing left """
+        while self.waiting and len(self.in_flight) < self.window:
+            self._send(self.waiting.popleft(), 1)
+        if not self.waiting and not self.in_flight and self.started is not None:
+            self.sync_time = time.perf_counter() - self.started
+            self.started = None
+            self.sync_count += 1
+            log.info("Synced %d strips in %.3fs", self.strips, self.sync_time)
+
+    def received(self, msg):
+        """
+        Called by the bridge with each message from the mixer
+        :param msg: CSCP Message
+        """
+        operation = msg.operation
+        if operation == 'read_console_info':
+            info = msg.value
+            # The mixer's response, rather than a read request
+            if isinstance(info, dict) and 'fader quantity' in info:
+                self.start(info['fader quantity'])
+        elif self.in_flight and operation in self.operations and msg.type == 'write':
+            if self.in_flight.pop((operation, msg.strip), None) is not None:
+                self._fill()
+
+    def check(self):
+        """ Bridge timer callback - send again, or give up on, reads that haven't had a response """
+        if not self.in_flight:
+            return
+        expired = time.monotonic() - self.timeout
+        for key, (sent, times_sent) in list(self.in_flight.items()):
+            if sent > expired:
+                continue
+            if times_sent <= self.retries:
+                self.resent_count += 1
+                self._send(key, times_sent + 1)
+            else:
+                del self.in_flight[key]
+                self.timed_out_count += 1
+        self._fill()
+
+    def stats(self):
+        """ :return: dict of the sync's counters """
+        return {'syncing': self.started is not None,
+                'syncs': self.sync_count,
+                'last sync seconds': self.sync_time,
+                'in flight': len(self.in_flight),
+                'waiting': len(self.waiting),
+                'sent': self.sent_count,
+                'resent': self.resent_count,
+                'timed out': self.timed_out_count}
+
+
+if __name__ == '__main__':
+    # Sync against a stand-in mixer that responds to each read after a delay, window of 1 vs WINDOW
+    import heapq
+
+    import CSCP_decode as decode
+    import CSCP_encode as encode
+
+    ROUND_TRIP = 0.002  # Seconds for the stand-in mixer to respond
+
+    class StubMixer:
+        """ Responds to reads after ROUND_TRIP, as a connection whose messages are handled straight away """
+        def __init__(self):
+            self.responses = []  # heap of (due, count, response bytes)
+            self.count = 0
+
+        def send(self, frame):
+            request = decode.Message(frame)
+            if request.operation == 'read_fader_label':
+                response = encode.Message('read_fader_label', request.strip, 'Ch {}'.format(request.strip),
+                                          recipient='controller')
+            else:
+                response = encode.Message('fader_path_info', request.strip, {'path_type': 1, 'path_width': 1,
+                                                                             'path_id': request.strip},
+                                          recipient='controller')
+            self.count += 1
+            heapq.heappush(self.responses, (time.perf_counter() + ROUND_TRIP, self.count, response.encoded))
+
+    for window in (1, WINDOW):
+        mixer = StubMixer()
+        sync = Sync(mixer, window=window)
+        info = schema.encode('read_console_info', {'CSCP version': 1, 'fader quantity': 192, 'mains quantity': 4,
+                                                   'console name': 'Summa'}, recipient='controller')
+        sync.received(decode.Message(info))
+        while sync.started is not None:
+            due, _, response = heapq.heappop(mixer.responses)
+            time.sleep(max(0, due - time.perf_counter()))
+            sync.received(decode.Message(response))
+        print('window {:>3}: 192 strips synced in {:.3f}s, with a {}ms round trip'.format(
+            window, sync.sync_time, ROUND_TRIP * 1000))
@@ -2,32 +2,25 @@
 
 import mido
 
-# TODO - fix fader jitter - noticed MIDI returns value-1 everytime?
-# - check this hypothesis, there could be a simple fix
+import CSCP_MIDI_scale
 
+# Fader jitter - MIDI used to return value-1 everytime, as the two scalings weren't inverses of each other.
+# Both directions now use the same CSCP_MIDI_scale tables, see adjust_scale()
 
-def adjust_scale(value):
-    # Convert CSCP fader value to MIDI pitchwheel value in range -8192 to 8192
-    # take a "pitch" value in range -8192 to +8192 and convert to a CSCP fader level
-    # TODO - Handle Alt MIDI mode - CC values 0-127
-    midi_min = -8192
-    midi_max = 8191
 
-    cscp_min = 0  # TODO - Check if this OK with PFL over-press,
-    # mixer will probably open Reaper's level control a bit
-    cscp_max = 1024  # TODO - Check this
+def adjust_scale(value, scale=None):
+    # Convert CSCP fader value 0 - 1024 to MIDI pitchwheel value in range -8192 to 8191
+    # scale - CSCP_MIDI_scale.Scale made from the mapping, default is linear over the full pitch range.
+    # Its level -> pitch table is the inverse of the pitch -> level one MIDI_to_CSCP uses,
+    # so levels convert back to the pitch they came from and echoed values don't drift
+    # TODO - Handle Alt MIDI mode - CC values 0-127, scale.cc()
+    # TODO - Check if level 0 is OK with PFL over-press, mixer will probably open Reaper's level control a bit
+    # Levels above 1024 (e.g. a noisy console) are taken as 1024, as CSCP_MIDI_mapping does
+    return (scale or CSCP_MIDI_scale.DEFAULT).level_to_pitch[min(value, CSCP_MIDI_scale.LEVEL_MAX)]
 
-    midi_range = midi_max - midi_min
-    cscp_range = cscp_max - cscp_min
 
-    scale_factor = midi_range / cscp_range
-    level = int(scale_factor * value)
-    level = level + midi_min  # Offset to handle negative min values
-
-    return level
-
-
-def convert_message(msg, mapping):
+def convert_message(msg, mapping, scale=None):
+    # scale - CSCP_MIDI_scale.Scale for the mapping, built once, see MIDI_to_CSCP.convert_message
     # message = CSCP_decode.Message(message)
     # print(message)
     if msg.operation == "fader_move":
@@ -36,7 +29,7 @@ def convert_message(msg, mapping):
             strip = mapping["CSCP to MIDI"]["strip_to_ch"][str(msg.strip)]
         except KeyError:
             return False
-        value = adjust_scale(msg.value)
+        value = adjust_scale(msg.value, scale)
         midi = mido.Message(mtype, channel=strip, pitch=value)
         return midi
 
@@ -82,6 +75,13 @@ def convert_message(msg, mapping):
     return False
 
 
+# Operations convert_message handles, and the mapping's table of strips for each.
+# CSCP_MIDI_mapping compiles these tables, its Mapping.subscription() is what the CSCP connection passes on
+MAPPED_OPERATIONS = {'fader_move': 'strip_to_ch',
+                     'pfl_toggle': 'pfl_strip_to_note',
+                     'cut_toggle': 'cut_strip_to_note'}
+
+
 if __name__ == '__main__':
 
     # Load the chosen control mapping json file
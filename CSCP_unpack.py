@@ -9,9 +9,12 @@
 
 # TODO - document and refactor
 
+import logging
 import time
 import CSCP_utils as utils
 
+log = logging.getLogger(__name__)
+
 
 def _find_header(data: bytes) -> int:
     """ Checks for CSCP protocol's SOH (start of header value - 0xF1 / dec 241w) within received data.
@@ -42,72 +45,181 @@ def _is_checksum_valid(message, header_byte, byte_count):
         return False
 
 
-def unpack_data(data, previous_insufficient_data=False):
+MAX_MESSAGE_LENGTH = 255 + 4  # Byte count is a single byte, plus SOH, BC, DEV & checksum bytes
+COMPACT_SIZE = 4096  # Unpacker only moves remaining bytes to the front of its buffer once this many are consumed
+ACK = 0x04
+NAK = 0x05
+
+# Unpacker's counters, one per way it recovers from data that isn't a valid message
+STATS = ('invalid checksum',  # Message with an invalid checksum, scanning resumes from the byte after its SOH
+         'false header',  # SOH whose message never completed, found to be data when a valid message followed it
+         'garbage bytes')  # Bytes skipped that were neither part of a valid message nor an ACK/NAK
+
+
+class Unpacker:
+    """
+    Streaming version of unpack_data(), one per connection.
+    Received chunks are appended to a single bytearray and messages are found in place, using bytearray.find
+    for the SOH and summing a memoryview for the checksum, rather than slicing off every message found and
+    concatenating residual data onto each chunk.
+    A message split across chunks is completed by the next feed().
+    ACKs & NAKs are returned in order with the messages, wherever they are in the data, except within
+    the bytes an invalid message's header claimed - they're more likely part of that message than ACK/NAKs.
+    If a message is invalid, e.g. its byte count byte was corrupted, scanning restarts at the next SOH after
+    its SOH, rather than after the bytes the byte count claimed, so valid messages following it aren't lost
+    """
+    def __init__(self, stats=None):
+        """
+        :param stats: optional dict, STATS counts are added to it & incremented
+        """
+        self.buffer = bytearray()
+        self.start = 0  # Index of the first byte not yet consumed - the start of a possible part message
+        self.scanned = 0  # Index up to which complete messages have been checked
+        self.stats = stats if stats is not None else {}
+        for stat in STATS:
+            self.stats.setdefault(stat, 0)
+
+    def reset(self):
+        """ Discard any part message, e.g. on reconnecting """
+        self.buffer.clear()
+        self.start = 0
+        self.scanned = 0
+
+    def _compact(self):
+        """ Drop consumed bytes from the front of the buffer, only copying once enough have built up """
+        if self.start == len(self.buffer):
+            self.reset()
+        elif self.start > COMPACT_SIZE:
+            del self.buffer[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+
+    def _skip(self, start, end, found, rejected):
+        """
+        Bytes from start to end aren't part of a valid message, pick out any ACKs & NAKs
+        :param rejected: list of (start, end) spans of invalid messages within, whose bytes aren't ACK/NAKs
+        """
+        buffer = self.buffer
+        garbage = end - start
+        if buffer.find(ACK, start, end) != -1 or buffer.find(NAK, start, end) != -1:
+            for i in range(start, end):
+                if (buffer[i] == ACK or buffer[i] == NAK) and not any(s <= i < e for s, e in rejected):
+                    found.append((i, i + 1))
+                    garbage -= 1
+        self.stats['garbage bytes'] += garbage
+        rejected.clear()
+
+    def feed_offsets(self, data):
+        """
+        Adds received data, finds the complete valid messages and ACK/NAKs
+        :param data: bytes
+        :return: list of (start, end) indexes of each message in self.buffer, in the order received,
+                 1 byte long for an ACK/NAK. Only valid until the next call
+        """
+        self._compact()
+        self.buffer += data
+
+        buffer = self.buffer
+        stats = self.stats
+        end = len(buffer)
+        found = []
+        pending = None  # First SOH whose message, if it is one, hasn't all been received yet
+        skipped = self.start  # Bytes from here to the next valid message aren't part of one
+        rejected = []  # (start, end) claimed by each SOH since skipped that wasn't a valid message
+        i = self.start
+        with memoryview(buffer) as view:
+            while True:
+                header_byte = buffer.find(utils.CSCP_HEADER_START, i)
+                if header_byte == -1:
+                    break
+
+                if header_byte + 1 == end:  # SOH found in last byte
+                    if pending is None:
+                        pending = header_byte
+                    break
+
+                message_end = header_byte + buffer[header_byte + utils.BYTE_COUNT_BYTE] + 4
+                if message_end > end:
+                    # Either not a real SOH or the rest of the message is still to come, keep looking after it
+                    if pending is None:
+                        pending = header_byte
+                    rejected.append((header_byte, message_end))
+                    i = header_byte + 1
+
+                elif (sum(view[header_byte + utils.CSCP_HEADER_LENGTH:message_end]) & 0xFF) == 0:
+                    # Payload plus its two's complement checksum sums to 0
+                    if pending is not None:
+                        stats['false header'] += 1
+                        pending = None
+                    if header_byte > skipped:
+                        self._skip(skipped, header_byte, found, rejected)
+                    rejected.clear()
+                    found.append((header_byte, message_end))
+                    skipped = i = message_end
+
+                else:
+                    if message_end > self.scanned:  # Not already counted when checking a previous chunk
+                        log.warning('invalid checksum')
+                        stats['invalid checksum'] += 1
+                    rejected.append((header_byte, message_end))
+                    i = header_byte + 1
+
+        self.scanned = end
+        if pending is None:
+            self._skip(skipped, end, found, rejected)
+            self.start = end
+        else:
+            # The pending message is incomplete, so less than MAX_MESSAGE_LENGTH is kept for the next feed()
+            self._skip(skipped, pending, found, rejected)
+            self.start = pending
+        return found
+
+    def feed(self, data):
+        """
+        :param data: bytes
+        :return: list of each valid message found as bytes, and ACK/NAKs as ints, in the order received
+        """
+        offsets = self.feed_offsets(data)
+        r = []
+        with memoryview(self.buffer) as view:
+            for start, end in offsets:
+                if end - start == 1:
+                    r.append(view[start])
+                    if view[start] == NAK:
+                        log.warning('NOT ACKNOWLEDGED!')
+                else:
+                    r.append(view[start:end].tobytes())
+        return r
+
+    def residual_size(self):
+        """ :return: int, bytes held that may be the beginning of a message """
+        return len(self.buffer) - self.start
+
+    def residual(self):
+        """ :return: bytes held that may be the beginning of a message, False if none """
+        if self.start == len(self.buffer):
+            return False
+        return bytes(self.buffer[self.start:])
+
+
+def unpack_data(data, previous_insufficient_data=False, stats=None):
     """ Takes bytes, (and any residual bytes returned from previous call).
         Extracts and returns valid CSCP messages found within
         also returns any residual data from the end that could be the beginning of a valid message
         (with remainder of message in next bytes to be received - to supply to this function in next call)
+        Connections use an Unpacker instead, which keeps the residual data itself
 
     :param data: bytes
     :param previous_insufficient_data: bytes (possible start of message from preceding data)
-    :return: bytes, bytes or bool (extracted messages, residual data that may be beginning of message who's remainder
-                is due in next received data
+    :param stats: optional dict, Unpacker's STATS counts are incremented in it
+    :return: list, bytes or bool (extracted messages & ACK/NAK ints, residual data that may be beginning of message
+                who's remainder is due in next received data
     """
-
-    if len(data) == 1 and data[0] == 0x04:  # ACK recieved as single byte - TODO - check if ACKs are always on their own in a 1024 receive?
-        #print('received ACK')
-        return data, False
-
-    elif len(data) == 1 and data[0] == 0x05:  # NAK
-        print('NOT ACKNOWLEDGED!')
-        return data, False
-
+    unpacker = Unpacker(stats)
     if previous_insufficient_data:
-        data = previous_insufficient_data + data # TODO - test this
-
-    messages = []
-    insufficient_data = False
-
-    while len(data) > 0:
-        header_byte = _find_header(data)  # First index within data containing a CSCP start of header value (0xF1 / 241)
-        if header_byte != -1:
-
-            if header_byte + 1 == len(data):  # SOH found in last byte
-                insufficient_data = data[header_byte:]
-                break
-
-            byte_count = data[header_byte + utils.BYTE_COUNT_BYTE]
-            checksum_byte = header_byte + utils.CSCP_HEADER_LENGTH + byte_count
-            total_message_length = byte_count + 4  # CSCP byte count value excludes, SOH, BC, DEV, and Checksum bytes
-
-            if total_message_length > len(data):
-                #print ('CSCP SOH found but no checksum - either invalid SOH or remainder of message to follow in next received data')
-                insufficient_data = data[header_byte:]     # if no further header bytes found, this could be the start of a valid message continued in next data to be received
-                data = data[header_byte + 1:]  # discard this header byte for next loop
-
-            elif _is_checksum_valid(data, header_byte, byte_count):
-                insufficient_data = False
-                #print('\nvalid CSCP message found')
-                preceding_data = data[:header_byte]  # TODO - don't discard, try adding to end of previoulsy received data to see if valid message spans two data blocks
-                #print('preceding data - {}'.format(preceding_data))
-
-                message = data[header_byte:checksum_byte+1]
-                #print('message - {}'.format(message))
-                messages.append(message)
-                byte_count = data[header_byte + utils.BYTE_COUNT_BYTE]
-                data = data[checksum_byte+1:]  # Discard processed message for next loop
-                #print('remaining data - {}'.format(data))
-
-
-            else:
-                print ('invalid checksum')
-                data = data[checksum_byte+1:]  # Discard processed message for next loop
-
-        else:
-            break  # No more CSCP start of headers found
-
-    #print ('messages extracted:', messages, ' insufficient_data:', insufficient_data)
-    return messages, insufficient_data
+        unpacker.buffer += previous_insufficient_data
+    messages = unpacker.feed(data)
+    return messages, unpacker.residual()
 
 
 if __name__ == '__main__':
@@ -120,6 +232,7 @@ if __name__ == '__main__':
                     b'\x80\xf1\x06\x00\x80\x00\x00\x03\x02\xE8\x93\x90\x80\xf1\x06\x00\x80\x00\x00\x03\x02\xE8\x93\x90\xf1\x06\x00\x80\xf1\x06\x00\x80\x00\x00\x03\x02\xE8\x93\x90\xf1',
                     b'\xf1\t\xff\x80\x07My Brio\x07\xf1\x16\xff\x80\x08\x00\x15\x00`\x00\x04\x00\x00\x00\x00\x00\x00My Brio\x00\x8d\xf1\r\xff\x80\x0b\x00\x00Mic -R tn\xbb\xf1\n\xff\x80\x0b\x00\x01Mic -L\xc2\xf1\n\xff\x80\x0b\x00\x02Mic -C\xca\xf1\x0c\xff\x80\x0b\x00\x03Mic -Lfe\xf5\xf1\x0b\xff\x80\x0b\x00\x04Mic -LsL\xf1\x0b\xff\x80\x0b\x00\x05Mic -RsE\xf1\n\xff\x80\x0b\x00\x06Mic 07\xcf\xf1\n\xff\x80\x0b\x00\x07Mic 08\xcd\xf1\n\xff\x80\x0b\x00\x08Mic 09\xcb\xf1\n\xff\x80\x0b\x00\tMic 10\xd2\xf1\x0b\xff\x80\x0b\x00\n9-1-004\x13\xf1\x0b\xff\x80\x0b\x00\x0b9-1-006\x10\xf1\n\xff\x80\x0b\x00\x0cMic 13\xcc\xf1\n\xff\x80\x0b\x00\rMic 14\xca\xf1\n\xff\x80\x0b\x00\x0eMic 15\xc8\xf1\n\xff\x80\x0b\x00\x0fMic 16\xc6\xf1\n\xff\x80\x0b\x00\x10Mic 17\xc4\xf1\r\xff\x80\x0b\x00\x11Mic 18 tn\xc0\xf1\x0c\xff\x80\x0b\x00\x12L 1F 19A\xb5\xf1\n\xff\x80\x0b\x00\x13Mic -R\xaa\xf1\n\xff\x80\x0b\x00\x14Mic 13\xc4\xf1\n\xff\x80\x0b\x00\x15Mic 14\xc2\xf1\x0c\xff\x80\x0b\x00\x16L 1F 23A\xb6\xf1\x0c\xff\x80\x0b\x00\x17L 1F 24A\xb4\xf1\x0c\xff\x80\x0b\x00\x18L 1F 25A\xb2\xf1\x0c\xff\x80\x0b\x00\x19L 1F 26A\xb0\xf1\x0c\xff\x80\x0b\x00\x1aL 1F 27A\xae\xf1\x0c\xff\x80\x0b\x00\x1bL 1F 28A\xac\xf1\x0c\xff\x80\x0b\x00\x1cL 1F 29A\xaa\xf1\x0c\xff\x80\x0b\x00\x1dL 1F 30A\xb1\xf1\x0c\xff\x80\x0b\x00\x1eL 1F 31A\xaf\xf1\x0c\xff\x80\x0b\x00\x1fL 1F 32A\xad\xf1\x0c\xff\x80\x0b\x00 L 1F 33A\xab\xf1\x0c\xff\x80\x0b\x00!L 1F 34A\xa9\xf1\x0c\xff\x80\x0b\x00"L 1F 35A\xa7\xf1\x0c\xff\x80\x0b\x00#L 1F 36A\xa5\xf1\n\xff\x80\x0b\x00$Mic 11\xb6\xf1\x0c\xff\x80\x0b\x00%L 1F  2B\xb9\xf1\x0c\xff\x80\x0b\x00&L 1F  3B\xb7\xf1\x0c\xff\x80\x0b\x00\'L 1F  4B\xb5\xf1\x0c\xff\x80\x0b\x00(L 1F  5B\xb3\xf1\x0c\xff\x80\x0b\x00)L 1F  6B\xb1\xf1\x0c\xff\x80\x0b\x00*L 1F  7B\xaf\xf1\x0c\xff\x80\x0b\x00+L 1F  8B\xad\xf1\x0c\xff\x80\x0b\x00,L 1F  9B\xab\xf1\x0c\xff\x80\x0b\x00-L 1F 10B\xa2\xf1\x0b\xff\x80\x0b\x00.9-1-005\xee\xf1\x0b\xff\x80\x0b\x00/9-1-007\xeb\xf1"\xff\x80\x0b\x000VCA MasterVCA MasterVCAMaster\x13\xf1\n\xff\x80\x0b\x001Mic 13\xa7\xf1\x0f\xff\x80\x0b\x002jhihojufydh\xa7\xf1\x1b\xff\x80\x0b\x00317B Direct Output -L tn\xd1\xf1\x0f\xff\x80\x0b\x004L 1F 17B tn\x92\xf1\n\xff\x80\x0b\x005Mic 10\xa6\xf1\x0b\xff\x80\x0b\x006Group 1\xe1\xf1\x0c\xff\x80\x0b\x007L 1F 20B\x97\xf1\n\xff\x80\x0b\x008Main 1g\xf1\x0f\xff\x80\x0b\x009L 1F 22B tn\x91\xf1\x0c\xff\x80\x0b\x00:fcfhggfd\x0c\xf1\n\xff\x80\x0b\x00;Main 3b\xf1\t\xff\x80\x0b\x00<Aux 1\xba\xf1\t\xff\x80\x0b\x00=Au', # example of random unsolicited message received:
                     ]
+    captured_data = test_data
 
     # following test data created by encode - checksum is worng, but seems to pass checks in this script?
     test_data = [b'\xf1\x06\x00P\x00\x00\x03\x02\xe8\xc3', # message created by me - mixer refuses but I think valid
@@ -160,4 +273,81 @@ if __name__ == '__main__':
     print(messages, residual)
     messages, residual = unpack_data(test_data_split[1], residual)
     print(messages, residual)
-    """
\ No newline at end of file
+    """
+
+    # Benchmark - Unpacker against the original unpack_data, on the sample data received in 1024 byte chunks
+    import timeit
+
+    def legacy_unpack_data(data, previous_insufficient_data=False):
+        """ unpack_data before Unpacker, slicing off each message found and concatenating residual data
+            (with its length check fixed to allow for data before the SOH, it raised IndexError on these chunks) """
+        if previous_insufficient_data:
+            data = previous_insufficient_data + data
+        messages = []
+        insufficient_data = False
+        while len(data) > 0:
+            header_byte = _find_header(data)
+            if header_byte == -1:
+                break
+            if header_byte + 1 == len(data):
+                insufficient_data = data[header_byte:]
+                break
+            byte_count = data[header_byte + utils.BYTE_COUNT_BYTE]
+            checksum_byte = header_byte + utils.CSCP_HEADER_LENGTH + byte_count
+            if header_byte + byte_count + 4 > len(data):
+                insufficient_data = data[header_byte:]
+                data = data[header_byte + 1:]
+            elif _is_checksum_valid(data, header_byte, byte_count):
+                insufficient_data = False
+                messages.append(data[header_byte:checksum_byte + 1])
+                data = data[checksum_byte + 1:]
+            else:
+                data = data[checksum_byte + 1:]
+        return messages, insufficient_data
+
+    def chunks(stream, size=1024):
+        return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+    streams = {'label dump': chunks(captured_data[6] * 64),
+               'fader moves': chunks(captured_data[0] * 6400),
+               'mixed samples': chunks(b''.join(captured_data[:6] + test_data) * 256)}
+
+    def run_legacy(data_chunks):
+        messages = []
+        residual = False
+        for chunk in data_chunks:
+            found, residual = legacy_unpack_data(chunk, residual)
+            messages += found
+        return messages
+
+    def run_unpacker(data_chunks):
+        messages = []
+        unpacker = Unpacker()
+        for chunk in data_chunks:
+            messages += unpacker.feed(chunk)
+        return messages
+
+    logging.disable(logging.WARNING)  # Don't log the invalid checksums in the samples
+    # Unpacker finds more messages than legacy where a corrupt or cut off message hid valid ones after it
+    print('\n{:<15}{:>8}{:>17}{:>10}{:>14}{:>14}'.format('stream', 'chunks', 'legacy messages', 'messages',
+                                                          'legacy us', 'Unpacker us'))
+    for name, data_chunks in streams.items():
+        legacy_time = min(timeit.repeat(lambda: run_legacy(data_chunks), number=3, repeat=3)) / 3
+        unpacker_time = min(timeit.repeat(lambda: run_unpacker(data_chunks), number=3, repeat=3)) / 3
+        print('{:<15}{:>8}{:>17}{:>10}{:>14.0f}{:>14.0f}'.format(name, len(data_chunks),
+                                                                 len(run_legacy(data_chunks)),
+                                                                 len(run_unpacker(data_chunks)),
+                                                                 legacy_time * 1e6, unpacker_time * 1e6))
+
+    # Recovery - a fader move with its byte count corrupted, followed by valid fader moves and ACKs
+    fader_move = captured_data[0]
+    corrupt = fader_move[:1] + b'\x20' + fader_move[2:]
+    stream = corrupt + b'\x04' + fader_move + b'\x04\x05' + fader_move + b'\x80\x04'
+    recovery_stats = {}
+    unpacker = Unpacker(recovery_stats)
+    found = []
+    for i in range(0, len(stream), 7):
+        found += unpacker.feed(stream[i:i + 7])
+    print('\nlegacy found:', legacy_unpack_data(stream)[0])
+    print('Unpacker found:', found)
+    print('Unpacker stats:', recovery_stats, 'residual:', unpacker.residual())
@@ -22,43 +22,6 @@ DEVICES = {0: 'mixer', 255: 'controller'}
 # CMD MSB decimal values
 TYPE = {0: 'read', 128: 'write'}  # 0x00 / 0x80
 
-# CMD LSB decimal values
-OPERATIONS = {0: 'fader_move',
-              1: 'cut_toggle',
-              2: 'main_fader_move',
-              5: 'pfl_toggle',
-              7: 'read_console_name',
-              8: 'read_console_info',
-              11: 'read_fader_label',
-              12: 'main_pfl_toggle',
-              13: 'main_fader_level',
-              16: 'available_auxes',
-              17: 'fader_path_info',
-              18: 'aux_send_toggle',
-              19: 'aux_output_level_change',
-              20: 'available_mains',
-              21: 'main_send_toggle',
-              22: 'input_routing_change',
-              }
-
-OP_BYTE_COUNTS = {'fader_move': 6,
-                  'cut_toggle': 5,
-                  'main_fader_move': 6,
-                  'pfl_toggle': 5,
-                  'read_console_name': 2,
-                  'read_console_info': 2,
-                  'read_fader_label': 4,
-                  'main_pfl_toggle': 5,
-                  'aux_send_toggle': 5,
-                  'aux_output_level_change': 6,
-                  # TODO - get main_send_toggle working
-                  # The following wont work if number of paths to pass is < 192
-                  # ... should handle BC values better generally(?)
-                  'main_send_toggle': 28,
-
-                  'input_routing_change': 5,
-                  }
-
 PATH_TYPES = {0: 'No Path',
               1: 'Input Channel',
               2: 'Group',
@@ -79,6 +42,44 @@ AUDIO_WIDTHS = {0: 'None',
                 6: 'Surround',
                 }
 
+# The protocol, per operation - CMD LSB decimal value: name & the fields following the CMD bytes,
+# for write messages and, if different, for read messages. Compiled into encoders & decoders by CSCP_schema.
+# Read messages default to the write fields up to & including the strip, i.e. just saying which strip to read.
+# Fields are (name, kind) or (name, kind, lookup table):
+#   'B', 'H' etc - a struct format, big endian. A lookup table translates the number to a name
+#   (None, '6x') - bytes to skip
+#   'str' - text taking up the rest of the message
+#   'cstr' - text taking up the rest of the message, ending with a 0 byte
+#   'bits' - (name, 'bits', number of bytes), a bitmask, its value being the numbers of the bits set
+# A message's value is its 'value' field, or a dict of its fields other than the strip if it has no 'value'
+STRIP = ('strip', 'H')
+
+SCHEMA = {0: {'name': 'fader_move', 'write': (STRIP, ('value', 'H'))},
+          1: {'name': 'cut_toggle', 'write': (STRIP, ('value', 'B'))},
+          2: {'name': 'main_fader_move', 'write': (STRIP, ('value', 'H'))},
+          5: {'name': 'pfl_toggle', 'write': (STRIP, ('value', 'B'))},
+          7: {'name': 'read_console_name', 'read': (), 'write': (('value', 'str'),)},
+          8: {'name': 'read_console_info', 'read': (),
+              'write': (('CSCP version', 'H'), ('fader quantity', 'H'), ('mains quantity', 'H'), (None, '6x'),
+                        ('console name', 'cstr'))},
+          11: {'name': 'read_fader_label', 'write': (STRIP, ('value', 'str'))},
+          12: {'name': 'main_pfl_toggle', 'write': (STRIP, ('value', 'B'))},
+          13: {'name': 'main_fader_level', 'write': (STRIP,)},
+          16: {'name': 'available_auxes', 'write': (STRIP,)},
+          17: {'name': 'fader_path_info',
+               'write': (STRIP, ('path_type', 'B', PATH_TYPES), ('path_width', 'B', AUDIO_WIDTHS), ('path_id', 'H'))},
+          18: {'name': 'aux_send_toggle', 'write': (STRIP, ('value', 'B'))},
+          19: {'name': 'aux_output_level_change', 'write': (STRIP, ('value', 'H'))},
+          20: {'name': 'available_mains', 'write': (STRIP,)},
+          # TODO - get main_send_toggle working, a byte count of 28 assumes a 1 byte main and 25 bytes of paths,
+          #  not checked against a mixer yet
+          21: {'name': 'main_send_toggle', 'write': (('strip', 'B'), ('value', 'bits', 25))},
+          22: {'name': 'input_routing_change', 'write': (STRIP, ('value', 'B'))},
+          }
+
+# CMD LSB decimal values
+OPERATIONS = {code: operation['name'] for code, operation in SCHEMA.items()}
+
 
 def twoscomp(value):
     # Takes a binary string, returns twos compliment
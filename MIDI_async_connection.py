@@ -0,0 +1,92 @@
+# MIDI_async_connection
+# Used by the CSCP-MIDI application when running in async mode.
+# asyncio version of MIDI_connection - rather than running a thread per input port,
+# mido/rtmidi's own callback hands each received message to the event loop.
+# Provides the same public methods as MIDI_connection.Connection
+# Copyright Peter Walker 2020.
+# Feedback - peter.allan.walker@gmail.com
+
+import asyncio
+import logging
+
+import mido
+
+import CSCP_capture
+import CSCP_MIDI_buffer as buffer
+
+BUFFER_SIZE = 4096  # Max received messages held waiting to be handled
+OVERFLOW = buffer.DROP_OLDEST  # What to do when that's exceeded. Not BLOCK, that would stall the event loop
+
+log = logging.getLogger(__name__)
+
+
+class Connection:
+    """
+    An asyncio MIDI Connection object
+    Must be created from within a running event loop, received messages are stored on that loop
+    """
+    def __init__(self, midi_input, midi_output, notify=None, buffer_size=BUFFER_SIZE, overflow=OVERFLOW,
+                 capture=None):
+        """
+        :param midi_input: string, name of MIDI input port to receive from
+        :param midi_output: string, name of MIDI output port to send to
+        :param notify: optional callable, called on the event loop whenever a message is received,
+                       e.g. asyncio.Event.set to wake up whatever is waiting on them
+        :param buffer_size: int, maximum number of received messages held
+        :param overflow: policy when the buffer is full, one of CSCP_MIDI_buffer.OVERFLOW_POLICIES
+        :param capture: optional CSCP_capture.Recorder, everything received is recorded to it
+        """
+        self.input = midi_input
+        self.output = midi_output
+        self.notify = notify
+        self.capture = capture
+        self.messages = buffer.MessageBuffer(buffer_size, overflow)
+        self.loop = asyncio.get_running_loop()
+
+        # mido calls _callback from the MIDI backend's thread for every message received
+        self.receiver = mido.open_input(self.input, callback=self._callback)
+        log.info("%s - MIDI input port is listening for control messages", self.receiver)
+
+        self.transmitter = mido.open_output(self.output)
+
+    def _callback(self, msg):
+        """ Called from the MIDI backend's thread, pass the message over to the event loop """
+        if self.capture:
+            self.capture.record(CSCP_capture.MIDI, msg)
+        self.loop.call_soon_threadsafe(self._receive, msg)
+
+    def _receive(self, msg):
+        """ Called on the event loop """
+        self.messages.put(msg)
+        if self.notify:
+            self.notify()
+
+    # The following are intended to be externally accessed/public methods
+    def get_message(self):
+        """
+        Returns and removes first message from self.messages
+        :return:
+        """
+        return self.messages.get()
+
+    def get_messages(self, max_n):
+        """
+        public / called externally
+        - removes and returns up to max_n of the oldest messages in the buffer
+        :param max_n: int
+        :return: list of mido messages, oldest first (empty if none received)
+        """
+        return self.messages.get_many(max_n)
+
+    def stats(self):
+        """
+        :return: dict of connection counters, for tuning buffer size
+        """
+        return {'receive buffer': self.messages.stats()}
+
+    def send_message(self, msg):
+        self.transmitter.send(msg)
+
+    def close(self):
+        self.receiver.close()
+        self.transmitter.close()
@@ -6,16 +6,41 @@
 # Copyright Peter Walker 2020.
 # Feedback - peter.allan.walker@gmail.com
 
+import logging
 import mido
 import threading
+import time
+
+import CSCP_capture
+import CSCP_MIDI_buffer as buffer
+
+BUFFER_SIZE = 4096  # Max received messages held waiting to be handled
+OVERFLOW = buffer.DROP_OLDEST  # What to do when that's exceeded, see CSCP_MIDI_buffer
+
+log = logging.getLogger(__name__)
 
 
 class Connection:
 
-    def __init__(self, midi_input, midi_output):
+    def __init__(self, midi_input, midi_output, notify=None, buffer_size=BUFFER_SIZE, overflow=OVERFLOW,
+                 latency=None, capture=None):
+        """
+        :param midi_input: string, name of MIDI input port to receive from
+        :param midi_output: string, name of MIDI output port to send to
+        :param notify: optional callable, called (from the receiver thread) whenever a message is received,
+                       e.g. threading.Event.set to wake up whatever is waiting on them
+        :param buffer_size: int, maximum number of received messages held
+        :param overflow: policy when the buffer is full, one of CSCP_MIDI_buffer.OVERFLOW_POLICIES
+        :param latency: optional CSCP_MIDI_latency.LatencyRecorder. If given, received messages' .time
+                        is set to when they were received, for the bridge to time
+        :param capture: optional CSCP_capture.Recorder, everything received is recorded to it
+        """
         self.input = midi_input
         self.output = midi_output
-        self.messages = []
+        self.notify = notify
+        self.latency = latency
+        self.capture = capture
+        self.messages = buffer.MessageBuffer(buffer_size, overflow)
 
         self.receiver = threading.Thread(target=self._run)  # target is the method called when thread starts
         self.receiver.daemon = True  # Important - without this, cannot kill with control+c
@@ -28,11 +53,17 @@ class Connection:
         Start listening for messages on the MIDI input
         """
         with mido.open_input(self.input) as input_port:
-            print("{} - MIDI input port is listening for control messages".format(input_port))
+            log.info("%s - MIDI input port is listening for control messages", input_port)
             # Handle incoming MIDI messages
             for msg in input_port:
                 # print("MIDI input message received: ", msg)
-                self.messages.append(msg)
+                if self.latency:
+                    msg.time = time.perf_counter()
+                if self.capture:
+                    self.capture.record(CSCP_capture.MIDI, msg)
+                self.messages.put(msg)
+                if self.notify:
+                    self.notify()
 
     # The following are intended to be externally accessed/public methods
     def get_message(self):
@@ -40,11 +71,22 @@ class Connection:
         Returns and removes first message from self.messages
         :return:
         """
-        r = False
-        if self.messages:
-            r = self.messages[0]
-            self.messages = self.messages[1:]
-        return r
+        return self.messages.get()
+
+    def get_messages(self, max_n):
+        """
+        public / called externally
+        - removes and returns up to max_n of the oldest messages in the buffer
+        :param max_n: int
+        :return: list of mido messages, oldest first (empty if none received)
+        """
+        return self.messages.get_many(max_n)
+
+    def stats(self):
+        """
+        :return: dict of connection counters, for tuning buffer size
+        """
+        return {'receive buffer': self.messages.stats()}
 
     def send_message(self, msg):
         # print("DEBUG CSCP SEND", msg)
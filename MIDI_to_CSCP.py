@@ -9,45 +9,41 @@
 
 
 import CSCP_encode
+import CSCP_MIDI_scale
 
+# Ready made CSCP messages, most MIDI messages convert to one already made
+frame_cache = CSCP_encode.FrameCache()
 
-def _adjust_scale(level):
-    # take a "pitch" value in range -8192 to +8192 and convert to a CSCP fader level
-    # TODO - Handle Alt MIDI mode - CC values 0-127
-    midi_min = -8192
-    midi_max = 8192
-    cscp_min = 0  # TODO - Check if this OK with PFL over-press
-    cscp_max = 1024  # TODO - Check this
 
-    midi_range = midi_max - midi_min
-    cscp_range = cscp_max - cscp_min
+def _adjust_scale(level, scale=None):
+    # take a "pitch" value in range -8192 to +8191 and convert to a CSCP fader level
+    # scale - CSCP_MIDI_scale.Scale made from the mapping, default is linear over the full pitch range
+    # TODO - Handle Alt MIDI mode - CC values 0-127, scale.cc_level()
+    # TODO - Check if level 0 is OK with PFL over-press
+    return (scale or CSCP_MIDI_scale.DEFAULT).pitch_to_level[level - CSCP_MIDI_scale.PITCH_MIN]
 
-    scale_factor = cscp_range / midi_range
 
-    level = level - midi_min  # Offset to handle negative min values
-    converted_level = int(scale_factor * level)
-    #print("DEBUG:", converted_level)
-    return converted_level
-
-
-def convert_message(message, mapping):
+def convert_message(message, mapping, scale=None):
     """
     :param message: MIDI message from mido
     :param mapping: dict loaded from json control mapping file
-    :returns CSCP_encode message object
+    :param scale: CSCP_MIDI_scale.Scale for the mapping, e.g. from CSCP_MIDI_scale.from_mapping(),
+                  build it once rather than per message. Default is linear over the full pitch range
+    :returns CSCP_encode message object, shared with other conversions so mustn't be changed
     """
     # TODO - figure out how to structure json mapping file to allow fewer conditionals in the following
     # (not too bad at the moment, but as I add more controls and different mappings/modes it will get cumbersome
-    # TODO - passing the control mapping dict for each message feels inefficient
+    # Passing the control mapping dict for each message is inefficient,
+    # the bridge uses a CSCP_MIDI_mapping.Mapping compiled from it instead
     if message.type == "pitchwheel":
         try:
             command = mapping["control_map"]["pitchwheel"]["command"]
             strip = mapping["control_map"]["pitchwheel"]["ch_to_strip"][str(message.channel)]
-            value = _adjust_scale(message.pitch)
+            value = _adjust_scale(message.pitch, scale)
         except KeyError:
             return False
 
-        return CSCP_encode.Message(command, strip, value)
+        return frame_cache.message(command, strip, value)
 
     elif message.type == "note_on":
         try:
@@ -58,7 +54,8 @@ def convert_message(message, mapping):
             return False
 
         # TODO - need to figure out how to handle actual state to allow toggle of function!
-        return CSCP_encode.Message(command, strip, value)
+        #  (the bridge's CSCP_state.MixerState now holds each strip's current cut/pfl state)
+        return frame_cache.message(command, strip, value)
 
 
 if __name__ == '__main__':